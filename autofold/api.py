@@ -199,7 +199,7 @@ class ManifoldAPI():
 			time.sleep(0.1)  # Sleep 100 milliseconds if the queue is empty 
 	
 
-	def retrieve_all_data(self, api_call_func, max_limit=1000, **api_params):
+	def retrieve_all_data(self, api_call_func, max_limit=1000, until_id=None, **api_params):
 		'''
 		Iteratively retrieves all available data from an API endpoint that supports pagination via a `before` parameter.
 
@@ -207,6 +207,8 @@ class ManifoldAPI():
 			Required. A function that makes the API call and returns a Future object.
 		:param int max_limit: 
 			Optional. The maximum number of items to request in a single API call. Default is 1000.
+		:param str until_id: 
+			Optional. Stops at the item with this ID and only returns the items before it, i.e. the items newer than an already known one. Default is None (all items).
 		:param api_params: 
 			Optional. Additional parameters to pass to the API call function. Must be passed as keyword arguments.
 		:type api_params: dict
@@ -244,6 +246,11 @@ class ManifoldAPI():
 				response = future_response.result()
 
 				if response:
+					if until_id is not None:
+						known = next((index for index, item in enumerate(response) if item['id'] == until_id), None)
+						if known is not None:
+							all_data.extend(response[:known])
+							break
 					all_data.extend(response)
 					last_item_id = response[-1]['id']
 					has_more_data = len(response) == max_limit
@@ -6,6 +6,8 @@ from autofold.api import ManifoldAPI
 from autofold.bot import AutomationBot
 from autofold.subscriber import ManifoldSubscriber
 from autofold.database import ManifoldDatabaseReader
+from autofold.market_state import MarketStateStore
+from autofold.event_bus import EventBus
 
 class Automation(ABC):
 	'''
@@ -25,7 +27,15 @@ class Automation(ABC):
 	- ``manifold_api``: The ManifoldAPI instance extracted from automation_bot.
 	- ``manifold_db_reader``: The ManifoldDatabaseReader instance extracted from automation_bot.
 	- ``manifold_subscriber``: The ManifoldSubscriber instance extracted from automation_bot.
+	- ``market_state_store``: The MarketStateStore instance extracted from automation_bot. Holds the live state of subscribed markets.
+	- ``event_bus``: The EventBus instance extracted from automation_bot. Delivers retrieved markets, bets, positions and users as they arrive.
 	- ``db``: The TinyDB instance for this automation.
+
+	.. note::
+
+		Automations registered with ``isolation="process"`` run in their own worker process (see ``AutomationBot``). There, ``automation_bot`` only holds
+		the attributes above, ``manifold_api``, ``manifold_subscriber``, ``market_state_store`` and ``event_bus`` are proxies whose methods run in the bot's
+		process (see ``AutomationHub``), and ``manifold_db_reader`` reads the database from the worker process.
 	''' 
 
 	def __init__(self, tiny_db_path: str):
@@ -39,6 +49,8 @@ class Automation(ABC):
 		self.manifold_api: ManifoldAPI = None
 		self.manifold_db_reader: ManifoldDatabaseReader = None
 		self.manifold_subscriber: ManifoldSubscriber = None
+		self.market_state_store: MarketStateStore = None
+		self.event_bus: EventBus = None
 		self.db: TinyDB = None 
   
 		# Ensure the directory exists
@@ -51,6 +63,8 @@ class Automation(ABC):
 		self.manifold_api = automation_bot.manifold_api
 		self.manifold_db_reader = automation_bot.manifold_db_reader
 		self.manifold_subscriber = automation_bot.manifold_subscriber
+		self.market_state_store = automation_bot.market_state_store
+		self.event_bus = automation_bot.event_bus
 		self.db = TinyDB(self.tiny_db_path)
 		
 	
@@ -0,0 +1,417 @@
+import itertools
+import multiprocessing
+import sys
+import threading
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import SimpleNamespace
+from loguru import logger
+
+from autofold.database import ManifoldDatabase
+from autofold.database import ManifoldDatabaseReader
+from autofold.event_bus import EventSubscription
+
+'''
+Protocol
+
+Messages are pickled tuples sent over a ``multiprocessing`` pipe between the bot (the hub) and an automation's worker process.
+Both sides send requests and answer the requests of the other side.
+
+- ``("request", request_id, payload)``: A request. Requests with a request_id of None expect no reply.
+- ``("pending", request_id, None)``: The request returned a Future, its result follows once it completes.
+- ``("result", request_id, value)`` or ``("error", request_id, exception)``: The result of a request.
+
+Worker to hub payloads:
+- ``("call", target, name, args, kwargs)``: Call the public method ``name`` of the hub's ``api``, ``subscriber``, ``market_state_store``
+  or ``event_bus``, or of a handle (an object returned by an earlier call, such as an ``EventSubscription``).
+- ``("release", handle)``: Forget a handle.
+
+Hub to worker payloads:
+- ``("callback", callback_id, args)``: Call a callback the worker passed to the hub. The reply is sent once the callback returned.
+- ``("stop",)``: Call the automation's ``stop``.
+'''
+
+
+class _CallbackRef:
+    # A function of the worker passed as an argument to the hub
+    def __init__(self, callback_id, name):
+        self.callback_id = callback_id
+        self.name = name
+
+
+class _HandleRef:
+    # An object returned by the hub that stays in the hub process
+    def __init__(self, handle_id):
+        self.handle_id = handle_id
+
+
+class _Channel:
+    '''
+    Requests and replies in both directions over one connection. Incoming requests are handled on a thread pool,
+    so a blocking request (such as waiting for events) does not hold up the others.
+    '''
+    def __init__(self, conn, handler, name, workers=8):
+        self._conn = conn
+        self._handler = handler
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._request_ids = itertools.count()
+        self._executor = ThreadPoolExecutor(thread_name_prefix=f"{name}_HANDLER", max_workers=workers)
+        self.closed = threading.Event()
+        self._thread = threading.Thread(target=self._receive_thread, name=f"{name}_RECEIVE", daemon=True)
+        self._thread.start()
+
+    def _send(self, message):
+        try:
+            with self._send_lock:
+                self._conn.send(message)
+        except (OSError, ValueError) as e:
+            raise ConnectionError(f"Lost connection to the automation process: {e}")
+
+    def notify(self, payload):
+        """
+        Sends a request without waiting for a reply.
+        """
+        self._send(("request", None, payload))
+
+    def call(self, payload, timeout=None):
+        """
+        Sends a request and returns its result, or a Future if the other side returned one.
+        Raises TimeoutError if no reply arrives within ``timeout`` seconds, a late reply is dropped.
+        """
+        if self.closed.is_set():
+            raise ConnectionError("The connection to the automation process is closed")
+        request_id = next(self._request_ids)
+        entry = {"replied": threading.Event(), "future": Future(), "pending": False}
+        with self._pending_lock:
+            self._pending[request_id] = entry
+        try:
+            self._send(("request", request_id, payload))
+        except ConnectionError:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            raise
+        if not entry["replied"].wait(timeout):
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            raise TimeoutError(f"No reply to {payload[0]} within {timeout}s")
+        return entry["future"] if entry["pending"] else entry["future"].result()
+
+    def _receive_thread(self):
+        while True:
+            try:
+                kind, request_id, payload = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            if kind == "request":
+                self._executor.submit(self._handle, request_id, payload)
+                continue
+            with self._pending_lock:
+                entry = self._pending.get(request_id) if kind == "pending" else self._pending.pop(request_id, None)
+            if entry is None:
+                continue
+            if kind == "pending":
+                entry["pending"] = True
+            elif kind == "result":
+                entry["future"].set_result(payload)
+            else:
+                entry["future"].set_exception(payload)
+            entry["replied"].set()
+
+        # Fail everything still waiting for the other side
+        self.closed.set()
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for entry in pending.values():
+            entry["future"].set_exception(ConnectionError("Lost connection to the automation process"))
+            entry["replied"].set()
+
+    def _handle(self, request_id, payload):
+        try:
+            value = self._handler(payload)
+        except Exception as e:
+            self._reply(request_id, "error", e)
+            return
+        if isinstance(value, Future):
+            self._reply(request_id, "pending", None)
+            value.add_done_callback(lambda future: self._reply(request_id, "result", future.result()) if future.exception() is None
+                                    else self._reply(request_id, "error", future.exception()))
+        else:
+            self._reply(request_id, "result", value)
+
+    def _reply(self, request_id, kind, value):
+        if request_id is None:
+            if kind == "error":
+                logger.error(f"Automation process request failed: {value}")
+            return
+        try:
+            self._send((kind, request_id, value))
+        except ConnectionError:
+            pass
+        except Exception as e:
+            # The value or exception cannot be pickled
+            self._send(("error", request_id, RuntimeError(f"Cannot send the result of the request: {e!r}")))
+
+    def close(self):
+        try:
+            self._conn.close()
+        except OSError:
+            pass
+        self._executor.shutdown(wait=False)
+
+
+class _RemoteCallback:
+    # Stands in for a worker's callback in the hub, calls it in the worker and waits up to timeout seconds for it to return.
+    # A callback that does not return in time fails with a TimeoutError, so a hung worker cannot hold a callback thread forever.
+    def __init__(self, channel, callback_id, name, timeout):
+        self._channel = channel
+        self._callback_id = callback_id
+        self._name = name
+        self._timeout = timeout
+
+    def __call__(self, *args):
+        if not self._channel.closed.is_set():
+            self._channel.call(("callback", self._callback_id, args), timeout=self._timeout)
+
+    def __repr__(self):
+        return self._name
+
+
+class AutomationHub:
+    '''
+    Serves the bot's ``ManifoldAPI``, ``ManifoldSubscriber``, ``MarketStateStore`` and ``EventBus`` to one automation running in its own worker process.
+
+    The automation calls them through proxies (see ``RemoteObject``): every public method works as in the bot's process, methods returning
+    a Future return a Future in the worker, callbacks passed to the subscriber are called in the worker, and event subscriptions stay in the hub
+    and are read through the proxy. The worker reads the database through its own ``ManifoldDatabaseReader``, whose stale-row refreshes go through the hub.
+
+    When the worker exits, its subscriber callbacks are removed and its event subscriptions are closed.
+
+    :param AutomationBot automation_bot: Required. The bot.
+    :param str name: Required. The name of the automation.
+    :param float callback_timeout: Optional. The number of seconds a subscriber callback may run in the worker before its call counts as failed. Default is 60.
+    '''
+    TARGETS = ("api", "subscriber", "market_state_store", "event_bus")
+    # Types of results that stay in the hub, the worker gets a handle to them
+    HANDLE_TYPES = (EventSubscription,)
+
+    def __init__(self, automation_bot, name, callback_timeout=60):
+        self.automation_bot = automation_bot
+        self.name = name
+        self.callback_timeout = callback_timeout
+        self.process = None
+        self._channel = None
+        self._targets = {
+            "api": automation_bot.manifold_api,
+            "subscriber": automation_bot.manifold_subscriber,
+            "market_state_store": automation_bot.market_state_store,
+            "event_bus": automation_bot.event_bus,
+        }
+        self._callbacks = {}
+        self._handles = {}
+        self._handle_ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def run(self, automation):
+        """
+        Starts the automation in a worker process and serves it until the process exits.
+
+        .. note::
+            This function is blocking.
+
+        :param Automation automation: Required. The automation, not registered with the bot. It is pickled into the worker process.
+        :return: The exit code of the worker process, 0 if the automation's ``start`` returned.
+        :rtype: int
+        """
+        # Spawned rather than forked, forking copies the bot's threads and locks in whatever state they are in
+        context = multiprocessing.get_context("spawn")
+        conn, worker_conn = context.Pipe()
+        self.process = context.Process(target=run_automation_process, name=f"MF_AUTOMATION_{self.name}", daemon=True,
+                                       args=(automation, worker_conn, self.automation_bot.manifold_db_path,
+                                             self.automation_bot.bet_partition_period, self.automation_bot.metrics_from_partitions))
+        self._channel = _Channel(conn, self._handle, name="MF_AUTOMATION_HUB")
+        self.process.start()
+        worker_conn.close()
+        logger.info(f"Automation {self.name} running in process {self.process.pid}")
+        try:
+            self.process.join()
+        finally:
+            # The worker's end is closed once it exited, which ends the receive thread
+            self._channel.closed.wait(5)
+            self._channel.close()
+            self._cleanup()
+        return self.process.exitcode
+
+    def stop(self, timeout=10):
+        """
+        Asks the automation to stop, and terminates its process if it is still running after ``timeout`` seconds.
+
+        :param float timeout: Optional. The number of seconds to wait. Default is 10.
+        """
+        if self.process is None or not self.process.is_alive():
+            return
+        try:
+            self._channel.notify(("stop",))
+        except ConnectionError:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            logger.warning(f"Automation {self.name} did not stop within {timeout}s, terminating its process")
+            self.process.terminate()
+
+    def _handle(self, payload):
+        if payload[0] == "release":
+            with self._lock:
+                handle = self._handles.pop(payload[1], None)
+            if isinstance(handle, EventSubscription):
+                handle.close()
+            return None
+        if payload[0] != "call":
+            raise ValueError(f"Unknown request {payload[0]}")
+
+        _, target, name, args, kwargs = payload
+        if isinstance(target, _HandleRef):
+            with self._lock:
+                obj = self._handles.get(target.handle_id)
+            if obj is None:
+                raise ValueError("The handle was released")
+        elif target in self.TARGETS:
+            obj = self._targets[target]
+        else:
+            raise ValueError(f"Unknown target {target}")
+        if name.startswith("_"):
+            raise AttributeError(f"{name} is not a public method")
+
+        args = [self._decode(arg) for arg in args]
+        kwargs = {key: self._decode(value) for key, value in kwargs.items()}
+        value = getattr(obj, name)(*args, **kwargs)
+        if isinstance(value, self.HANDLE_TYPES):
+            with self._lock:
+                handle_id = next(self._handle_ids)
+                self._handles[handle_id] = value
+            return _HandleRef(handle_id)
+        return value
+
+    def _decode(self, value):
+        if not isinstance(value, _CallbackRef):
+            return value
+        # The same callback always maps to the same stand-in, so it can be removed again
+        with self._lock:
+            callback = self._callbacks.get(value.callback_id)
+            if callback is None:
+                callback = self._callbacks[value.callback_id] = _RemoteCallback(self._channel, value.callback_id, f"{self.name}:{value.name}",
+                                                                              self.callback_timeout)
+        return callback
+
+    def _cleanup(self):
+        with self._lock:
+            callbacks = list(self._callbacks.values())
+            handles = list(self._handles.values())
+            self._callbacks.clear()
+            self._handles.clear()
+        subscriber = self._targets["subscriber"]
+        for callback in callbacks:
+            subscriber.remove_callbacks(callback)
+        for handle in handles:
+            if isinstance(handle, EventSubscription):
+                handle.close()
+
+
+class RemoteObject:
+    '''
+    Proxy of an object of the bot's process in an automation's worker process (see ``AutomationHub``). Only its methods can be used.
+    '''
+    def __init__(self, worker, target):
+        self._worker = worker
+        self._target = target
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def method(*args, **kwargs):
+            return self._worker._call(self._target, name, args, kwargs)
+        method.__name__ = name
+        return method
+
+    def release(self):
+        """
+        Forgets a handle (such as an event subscription) in the hub. Closes event subscriptions.
+        """
+        if isinstance(self._target, _HandleRef):
+            self._worker._channel.notify(("release", self._target.handle_id))
+
+    def __repr__(self):
+        return f"<RemoteObject({self._target})>"
+
+
+class _AutomationWorker:
+    # The worker process's end of the connection to the hub
+    def __init__(self, conn):
+        self.on_stop = None
+        self._callbacks = {}
+        self._callback_ids = {}
+        self._callback_id_counter = itertools.count()
+        self._lock = threading.Lock()
+        self._channel = _Channel(conn, self._handle, name="MF_AUTOMATION_WORKER")
+
+    def _call(self, target, name, args, kwargs):
+        args = [self._encode(arg) for arg in args]
+        kwargs = {key: self._encode(value) for key, value in kwargs.items()}
+        value = self._channel.call(("call", target, name, args, kwargs))
+        if isinstance(value, _HandleRef):
+            return RemoteObject(self, value)
+        return value
+
+    def _encode(self, value):
+        if not callable(value) or isinstance(value, type):
+            return value
+        with self._lock:
+            callback_id = self._callback_ids.get(value)
+            if callback_id is None:
+                callback_id = self._callback_ids[value] = next(self._callback_id_counter)
+                self._callbacks[callback_id] = value
+        return _CallbackRef(callback_id, getattr(value, "__qualname__", repr(value)))
+
+    def _handle(self, payload):
+        if payload[0] == "callback":
+            _, callback_id, args = payload
+            with self._lock:
+                callback = self._callbacks[callback_id]
+            callback(*args)
+            return None
+        if payload[0] == "stop":
+            if self.on_stop is not None:
+                self.on_stop()
+            return None
+        raise ValueError(f"Unknown request {payload[0]}")
+
+    def close(self):
+        self._channel.close()
+
+
+def run_automation_process(automation, conn, manifold_db_path, bet_partition_period=None, metrics_from_partitions=0):
+    """
+    Entry point of an automation's worker process (see ``AutomationHub``). Registers the automation with proxies of the hub's objects
+    and its own database reader, and runs it.
+    """
+    worker = _AutomationWorker(conn)
+    manifold_subscriber = RemoteObject(worker, "subscriber")
+    manifold_db = ManifoldDatabase(manifold_db_path, bet_partition_period=bet_partition_period, metrics_from_partitions=metrics_from_partitions)
+    automation_bot = SimpleNamespace(
+        manifold_api=RemoteObject(worker, "api"),
+        manifold_db_reader=ManifoldDatabaseReader(manifold_db, refresher=manifold_subscriber),
+        manifold_subscriber=manifold_subscriber,
+        market_state_store=RemoteObject(worker, "market_state_store"),
+        event_bus=RemoteObject(worker, "event_bus"),
+    )
+    automation._register(automation_bot)
+    worker.on_stop = automation.stop
+    try:
+        automation.start()
+    except Exception:
+        logger.error(f"Caught exception in automation process \n {traceback.format_exc()}")
+        sys.exit(1)
+    finally:
+        worker.close()
@@ -9,7 +9,12 @@ from autofold.api import ManifoldAPI
 from autofold.database import ManifoldDatabase
 from autofold.database import ManifoldDatabaseWriter
 from autofold.database import ManifoldDatabaseReader
+from autofold.database import ManifoldDatabaseMaintainer
+from autofold.database_service import ManifoldDatabaseWriterClient
+from autofold.market_state import MarketStateStore
+from autofold.event_bus import EventBus
 from autofold.subscriber import ManifoldSubscriber
+from autofold.automation_process import AutomationHub
 
 
 
@@ -22,6 +27,33 @@ class AutomationBot:
 
 	:param bool dev_api_endpoint: Optional. 
  		Whether to use the dev.manifold.markets endpoint. Useful for testing. Requires an API key for dev.manifold.markets. Default is False.
+
+	:param int query_cache_size: Optional.
+		The number of read query results cached by the ManifoldDatabaseReader. Default is 0 (no caching).
+
+	:param str writer_service_socket: Optional.
+		The Unix socket of a ManifoldDatabaseWriterService owning the database. When set, writes are sent to the service (which also runs the database maintenance)
+		so that several bots can share one database. Default is None (the bot writes to the database itself).
+
+	:param str bet_partition_period: Optional.
+		Store bets in one partition file per ``year`` or ``month`` (see ``ManifoldDatabase``). Default is None (no partitioning).
+
+	:param int metrics_from_partitions: Optional.
+		The number of hash partitions of contract_metrics_from (see ``ManifoldDatabase``). Default is 0 (no partitioning).
+
+	:param StreamSource stream_source: Optional.
+		A live data source feeding the subscriber (see ``autofold.streaming``). Polling takes over while it is disconnected. Default is None (polling only).
+
+	:param str subscription_owner: Optional.
+		An ID unique to this bot. When set, the subscriber saves the bot's subscriptions under it and resumes them on the next start (see ``ManifoldSubscriber``),
+		so bots sharing a database only resume their own. Default is None (subscriptions are not resumed).
+
+	:param str isolation: Optional.
+		How automations run: ``thread`` runs them in the bot's thread pool, and an exception in one stops the bot. ``process`` runs each automation
+		in its own worker process, which calls the bot's API, subscriber, market state store and event bus through an ``AutomationHub`` and reads
+		the database directly. CPU-heavy automations then run in parallel, and a crashing automation only ends its own process. Automations must be
+		picklable and importable by the worker process, so they should be defined in a module or behind ``if __name__ == "__main__"``.
+		Can be overridden per automation in ``register_automation``. Default is thread.
  
 	Attributes:
 	-----------
@@ -29,13 +61,27 @@ class AutomationBot:
 	- ``manifold_api``: The ManifoldAPI instance
 	- ``manifold_db``: The ManifoldDatabase instance
 	- ``manifold_db_reader``: The ManifoldDatabaseReader instance
-	- ``manifold_db_writer``: The ManifoldDatabaseWriter instance
+	- ``manifold_db_writer``: The ManifoldDatabaseWriter (or ManifoldDatabaseWriterClient) instance
+	- ``manifold_db_maintainer``: The ManifoldDatabaseMaintainer instance
+	- ``market_state_store``: The MarketStateStore instance holding the live state of subscribed markets
+	- ``event_bus``: The EventBus instance the subscriber publishes retrieved markets, bets, positions and users on
 	- ``manifold_subscriber``: The ManifoldSubscriber instance
+	- ``isolation``: How automations run by default, ``thread`` or ``process``
 	''' 
-	def __init__(self, manifold_db_path, dev_api_endpoint=False):
+	def __init__(self, manifold_db_path, dev_api_endpoint=False, query_cache_size=0, writer_service_socket=None,
+				 bet_partition_period=None, metrics_from_partitions=0, stream_source=None, subscription_owner=None, isolation="thread"):
+		if isolation not in ("thread", "process"):
+			raise ValueError(f"Unknown isolation {isolation}")
 
 		self.manifold_db_path = manifold_db_path
 		self.dev_api_endpoint = dev_api_endpoint
+		self.query_cache_size = query_cache_size
+		self.writer_service_socket = writer_service_socket
+		self.bet_partition_period = bet_partition_period
+		self.metrics_from_partitions = metrics_from_partitions
+		self.stream_source = stream_source
+		self.subscription_owner = subscription_owner
+		self.isolation = isolation
   
 		self._started = False
   
@@ -48,15 +94,19 @@ class AutomationBot:
 		self.manifold_db = None
 		self.manifold_db_reader = None
 		self.manifold_db_writer = None
+		self.manifold_db_maintainer = None
+		self.market_state_store = None
+		self.event_bus = None
 		self.manifold_subscriber = None
 
-	def register_automation(self, automation_obj, automation_name, run_on_bot_start=True):
+	def register_automation(self, automation_obj, automation_name, run_on_bot_start=True, isolation=None):
 		'''
 		Registers an automation with the bot.
 
 		:param Strategy automation_obj: Required. The automation class to register. Must be a subclass of the `Automation` class.
 		:param str automation_name: Required. The name of the automation.
 		:param bool run_on_bot_start: Optional. Whether the automation should be automatically run when the bot first starts. Default True.
+		:param str isolation: Optional. ``thread`` or ``process`` (see ``AutomationBot``). Default is the bot's isolation.
 		:raises TypeError: if the automation is not a class type.
 		:raises ValueError: if the automation is not a subclass of `Automation`.
 
@@ -72,13 +122,18 @@ class AutomationBot:
 		if not isinstance(automation_obj, Automation):
 			logger.error(f"{automation_obj} must be of a subclass of type Automation")
 			return
+		isolation = isolation or self.isolation
+		if isolation not in ("thread", "process"):
+			raise ValueError(f"Unknown isolation {isolation}")
 
 		self._automations.append({'object': automation_obj, 
 								  'name': automation_name,
 								  'registered': False,
 								  'shouldRun': run_on_bot_start,
 							   	  'running': False,
-             					  'finished': False})
+             					  'finished': False,
+								  'isolation': isolation,
+								  'hub': None})
 
   
  	
@@ -97,12 +152,24 @@ class AutomationBot:
 
 		self.manifold_api = ManifoldAPI(dev_mode=self.dev_api_endpoint)
 
-		self.manifold_db = ManifoldDatabase(self.manifold_db_path)
+		self.manifold_db = ManifoldDatabase(self.manifold_db_path, bet_partition_period=self.bet_partition_period,
+										   metrics_from_partitions=self.metrics_from_partitions)
 		self.manifold_db.create_tables()
-		self.manifold_db_reader = ManifoldDatabaseReader(self.manifold_db)
-		self.manifold_db_writer = ManifoldDatabaseWriter(self.manifold_db)
+		self.manifold_db_reader = ManifoldDatabaseReader(self.manifold_db, cache_size=self.query_cache_size)
+		if self.writer_service_socket:
+			self.manifold_db_writer = ManifoldDatabaseWriterClient(self.manifold_db, self.writer_service_socket)
+		else:
+			self.manifold_db_writer = ManifoldDatabaseWriter(self.manifold_db)
+			self.manifold_db_maintainer = ManifoldDatabaseMaintainer(self.manifold_db, self.manifold_db_writer)
 
-		self.manifold_subscriber = ManifoldSubscriber(self.manifold_api, self.manifold_db, self.manifold_db_writer)
+		self.market_state_store = MarketStateStore(self.manifold_db_reader)
+		self.event_bus = EventBus()
+		self.manifold_subscriber = ManifoldSubscriber(self.manifold_api, self.manifold_db, self.manifold_db_writer,
+													  market_state_store=self.market_state_store, event_bus=self.event_bus,
+													  stream_source=self.stream_source, resume_subscriptions=self.subscription_owner is not None,
+													  subscription_owner=self.subscription_owner or "default")
+		# Reads with a maximum staleness retrieve stale rows through the subscriber
+		self.manifold_db_reader.refresher = self.manifold_subscriber
 
 		self._executor = ThreadPoolExecutor(thread_name_prefix="BOT_AUTOMATION_POOL", max_workers=20) 
 
@@ -114,7 +181,9 @@ class AutomationBot:
 			for automation in self._automations:
 				if not automation['registered']:
 					logger.debug("Registering automation {automation}")
-					automation['object']._register(self)
+					# Process automations are registered in their worker process
+					if automation['isolation'] == "thread":
+						automation['object']._register(self)
 					automation['registered'] = True
 				if not automation['running'] and automation['shouldRun']:
 					automation['running'] = True
@@ -147,6 +216,16 @@ class AutomationBot:
 
 	def _run_automation(self, automation):
 		logger.debug(f"Running automation {automation['name']}")
+
+		if automation['isolation'] == "process":
+			# A crash only ends the automation's own process
+			automation['hub'] = AutomationHub(self, automation['name'])
+			exitcode = automation['hub'].run(automation['object'])
+			if exitcode:
+				logger.error(f"Automation {automation['name']} exited with code {exitcode}")
+			automation['running'] = False
+			automation['finished'] = True
+			return
 	 
 		try:
 			automation['object'].start()
@@ -170,7 +249,11 @@ class AutomationBot:
 			self.manifold_api.shutdown()
 
 		for automation in self._automations:
-			automation['object'].stop()
+			if automation['isolation'] == "process":
+				if automation['hub']:
+					automation['hub'].stop()
+			else:
+				automation['object'].stop()
   
 		if self._executor:
 			self._executor.shutdown(wait=False)
@@ -180,6 +263,8 @@ class AutomationBot:
 			self.manifold_subscriber.shutdown()
 
 		# Database 
+		if self.manifold_db_maintainer:
+			self.manifold_db_maintainer.shutdown()
 		if self.manifold_db_writer:
 			self.manifold_db_writer.shutdown()  
   
@@ -6,6 +6,12 @@ import sqlite3
 import threading
 import time
 import os
+import urllib.parse
+import shutil
+import sys
+import zlib
+from collections import OrderedDict, defaultdict, deque
+from operator import itemgetter
 
 from autofold.utils.str_utils import collapse_list_of_strings_to_string
 import concurrent.futures
@@ -20,15 +26,75 @@ def sanitize_value(value):
         # You can add more sanitation logic as needed
         return value
 
-def prepare_and_execute_multi_upsert(conn, query, fields, data):
-    query_fields = ", ".join(fields)
-    query_placeholders = ", ".join("?" for _ in fields)
+class RowEncoder:
+    '''
+    Turns records into the value tuples of an insert statement.
+
+    Plain fields are read with a single ``map(row.get, ...)`` per row and derived fields with the functions in ``sources``;
+    a precomputed ``operator.itemgetter`` then puts the values in insert order, so no dict is copied per row.
+
+    :param list[str] fields: Required. The columns, in insert order.
+    :param dict sources: Optional. Functions ``(row, context)`` computing a field instead of ``row.get('<field>')``.
+    :param function rows: Optional. Returns the ``(context, row)`` pairs to encode from the records, e.g. the parent record
+        of nested rows. Default is every record with a context of None.
+    :param tuple params: Optional. Fields taken from the keyword parameters passed to ``encode`` (e.g. ``retrievedTimestamp``).
+    '''
+    def __init__(self, fields, sources=None, rows=None, params=()):
+        self.fields = list(fields)
+        sources = sources or {}
+        self._rows = rows
+        self._plain = [field for field in self.fields if field not in sources and field not in params]
+        derived = [field for field in self.fields if field in sources]
+        self._sources = [sources[field] for field in derived]
+        self._params = [field for field in self.fields if field in params and field not in sources]
+
+        # Values are built as plain + derived + params, reorder them unless that already is the insert order
+        built = self._plain + derived + self._params
+        positions = [built.index(field) for field in self.fields]
+        self._order = itemgetter(*positions) if positions != sorted(positions) else None
+
+    def encode(self, records, **params):
+        """
+        Encodes ``records`` into a list of value tuples.
+        """
+        plain, sources, order = self._plain, self._sources, self._order
+        constants = tuple(params[field] for field in self._params)
+        rows = self._rows(records) if self._rows is not None else ((None, record) for record in records)
+
+        encoded = []
+        for context, row in rows:
+            values = (*map(row.get, plain), *[source(row, context) for source in sources], *constants) if plain \
+                else (*[source(row, context) for source in sources], *constants)
+            if order is not None:
+                values = order(values)
+            # sanitize_value, inlined to save a function call per value
+            encoded.append(tuple([round(value, 4) if value.__class__ is float
+                                  else value if value.__class__ is not int or -9223372036854775808 <= value <= 9223372036854775807
+                                  else sanitize_value(value) for value in values]))
+        return encoded
+
+def prepare_and_execute_multi_upsert(conn, query, fields=None, data=None, encoder=None, **params):
+    if encoder is None:
+        encoder = RowEncoder(fields)
+    query_fields = ", ".join(encoder.fields)
+    query_placeholders = ", ".join("?" for _ in encoder.fields)
     sql_query = query.format(fields=query_fields, placeholders=query_placeholders)
-    values_tuple = [tuple(sanitize_value(data.get(field, None)) for field in fields) for data in data]
-    conn.executemany(sql_query, values_tuple)
+    conn.executemany(sql_query, encoder.encode(data, **params))
+
+def writes_tables(*tables):
+    """
+    Declares the tables a ManifoldDatabase write function modifies, so that ``ManifoldDatabaseWriter`` only
+    invalidates cached query results of those tables. Write functions without the declaration invalidate everything.
+    """
+    def decorator(function):
+        function.tables = frozenset(tables)
+        return function
+    return decorator
 
 # Helper function for multiple deletions
 def prepare_and_execute_multi_deletion(conn, query, ids):
+    if not ids:
+        return
     # Check if the first item in ids is a tuple
     if isinstance(ids[0], tuple):
         values_tuple = ids
@@ -38,6 +104,226 @@ def prepare_and_execute_multi_deletion(conn, query, ids):
     conn.executemany(query, values_tuple)
     
 
+# Row encoders of the upsert functions, built once rather than on every upsert
+USER_FIELDS = [
+    "id", "createdTime", "name", "username",
+    "url", "bio", "streakForgiveness", "referredByUserId",
+    "lastBetTime", "referredByContractId", "currentBettingStreak", "userDeleted",
+    "marketsCreatedThisWeek", "balance", "totalDeposits",
+    "nextLoanCached", "twitterHandle", "followerCountCached",
+    "metricsLastUpdated", "hasSeenContractFollowModal",
+    "fractionResolvedCorrectly", "isBot",
+    "isAdmin", "isTrustworthy", "isBannedFromPosting", "retrievedTimestamp"
+]
+USER_ENCODER = RowEncoder(USER_FIELDS, params=("retrievedTimestamp",))
+USER_PROFIT_CACHED_ENCODER = RowEncoder(
+    ["userId", "daily", "weekly", "monthly", "allTime"],
+    sources={"userId": lambda row, user: user["id"]},
+    rows=lambda users: ((user, user["profitCached"]) for user in users if user.get("profitCached") is not None))
+USER_CREATOR_TRADERS_ENCODER = RowEncoder(
+    ["userId", "daily", "weekly", "monthly", "allTime"],
+    sources={"userId": lambda row, user: user["id"]},
+    rows=lambda users: ((user, user["creatorTraders"]) for user in users if user.get("creatorTraders") is not None))
+
+BINARY_CHOICE_MARKET_FIELDS = [
+    "id", "closeTime", "createdTime", "creatorId", "creatorName",
+    "creatorUsername", "isResolved", "lastUpdatedTime", "mechanism",
+    "outcomeType", "p", "probability", "question", "textDescription",
+    "totalLiquidity", "volume", "volume24Hours", "url", "pool_NO",
+    "pool_YES", "groupSlugs", "retrievedTimestamp", "lite"
+]
+BINARY_CHOICE_MARKET_ENCODER = RowEncoder(
+    BINARY_CHOICE_MARKET_FIELDS,
+    sources={
+        "lite": lambda row, _: int(row.get("lite", 0)),
+        "groupSlugs": lambda row, _: collapse_list_of_strings_to_string(row.get("groupSlugs", "")),
+        "pool_NO": lambda row, _: row.get("pool", {}).get("NO"),
+        "pool_YES": lambda row, _: row.get("pool", {}).get("YES"),
+    },
+    params=("retrievedTimestamp",))
+
+MULTIPLE_CHOICE_MARKET_FIELDS = [
+    "id", "closeTime", "createdTime", "creatorId", "creatorName",
+    "creatorUsername", "isResolved", "lastUpdatedTime", "mechanism",
+    "outcomeType", "question", "textDescription", "totalLiquidity",
+    "volume", "volume24Hours", "url", "groupSlugs", "retrievedTimestamp", "lite"
+]
+MULTIPLE_CHOICE_MARKET_ENCODER = RowEncoder(
+    MULTIPLE_CHOICE_MARKET_FIELDS,
+    sources={
+        "lite": lambda row, _: int(row.get("lite", 0)),
+        "groupSlugs": lambda row, _: collapse_list_of_strings_to_string(row.get("groupSlugs", "")),
+    },
+    params=("retrievedTimestamp",))
+ANSWER_FIELDS = [
+    "contractId", "createdTime", "fsUpdatedTime", "isOther", "answerIndex",
+    "probability", "subsidyPool", "text", "totalLiquidity", "userId",
+    "pool_NO", "pool_YES"
+]
+ANSWER_ENCODER = RowEncoder(
+    ANSWER_FIELDS,
+    sources={
+        "pool_NO": lambda row, _: row.get("pool", {}).get("NO"),
+        "pool_YES": lambda row, _: row.get("pool", {}).get("YES"),
+    },
+    rows=lambda markets: ((market, answer) for market in markets for answer in market.get("answers", [])))
+
+CONTRACT_METRIC_FIELDS = [
+    "contractId", "hasNoShares", "hasShares", "hasYesShares",
+    "invested", "loan", "maxSharesOutcome", "payout",
+    "profit", "profitPercent", "userId", "userUsername",
+    "userName", "lastBetTime", "retrievedTimestamp"
+]
+CONTRACT_METRIC_ENCODER = RowEncoder(CONTRACT_METRIC_FIELDS, params=("retrievedTimestamp",))
+CONTRACT_METRIC_FROM_FIELDS = ["contractId", "userId", "period", "value", "profit", "invested", "prevValue", "profitPercent"]
+CONTRACT_METRIC_FROM_ENCODER = RowEncoder(
+    CONTRACT_METRIC_FROM_FIELDS,
+    sources={
+        "contractId": lambda row, context: context[0].get("contractId"),
+        "userId": lambda row, context: context[0].get("userId"),
+        "period": lambda row, context: context[1],
+        "profitPercent": lambda row, context: min(row.get("profitPercent") or 0, 1_000_000),
+    },
+    rows=lambda metrics: (((metric, period), from_vals) for metric in metrics for period, from_vals in metric.get("from", {}).items()))
+CONTRACT_METRIC_TOTAL_SHARES_FIELDS = ["contractId", "userId", "outcome", "numberOfShares"]
+CONTRACT_METRIC_TOTAL_SHARES_ENCODER = RowEncoder(
+    CONTRACT_METRIC_TOTAL_SHARES_FIELDS,
+    sources={
+        "contractId": lambda row, metric: metric.get("contractId"),
+        "userId": lambda row, metric: metric.get("userId"),
+        "outcome": lambda row, metric: row[0],
+        "numberOfShares": lambda row, metric: row[1],
+    },
+    rows=lambda metrics: ((metric, shares) for metric in metrics for shares in metric.get("totalShares", {}).items()))
+
+BET_FIELDS = [
+    "id", "userId", "contractId", "isFilled", "amount", "probBefore",
+    "isCancelled", "outcome", "shares", "limitProb", "loanAmount",
+    "orderAmount", "probAfter", "createdTime", "retrievedTimestamp"
+]
+BET_ENCODER = RowEncoder(BET_FIELDS, params=("retrievedTimestamp",))
+BET_FEE_FIELDS = ["betId", "creatorFee", "liquidityFee", "platformFee"]
+BET_FEE_ENCODER = RowEncoder(
+    BET_FEE_FIELDS,
+    sources={"betId": lambda row, bet: bet["id"]},
+    rows=lambda bets: ((bet, bet["fees"]) for bet in bets if bet.get("fees") is not None))
+BET_FILL_FIELDS = ["betId", "timestamp", "matchedBetId", "amount", "shares"]
+BET_FILL_ENCODER = RowEncoder(
+    BET_FILL_FIELDS,
+    sources={"betId": lambda row, bet: bet["id"]},
+    rows=lambda bets: ((bet, fill) for bet in bets for fill in bet.get("fills", [])))
+
+
+class StatementRecordingError(Exception):
+    """
+    Raised when a write function reads from the database while its statements are being recorded.
+    """
+
+
+class _StatementRecorder:
+    # Stands in for the sqlite3 connection of a write function being recorded
+    in_transaction = False
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, sql, parameters=()):
+        self.statements.append(("execute", sql, parameters))
+        return self
+
+    def executemany(self, sql, parameters):
+        self.statements.append(("executemany", sql, list(parameters)))
+        return self
+
+    def commit(self):
+        self.statements.append(("commit", None, None))
+
+    def attach_partitions(self, partitions):
+        self.statements.append(("attach", None, partitions))
+
+    def rollback(self):
+        self.statements.append(("rollback", None, None))
+
+    def __getattr__(self, name):
+        raise StatementRecordingError(f"Cannot record a write function using connection.{name}")
+
+
+class ChangeEvent:
+    '''
+    The rows of a table that changed between two polls of a subscription.
+
+    - ``inserted``, ``updated`` and ``deleted``: The keys of the changed rows. Keys are the row ``id``,
+      or a ``(contractId, userId)`` tuple for contract metrics.
+    - ``old`` and ``new``: The tracked field values of each changed key before and after the change
+      (``old`` has no inserted keys, ``new`` has no deleted keys).
+
+    :param str table: Required. The table the rows belong to.
+    '''
+    def __init__(self, table, inserted=None, updated=None, deleted=None, old=None, new=None):
+        self.table = table
+        self.inserted = inserted if inserted is not None else []
+        self.updated = updated if updated is not None else []
+        self.deleted = deleted if deleted is not None else []
+        self.old = old if old is not None else {}
+        self.new = new if new is not None else {}
+
+    def __bool__(self):
+        return bool(self.inserted or self.updated or self.deleted)
+
+    def __repr__(self):
+        return f"<ChangeEvent(table={self.table}, inserted={len(self.inserted)}, updated={len(self.updated)}, deleted={len(self.deleted)})>"
+
+    def select(self, fields, keys=None):
+        """
+        Returns the changes of a subset of the tracked fields. Updates that changed none of them are left out.
+
+        :param list[str] fields: Required. The fields.
+        :param set keys: Optional. Only keep the changes of these keys. Default is None (all keys).
+        :rtype: ChangeEvent
+        """
+        def project(values):
+            return {field: values.get(field) for field in fields}
+        inserted = [key for key in self.inserted if keys is None or key in keys]
+        deleted = [key for key in self.deleted if keys is None or key in keys]
+        updated = [key for key in self.updated if (keys is None or key in keys) and project(self.old[key]) != project(self.new[key])]
+        return ChangeEvent(self.table, inserted, updated, deleted,
+                           old={key: project(self.old[key]) for key in updated + deleted},
+                           new={key: project(self.new[key]) for key in inserted + updated})
+
+    def merge(self, later):
+        """
+        Combines this event with a later event of the same table into one event spanning both.
+
+        :param ChangeEvent later: Required. The later event.
+        :rtype: ChangeEvent
+        """
+        # Net effect per key: the value before the first change and after the last one
+        before = {key: self.old.get(key) for key in self.updated + self.deleted}
+        before.update({key: None for key in self.inserted})
+        after = {key: self.new.get(key) for key in self.inserted + self.updated}
+        after.update({key: None for key in self.deleted})
+        for key in later.inserted + later.updated + later.deleted:
+            if key not in before:
+                before[key] = later.old.get(key)
+            after[key] = later.new.get(key)
+
+        merged = ChangeEvent(self.table)
+        for key in before:
+            if before[key] is None and after[key] is None:
+                continue
+            if before[key] is None:
+                merged.inserted.append(key)
+            elif after[key] is None:
+                merged.deleted.append(key)
+            elif before[key] != after[key]:
+                merged.updated.append(key)
+            else:
+                continue
+            if before[key] is not None:
+                merged.old[key] = before[key]
+            if after[key] is not None:
+                merged.new[key] = after[key]
+        return merged
 
 
 class ManifoldDatabase:
@@ -54,10 +340,17 @@ class ManifoldDatabase:
     - ``local_storage``: Thread-local storage for SQLite3 connections
     
     :param str db_path: Reqauired. The path to the SQLite3 database file. Should be a .db file.
+    :param str bet_partition_period: Optional. Store bets (with their fees and fills) in one partition file per ``year`` or ``month`` of their createdTime. Default is None (no partitioning).
+    :param int metrics_from_partitions: Optional. Spread contract_metrics_from over this many partition files by a hash of the contractId. Default is 0 (no partitioning).
     :raises OSError: If the specified directory cannot be created. 
     ''' 
-    def __init__(self, db_path):
+    def __init__(self, db_path, bet_partition_period=None, metrics_from_partitions=0):
+        if bet_partition_period not in (None, "year", "month"):
+            raise ValueError(f"Unknown bet partition period {bet_partition_period}")
         self.db_path = db_path
+        self.bet_partition_period = bet_partition_period
+        self.metrics_from_partitions = metrics_from_partitions
+        self.partition_dir = os.path.abspath(os.path.splitext(db_path)[0] + ".partitions")
 
         # Ensure the directory exists
         dir_name = os.path.dirname(self.db_path)
@@ -66,15 +359,93 @@ class ManifoldDatabase:
 
         self.local_storage = threading.local()
 
+        self._change_listeners = []
+
+    def add_change_listener(self, listener):
+        """
+        Registers a function called with the set of modified table names (or None for "any table") after every write committed through the ``ManifoldDatabaseWriter``.
+
+        :param function listener: Required. The function to call.
+        """
+        self._change_listeners.append(listener)
+
+    def notify_tables_changed(self, tables):
+        """
+        Notifies the change listeners that ``tables`` were modified.
+
+        :param tables: Required. The modified table names, or None if they are unknown.
+        """
+        for listener in self._change_listeners:
+            listener(tables)
+
     def get_conn(self):
+        recorder = getattr(self.local_storage, "recorder", None)
+        if recorder is not None:
+            return recorder
         if not hasattr(self.local_storage, "conn"):
             self.local_storage.conn = sqlite3.connect(self.db_path)
+            # Must come before journal_mode=WAL, which writes the header of a new database.
+            # Lets the maintainer reclaim free pages with PRAGMA incremental_vacuum.
+            self.local_storage.conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
             self.local_storage.conn.execute("PRAGMA journal_mode=WAL;")
+            # INSERT OR REPLACE fires the delete triggers of the replaced rows, keeping the aggregate tables exact
+            self.local_storage.conn.execute("PRAGMA recursive_triggers = ON;")
         return self.local_storage.conn
 
+    def record_statements(self, function, data):
+        """
+        Runs the write function ``function`` (a method of this instance) on ``data`` without touching the database and returns
+        the statements it executes, so that the rows can be encoded in one process and written by another (see ``execute_statements``).
+
+        :param function: Required. The write function, e.g. ``manifold_db.upsert_bets``.
+        :param data: Required. The data to write.
+        :raises StatementRecordingError: If the function reads from the database and cannot be recorded.
+        :return: A list of ``(method, sql, parameters)`` tuples.
+        :rtype: list[tuple]
+        """
+        recorder = _StatementRecorder()
+        self.local_storage.recorder = recorder
+        try:
+            function(data)
+        finally:
+            del self.local_storage.recorder
+        return recorder.statements
+
+    def execute_statements(self, statements):
+        """
+        Replays statements returned by ``record_statements`` on this thread's connection.
+
+        :param list[tuple] statements: Required. The recorded statements.
+        """
+        conn = self.get_conn()
+        try:
+            for method, sql, parameters in statements:
+                if method == "execute":
+                    conn.execute(sql, parameters)
+                elif method == "executemany":
+                    conn.executemany(sql, parameters)
+                elif method == "commit":
+                    conn.commit()
+                elif method == "rollback":
+                    conn.rollback()
+                elif method == "attach":
+                    self._attach_partitions(conn, parameters)
+        except sqlite3.Error as e:
+            logger.error(f"Database error in execute_statements: {e}")
+            if conn.in_transaction:
+                conn.rollback()
+
     def create_tables(self):
         conn = self.get_conn()
         logger.debug("Creating tables") 
+
+        # Databases created without incremental auto_vacuum are converted once, which rewrites the whole file
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        if cursor.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+            logger.info("Converting the database to incremental auto_vacuum, this runs VACUUM once")
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            conn.execute("VACUUM;")
         '''
         ########################################################
         ####                    USERS                       ####
@@ -217,6 +588,23 @@ class ManifoldDatabase:
         ); 
         """)
 
+        # Full-text search index over market questions and descriptions (both market tables).
+        # markets_fts_docs maps a market id to its stable rowid in markets_fts.
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS markets_fts_docs (
+            docId INTEGER PRIMARY KEY,
+            id TEXT UNIQUE
+        );
+        """)
+
+        conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS markets_fts USING fts5(
+            question,
+            textDescription,
+            tokenize = 'porter unicode61'
+        );
+        """)
+
         '''
         ########################################################
         ####                 CONTRACT METRICS               ####
@@ -322,7 +710,96 @@ class ManifoldDatabase:
         );
         """)
 
+        # Indexes used by the nested table deletions and by retention pruning
+        conn.execute("CREATE INDEX IF NOT EXISTS bets_createdTime ON bets (createdTime);")
+        conn.execute("CREATE INDEX IF NOT EXISTS bet_fees_betId ON bet_fees (betId);")
+        conn.execute("CREATE INDEX IF NOT EXISTS bet_fills_betId ON bet_fills (betId);")
+        conn.execute("CREATE INDEX IF NOT EXISTS contract_metrics_from_contractId_userId ON contract_metrics_from (contractId, userId);")
+        conn.execute("CREATE INDEX IF NOT EXISTS contract_metrics_totalShares_contractId_userId ON contract_metrics_totalShares (contractId, userId);")
+
+        '''
+        ########################################################
+        ####                 SUBSCRIPTIONS                  ####
+        ########################################################
+        '''
+        # Interval jobs of the ManifoldSubscriber, restored on startup. Tables saved before subscriptions had an owner
+        # are dropped, they only hold sync state that the next polls rebuild.
+        if "owner" not in {row[1] for row in conn.execute("PRAGMA table_info(subscriptions);").fetchall()}:
+            conn.execute("DROP TABLE IF EXISTS subscriptions;")
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            owner TEXT,
+            function TEXT,
+            params TEXT,
+            polling_time REAL,
+            max_polling_time REAL,
+            last_execution_time REAL,
+            cursor TEXT,
+            full_sync_time REAL,
+            PRIMARY KEY (owner, function, params)
+        );
+        """)
+
+        '''
+        ########################################################
+        ####                  AGGREGATES                    ####
+        ########################################################
+        '''
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        aggregates_exist = cursor.execute("SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE name = 'market_trader_counts')").fetchone()[0]
+
+        # Number of bets of each trader of a market
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS market_traders (
+            contractId TEXT,
+            userId TEXT,
+            bets INTEGER,
+            PRIMARY KEY (contractId, userId)
+        );
+        """)
+
+        # Number of unique traders of a market
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS market_trader_counts (
+            contractId TEXT PRIMARY KEY,
+            traders INTEGER
+        );
+        """)
+
+        # Bet volume of a market per hour (hour = createdTime // 3600000)
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS market_volume_hourly (
+            contractId TEXT,
+            hour INTEGER,
+            volume REAL,
+            bets INTEGER,
+            PRIMARY KEY (contractId, hour)
+        );
+        """)
+
+        # YES and NO shares of a user in a binary market
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_contract_shares (
+            contractId TEXT,
+            userId TEXT,
+            yesShares REAL,
+            noShares REAL,
+            PRIMARY KEY (contractId, userId)
+        );
+        """)
+
+        self._create_aggregate_triggers(conn)
+
         conn.commit()
+
+        # Backfill the aggregates for databases created before they existed
+        if not aggregates_exist:
+            self.rebuild_aggregates()
+
+        # Backfill the search index for databases created before it existed
+        if cursor.execute("SELECT NOT EXISTS (SELECT 1 FROM markets_fts_docs)").fetchone()[0]:
+            self.rebuild_market_search_index()
         
     '''
     ########################################################
@@ -330,6 +807,7 @@ class ManifoldDatabase:
     ########################################################
     '''
 
+    @writes_tables("users", "users_profit_cached", "users_creator_traders")
     def upsert_users(self, users: list[dict]):
         # Get database connection
         conn = self.get_conn()
@@ -343,24 +821,14 @@ class ManifoldDatabase:
         conn.execute("BEGIN TRANSACTION;")
 
         try:
-            # Base table fields
-            base_fields = [
-                "id", "createdTime", "name", "username",
-                "url", "bio", "streakForgiveness", "referredByUserId",
-                "lastBetTime", "referredByContractId", "currentBettingStreak", "userDeleted",
-                "marketsCreatedThisWeek", "balance", "totalDeposits",
-                "nextLoanCached", "twitterHandle", "followerCountCached",
-                "metricsLastUpdated", "hasSeenContractFollowModal",
-                "fractionResolvedCorrectly", "isBot",
-                "isAdmin", "isTrustworthy", "isBannedFromPosting", "retrievedTimestamp"
-            ]
 
             # Insert or Replace into the base table
             prepare_and_execute_multi_upsert(
                 conn=conn,
                 query="INSERT OR REPLACE INTO users ({fields}) VALUES ({placeholders})",
-                fields=base_fields,
-                data=[{**user, "retrievedTimestamp": current_time} for user in users],
+                encoder=USER_ENCODER,
+                data=users,
+                retrievedTimestamp=current_time,
             )
 
             # Delete entries for nested table 'profitCached'
@@ -374,8 +842,8 @@ class ManifoldDatabase:
             prepare_and_execute_multi_upsert(
                 conn=conn,
                 query="INSERT OR REPLACE INTO users_profit_cached (userId, daily, weekly, monthly, allTime) VALUES (?, ?, ?, ?, ?)",
-                fields=["userId", "daily", "weekly", "monthly", "allTime"],
-                data=[{**user["profitCached"], "userId": user["id"]} for user in users if "profitCached" in user]
+                encoder=USER_PROFIT_CACHED_ENCODER,
+                data=users
             )
             # Delete entries for nested table 'creatorTraders'
             prepare_and_execute_multi_deletion(
@@ -388,8 +856,8 @@ class ManifoldDatabase:
             prepare_and_execute_multi_upsert(
                 conn=conn,
                 query="INSERT OR REPLACE INTO users_creator_traders (userId, daily, weekly, monthly, allTime) VALUES (?, ?, ?, ?, ?)",
-                fields=["userId", "daily", "weekly", "monthly", "allTime"],
-                data=[{**user["creatorTraders"], "userId": user["id"]} for user in users if "creatorTraders" in user]
+                encoder=USER_CREATOR_TRADERS_ENCODER,
+                data=users
             )
 
             # Commit transaction
@@ -410,6 +878,7 @@ class ManifoldDatabase:
     '''
 
     # Upsert Market
+    @writes_tables("binary_choice_markets", "markets_fts", "markets_fts_docs")
     def upsert_binary_choice_markets(self, markets: list[dict]):
         # Get database connection
         conn = self.get_conn()
@@ -423,29 +892,17 @@ class ManifoldDatabase:
         conn.execute("BEGIN TRANSACTION;")
         
         try:
-            # Base table fields
-            base_fields = [
-                "id", "closeTime", "createdTime", "creatorId", "creatorName", 
-                "creatorUsername", "isResolved", "lastUpdatedTime", "mechanism", 
-                "outcomeType", "p", "probability", "question", "textDescription", 
-                "totalLiquidity", "volume", "volume24Hours", "url", "pool_NO",
-                "pool_YES", "groupSlugs", "retrievedTimestamp", "lite"
-            ]
-            
             # Insert or Replace into the base table
             prepare_and_execute_multi_upsert(
                 conn=conn,
                 query="INSERT OR REPLACE INTO binary_choice_markets ({fields}) VALUES ({placeholders})",
-                fields=base_fields,
-                data=[
-                    {**market, 
-                    "retrievedTimestamp": current_time,
-                    "lite": int(market.get("lite", 0)),
-                    "groupSlugs": collapse_list_of_strings_to_string(market.get("groupSlugs", "")),
-                    "pool_NO": market.get("pool", {}).get("NO", None),
-                    "pool_YES": market.get("pool", {}).get("YES", None)
-                    } for market in markets],
+                encoder=BINARY_CHOICE_MARKET_ENCODER,
+                data=markets,
+                retrievedTimestamp=current_time,
             )
+
+            # Keep the search index in sync
+            self._sync_market_search_index(conn, markets)
             
             # Commit transaction
             conn.commit()
@@ -457,6 +914,7 @@ class ManifoldDatabase:
         logger.debug("Upsert binary choice markets successful")
 
 
+    @writes_tables("multiple_choice_markets", "multiple_choice_market_answers", "markets_fts", "markets_fts_docs")
     def upsert_multiple_choice_markets(self, markets: list[dict]):
         # Get database connection
         conn = self.get_conn()
@@ -470,28 +928,17 @@ class ManifoldDatabase:
         conn.execute("BEGIN TRANSACTION;")
         
         try:
-            # Base table fields
-            base_fields = [
-                "id", "createdTime", "name", "username",
-                "url", "bio", "streakForgiveness", "referredByUserId",
-                "lastBetTime", "referredByContractId", "currentBettingStreak", "userDeleted",
-                "marketsCreatedThisWeek", "balance", "totalDeposits", "nextLoanCached",
-                "twitterHandle", "followerCountCached", "metricsLastUpdated", "hasSeenContractFollowModal",
-                "fractionResolvedCorrectly", "isBot", "isAdmin", "isTrustworthy", "isBannedFromPosting"
-            ]
-
             # Insert or Replace into the base table
             prepare_and_execute_multi_upsert(
                 conn=conn,
                 query="INSERT OR REPLACE INTO multiple_choice_markets ({fields}) VALUES ({placeholders})",
-                fields=base_fields,
-                data=[
-                    {**market, 
-                     "retrievedTimestamp": current_time,
-                     "lite": int(market.get("lite", 0)),
-                     "groupSlugs": collapse_list_of_strings_to_string(market.get("groupSlugs", ""))
-                    } for market in markets],
+                encoder=MULTIPLE_CHOICE_MARKET_ENCODER,
+                data=markets,
+                retrievedTimestamp=current_time,
             )
+
+            # Keep the search index in sync
+            self._sync_market_search_index(conn, markets)
             
             # Handle nested tables (answers)
             lite = any([market.get("lite", 0) for market in markets])
@@ -504,21 +951,11 @@ class ManifoldDatabase:
                     ids=[market["id"] for market in markets]
                 )
                 
-                answer_fields = [
-                    "contractId", "createdTime", "fsUpdatedTime", "isOther", "answerIndex", 
-                    "probability", "subsidyPool", "text", "totalLiquidity", "userId", 
-                    "pool_NO", "pool_YES"
-                ]
-                
                 prepare_and_execute_multi_upsert(
                     conn=conn,
                     query="INSERT OR REPLACE INTO multiple_choice_market_answers ({fields}) VALUES ({placeholders})",
-                    fields=answer_fields,
-                    data=[
-                        {**answer,
-                         "pool_NO": answer.get("pool", {}).get("NO", None),
-                         "pool_YES": answer.get("pool", {}).get("YES", None)
-                         } for market in markets for answer in market.get("answers", [])]
+                    encoder=ANSWER_ENCODER,
+                    data=markets
                 )
             
             # Commit transaction
@@ -534,11 +971,48 @@ class ManifoldDatabase:
 
         
 
+    def _sync_market_search_index(self, conn, markets):
+        """
+        Re-indexes the given markets in markets_fts. Must be called inside the upsert transaction.
+        """
+        ids = [(market["id"],) for market in markets]
+        conn.executemany("INSERT OR IGNORE INTO markets_fts_docs (id) VALUES (?)", ids)
+        conn.executemany("DELETE FROM markets_fts WHERE rowid = (SELECT docId FROM markets_fts_docs WHERE id = ?)", ids)
+        conn.executemany(
+            "INSERT INTO markets_fts (rowid, question, textDescription) SELECT docId, ?, ? FROM markets_fts_docs WHERE id = ?",
+            [(market.get("question"), market.get("textDescription"), market["id"]) for market in markets]
+        )
+
+    @writes_tables("markets_fts", "markets_fts_docs")
+    def rebuild_market_search_index(self):
+        """
+        Rebuilds the market full-text search index from the binary and multiple choice market tables.
+        """
+        conn = self.get_conn()
+
+        logger.debug("Rebuilding market search index")
+
+        conn.execute("BEGIN TRANSACTION;")
+        try:
+            conn.execute("DELETE FROM markets_fts;")
+            conn.execute("DELETE FROM markets_fts_docs;")
+            for table in ("binary_choice_markets", "multiple_choice_markets"):
+                conn.execute(f"INSERT INTO markets_fts_docs (id) SELECT id FROM {table};")
+                conn.execute(f"""
+                    INSERT INTO markets_fts (rowid, question, textDescription)
+                    SELECT d.docId, m.question, m.textDescription FROM {table} m JOIN markets_fts_docs d ON d.id = m.id;
+                """)
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Database error in rebuild_market_search_index: {e}")
+            conn.rollback()
+
     '''
     ########################################################
     ####                 CONTRACT METRICS               ####
     ########################################################
     '''
+    @writes_tables("contract_metrics", "contract_metrics_from", "contract_metrics_totalShares", "user_contract_shares")
     def upsert_contract_metrics(self, contract_metrics: list[dict]):
         # Get database connection
         conn = self.get_conn()
@@ -548,49 +1022,50 @@ class ManifoldDatabase:
         # Current UNIX epoch time for all contract_metrics in this batch
         current_time = int(time.time())
         
+        # Route the 'from' entries to their partitions (attached before the transaction begins)
+        partitions = self._route_to_partitions(conn, "contract_metrics_from", contract_metrics, lambda metric: self._metrics_from_partition_key(metric.get("contractId")))
+
         # Begin transaction for better performance and data integrity
         conn.execute("BEGIN TRANSACTION;")
 
         try:
 
             # Base table
-            base_fields = [
-                "contractId", "hasNoShares", "hasShares", "hasYesShares",
-                "invested", "loan", "maxSharesOutcome", "payout", 
-                "profit", "profitPercent", "userId", "userUsername", 
-                "userName", "lastBetTime", "retrievedTimestamp"
-            ]
             prepare_and_execute_multi_upsert(
                 conn=conn,
                 query="INSERT OR REPLACE INTO contract_metrics ({fields}) VALUES ({placeholders})",
-                fields=base_fields,
-                data=[
-                    {**metric, "retrievedTimestamp": current_time} for metric in contract_metrics]
+                encoder=CONTRACT_METRIC_ENCODER,
+                data=contract_metrics,
+                retrievedTimestamp=current_time,
             )
 
             
             # Handle nested tables (from and totalShares)
-            # Delete entries
-            prepare_and_execute_multi_deletion(
-                conn=conn,
-                query="DELETE FROM contract_metrics_from WHERE contractId = ? AND userId = ?",
-                ids=[(contract_metric["contractId"], contract_metric["userId"]) for contract_metric in contract_metrics]
-            )
-            
-            from_fields = ["contractId", "userId", "period", "value", "profit", "invested", "prevValue", "profitPercent"]
-            
-            # Clean data (some 'from' entries report profit percents of over a trillion, because of buggy invested value tracking. Set anything over 1,000,000% to -1)
-            prepare_and_execute_multi_upsert(
-                conn=conn,
-                query="INSERT OR REPLACE INTO contract_metrics_from ({fields}) VALUES ({placeholders})",
-                fields=from_fields,
-                data=[
-                    {**from_vals,
-                        "profitPercent": 1_000_000 if contract_metric.get("profitPercent", 0) > 1_000_000 else contract_metric.get("profitPercent", 0),
-                        "contractId": contract_metric.get("contractId", None),
-                        "userId": contract_metric.get("userId", None), 
-                        "period": period} for contract_metric in contract_metrics for period, from_vals in contract_metric.get("from", {}).items()]
-            )
+            for schema, partition_metrics in partitions.items():
+                metric_ids = [(contract_metric["contractId"], contract_metric["userId"]) for contract_metric in partition_metrics]
+
+                # Entries written before partitioning was enabled are moved out of the main database
+                if schema != "main":
+                    prepare_and_execute_multi_deletion(
+                        conn=conn,
+                        query="DELETE FROM main.contract_metrics_from WHERE contractId = ? AND userId = ?",
+                        ids=metric_ids
+                    )
+
+                # Delete entries
+                prepare_and_execute_multi_deletion(
+                    conn=conn,
+                    query=f"DELETE FROM {schema}.contract_metrics_from WHERE contractId = ? AND userId = ?",
+                    ids=metric_ids
+                )
+                
+                # Clean data (some 'from' entries report profit percents of over a trillion, because of buggy invested value tracking. Cap each entry's own value at 1,000,000%)
+                prepare_and_execute_multi_upsert(
+                    conn=conn,
+                    query=f"INSERT OR REPLACE INTO {schema}.contract_metrics_from ({{fields}}) VALUES ({{placeholders}})",
+                    encoder=CONTRACT_METRIC_FROM_ENCODER,
+                    data=partition_metrics
+                )
 
             # Delete entries
             prepare_and_execute_multi_deletion(
@@ -599,18 +1074,11 @@ class ManifoldDatabase:
                 ids=[(contract_metric["contractId"], contract_metric["userId"]) for contract_metric in contract_metrics]
             )
             
-            total_shares_fields = ["contractId", "userId", "outcome", "numberOfShares"]
             prepare_and_execute_multi_upsert(
                 conn=conn,
                 query="INSERT OR REPLACE INTO contract_metrics_totalShares ({fields}) VALUES ({placeholders})",
-                fields=total_shares_fields,
-                data=[
-                    {
-                        "contractId": contract_metric.get("contractId", None),
-                        "userId": contract_metric.get("userId", None),
-                        "outcome": outcome,
-                        "numberOfShares": numberOfShares
-                        } for contract_metric in contract_metrics for outcome, numberOfShares in contract_metric.get("totalShares", {}).items()]
+                encoder=CONTRACT_METRIC_TOTAL_SHARES_ENCODER,
+                data=contract_metrics
             )
         
             # Commit transaction
@@ -622,11 +1090,28 @@ class ManifoldDatabase:
 
         logger.debug("Upsert contract metrics successful")
 
+    def get_market_traders_by_staleness(self, contract_id):
+        """
+        Returns the users with bets on a market (from the ``market_traders`` aggregate), those without a stored position first,
+        then the others by the age of their stored position, oldest first.
+
+        :param str contract_id: Required. The market ID.
+        :return: The user IDs.
+        :rtype: list[str]
+        """
+        cursor = self.get_conn().cursor()
+        cursor.row_factory = None
+        return [row[0] for row in cursor.execute(
+            "SELECT mt.userId FROM market_traders mt "
+            "LEFT JOIN contract_metrics cm ON cm.contractId = mt.contractId AND cm.userId = mt.userId "
+            "WHERE mt.contractId = ? ORDER BY cm.retrievedTimestamp IS NOT NULL, cm.retrievedTimestamp;", (contract_id,)).fetchall()]
+
     '''
     ########################################################
     ####                      BETS                      ####
     ########################################################
     '''
+    @writes_tables("bets", "bet_fees", "bet_fills", "market_traders", "market_trader_counts", "market_volume_hourly")
     def upsert_bets(self, bets: list[dict]):
         # Get database connection
         conn = self.get_conn()
@@ -635,57 +1120,59 @@ class ManifoldDatabase:
         
         # Current UNIX epoch time for all bets in this batch
         current_time = int(time.time())
+
+        # Route the bets to their partitions (attached before the transaction begins)
+        partitions = self._route_to_partitions(conn, "bets", bets, lambda bet: self._bet_partition_key(bet.get("createdTime")))
         
         # Begin transaction for performance and data integrity
         conn.execute("BEGIN TRANSACTION;")
 
         try:
-            # Fields for the bets base table
-            bet_fields = [
-                "id", "userId", "contractId", "isFilled", "amount", "probBefore",
-                "isCancelled", "outcome", "shares", "limitProb", "loanAmount", 
-                "orderAmount", "probAfter", "createdTime", "retrievedTimestamp"
-            ]
-            
-            # Insert or replace into the bets base table
-            prepare_and_execute_multi_upsert(
-                conn=conn,
-                query="INSERT OR REPLACE INTO bets ({fields}) VALUES ({placeholders})",
-                fields=bet_fields,
-                data=[{**bet, "retrievedTimestamp": current_time} for bet in bets]
-            )
-            
-            # Handle nested tables (fees and fills)
-            # Delete entries
-            prepare_and_execute_multi_deletion(
-                conn=conn,
-                query="DELETE FROM bet_fees WHERE betId = ?",
-                ids=[bet["id"] for bet in bets]
-            )
+            for schema, partition_bets in partitions.items():
+                bet_ids = [bet["id"] for bet in partition_bets]
 
-            fee_fields = ["betId", "creatorFee", "liquidityFee", "platformFee"]
-            prepare_and_execute_multi_upsert(
-                conn=conn,
-                query="INSERT OR REPLACE INTO bet_fees ({fields}) VALUES ({placeholders})",
-                fields=fee_fields,
-                data=[{**bet["fees"], "betId": bet["id"]} for bet in bets if "fees" in bet]
-            )
+                # Bets written before partitioning was enabled are moved out of the main database
+                if schema != "main":
+                    for table, column in (("bets", "id"), ("bet_fees", "betId"), ("bet_fills", "betId")):
+                        prepare_and_execute_multi_deletion(conn=conn, query=f"DELETE FROM main.{table} WHERE {column} = ?", ids=bet_ids)
 
-            # Delete entries
-            prepare_and_execute_multi_deletion(
-                conn=conn,
-                query="DELETE FROM bet_fills WHERE betId = ?",
-                ids=[bet["id"] for bet in bets]
-            )
+                # Insert or replace into the bets base table
+                prepare_and_execute_multi_upsert(
+                    conn=conn,
+                    query=f"INSERT OR REPLACE INTO {schema}.bets ({{fields}}) VALUES ({{placeholders}})",
+                    encoder=BET_ENCODER,
+                    data=partition_bets,
+                    retrievedTimestamp=current_time,
+                )
+                
+                # Handle nested tables (fees and fills)
+                # Delete entries
+                prepare_and_execute_multi_deletion(
+                    conn=conn,
+                    query=f"DELETE FROM {schema}.bet_fees WHERE betId = ?",
+                    ids=bet_ids
+                )
 
-            fill_fields = ["betId", "timestamp", "matchedBetId", "amount", "shares"]
-            prepare_and_execute_multi_upsert(
-                conn=conn,
-                query="INSERT OR REPLACE INTO bet_fills ({fields}) VALUES ({placeholders})",
-                fields=fill_fields,
-                data=[{**fill, "betId": bet["id"]} for bet in bets for fill in bet.get("fills", [])]
+                prepare_and_execute_multi_upsert(
+                    conn=conn,
+                    query=f"INSERT OR REPLACE INTO {schema}.bet_fees ({{fields}}) VALUES ({{placeholders}})",
+                    encoder=BET_FEE_ENCODER,
+                    data=partition_bets
+                )
 
-            )
+                # Delete entries
+                prepare_and_execute_multi_deletion(
+                    conn=conn,
+                    query=f"DELETE FROM {schema}.bet_fills WHERE betId = ?",
+                    ids=bet_ids
+                )
+
+                prepare_and_execute_multi_upsert(
+                    conn=conn,
+                    query=f"INSERT OR REPLACE INTO {schema}.bet_fills ({{fields}}) VALUES ({{placeholders}})",
+                    encoder=BET_FILL_ENCODER,
+                    data=partition_bets
+                )
             
             # Commit transaction
             conn.commit()
@@ -696,38 +1183,1209 @@ class ManifoldDatabase:
 
         logger.debug("Upsert bets successful")
 
+    '''
+    ########################################################
+    ####                  AGGREGATES                    ####
+    ########################################################
+    '''
+    # Trigger bodies maintaining the aggregate tables, applied to the inserted (NEW) or deleted (OLD) row
+    _AGGREGATE_TRIGGERS = {
+        "bets": {
+            "INSERT": """
+                INSERT INTO market_trader_counts (contractId, traders)
+                SELECT NEW.contractId, 1 WHERE NEW.contractId IS NOT NULL AND NEW.userId IS NOT NULL
+                    AND NOT EXISTS (SELECT 1 FROM market_traders WHERE contractId = NEW.contractId AND userId = NEW.userId)
+                ON CONFLICT (contractId) DO UPDATE SET traders = traders + 1;
+                INSERT INTO market_traders (contractId, userId, bets)
+                SELECT NEW.contractId, NEW.userId, 1 WHERE NEW.contractId IS NOT NULL AND NEW.userId IS NOT NULL
+                ON CONFLICT (contractId, userId) DO UPDATE SET bets = bets + 1;
+                INSERT INTO market_volume_hourly (contractId, hour, volume, bets)
+                SELECT NEW.contractId, NEW.createdTime / 3600000, ABS(COALESCE(NEW.amount, 0)), 1 WHERE NEW.contractId IS NOT NULL AND NEW.createdTime IS NOT NULL
+                ON CONFLICT (contractId, hour) DO UPDATE SET volume = volume + excluded.volume, bets = bets + 1;
+            """,
+            "DELETE": """
+                UPDATE market_traders SET bets = bets - 1 WHERE contractId = OLD.contractId AND userId = OLD.userId;
+                UPDATE market_trader_counts SET traders = traders - 1 WHERE contractId = OLD.contractId
+                    AND EXISTS (SELECT 1 FROM market_traders WHERE contractId = OLD.contractId AND userId = OLD.userId AND bets <= 0);
+                DELETE FROM market_traders WHERE contractId = OLD.contractId AND userId = OLD.userId AND bets <= 0;
+                UPDATE market_volume_hourly SET volume = volume - ABS(COALESCE(OLD.amount, 0)), bets = bets - 1
+                    WHERE contractId = OLD.contractId AND hour = OLD.createdTime / 3600000;
+            """,
+        },
+        "contract_metrics_totalShares": {
+            # Recomputed from the (at most a few) share rows of the user, so repeated upserts do not accumulate rounding errors
+            "INSERT": """
+                INSERT INTO user_contract_shares (contractId, userId, yesShares, noShares)
+                SELECT NEW.contractId, NEW.userId,
+                    (SELECT TOTAL(numberOfShares) FROM contract_metrics_totalShares WHERE contractId = NEW.contractId AND userId = NEW.userId AND outcome = 'YES'),
+                    (SELECT TOTAL(numberOfShares) FROM contract_metrics_totalShares WHERE contractId = NEW.contractId AND userId = NEW.userId AND outcome = 'NO')
+                WHERE NEW.outcome IN ('YES', 'NO') AND NEW.contractId IS NOT NULL AND NEW.userId IS NOT NULL
+                ON CONFLICT (contractId, userId) DO UPDATE SET yesShares = excluded.yesShares, noShares = excluded.noShares;
+            """,
+            "DELETE": """
+                UPDATE user_contract_shares SET
+                    yesShares = (SELECT TOTAL(numberOfShares) FROM contract_metrics_totalShares WHERE contractId = OLD.contractId AND userId = OLD.userId AND outcome = 'YES'),
+                    noShares = (SELECT TOTAL(numberOfShares) FROM contract_metrics_totalShares WHERE contractId = OLD.contractId AND userId = OLD.userId AND outcome = 'NO')
+                WHERE contractId = OLD.contractId AND userId = OLD.userId;
+            """,
+        },
+    }
+
+    def _create_aggregate_triggers(self, conn, schema="main"):
+        # Triggers of the main tables are stored in the database. Triggers of attached partitions can only write to the aggregate
+        # tables of the main database as TEMP triggers, which live as long as the connection.
+        if schema == "main":
+            temp, prefix, tables = "", "", self._AGGREGATE_TRIGGERS
+        else:
+            temp, prefix, tables = "TEMP ", f"{schema}_", self.PARTITION_GROUPS[self._partition_group(schema)]
+        for table, events in self._AGGREGATE_TRIGGERS.items():
+            if table not in tables:
+                continue
+            for event, body in events.items():
+                conn.execute(f"CREATE {temp}TRIGGER IF NOT EXISTS {prefix}{table}_aggregates_{event.lower()} "
+                             f"AFTER {event} ON {schema}.{table} BEGIN {body} END;")
+            conn.execute(f"CREATE {temp}TRIGGER IF NOT EXISTS {prefix}{table}_aggregates_update "
+                         f"AFTER UPDATE ON {schema}.{table} BEGIN {events['DELETE']} {events['INSERT']} END;")
+
+    @writes_tables("market_traders", "market_trader_counts", "market_volume_hourly", "user_contract_shares")
+    def rebuild_aggregates(self):
+        """
+        Recomputes the aggregate tables from the bets (of every writable partition) and contract metrics.
+        Only needed after bets were modified without the triggers, e.g. after archiving a partition.
+        """
+        conn = self.get_conn()
+        partitions = [(partition["schema"], partition["path"]) for partition in self.list_partitions("bets") if not partition["read_only"]]
+        self._attach_partitions(conn, partitions)
+        bets = " UNION ALL ".join(f"SELECT contractId, userId, amount, createdTime FROM {schema}.bets" for schema in ["main"] + [schema for schema, _ in partitions])
+
+        logger.debug("Rebuilding aggregate tables")
+
+        conn.execute("BEGIN TRANSACTION;")
+        try:
+            for table in ("market_traders", "market_trader_counts", "market_volume_hourly", "user_contract_shares"):
+                conn.execute(f"DELETE FROM main.{table};")
+            conn.execute(f"""
+                INSERT INTO main.market_traders (contractId, userId, bets)
+                SELECT contractId, userId, COUNT(*) FROM ({bets}) WHERE contractId IS NOT NULL AND userId IS NOT NULL GROUP BY contractId, userId;
+            """)
+            conn.execute("""
+                INSERT INTO main.market_trader_counts (contractId, traders)
+                SELECT contractId, COUNT(*) FROM main.market_traders GROUP BY contractId;
+            """)
+            conn.execute(f"""
+                INSERT INTO main.market_volume_hourly (contractId, hour, volume, bets)
+                SELECT contractId, createdTime / 3600000, TOTAL(ABS(amount)), COUNT(*) FROM ({bets})
+                WHERE contractId IS NOT NULL AND createdTime IS NOT NULL GROUP BY contractId, createdTime / 3600000;
+            """)
+            conn.execute("""
+                INSERT INTO main.user_contract_shares (contractId, userId, yesShares, noShares)
+                SELECT contractId, userId, TOTAL(CASE WHEN outcome = 'YES' THEN numberOfShares END), TOTAL(CASE WHEN outcome = 'NO' THEN numberOfShares END)
+                FROM main.contract_metrics_totalShares WHERE outcome IN ('YES', 'NO') AND contractId IS NOT NULL AND userId IS NOT NULL GROUP BY contractId, userId;
+            """)
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Database error in rebuild_aggregates: {e}")
+            conn.rollback()
+
+    '''
+    ########################################################
+    ####                  PARTITIONS                    ####
+    ########################################################
+    '''
+    # The tables stored in the partition files of each partitioned group
+    PARTITION_GROUPS = {
+        "bets": ("bets", "bet_fees", "bet_fills"),
+        "contract_metrics_from": ("contract_metrics_from",),
+    }
+
+    def _bet_partition_key(self, created_time):
+        if not self.bet_partition_period or created_time is None:
+            return None
+        created = time.gmtime(created_time / 1000)
+        if self.bet_partition_period == "year":
+            return f"{created.tm_year}"
+        return f"{created.tm_year}_{created.tm_mon:02d}"
+
+    def _metrics_from_partition_key(self, contract_id):
+        if not self.metrics_from_partitions or contract_id is None:
+            return None
+        # crc32 rather than hash(), which is salted per process
+        return f"{zlib.crc32(contract_id.encode()) % self.metrics_from_partitions}"
+
+    def _route_to_partitions(self, conn, group, records, key_function):
+        # Groups the records by the schema they are written to, creating and attaching missing partitions
+        partitions = defaultdict(list)
+        for record in records:
+            key = key_function(record)
+            partitions["main" if key is None else f"{group}_{key}"].append(record)
+
+        # Writing to a read-only partition would fail and roll back the whole batch, reject its rows instead
+        for schema in [schema for schema in partitions if schema != "main" and self._is_partition_read_only(schema)]:
+            logger.warning(f"Skipping {len(partitions[schema])} {group} records routed to the read-only partition {schema}")
+            del partitions[schema]
+
+        attach = [self._ensure_partition(schema) for schema in partitions if schema != "main"]
+        if attach:
+            self._attach_partitions(conn, attach)
+        return partitions
+
+    def _is_partition_read_only(self, schema):
+        return os.path.exists(os.path.join(self.partition_dir, f"{schema}.db.readonly"))
+
+    def _writable_schemas(self, conn):
+        # The main database and the partitions attached writable to this thread's connection
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        read_only = self._read_only_partitions()
+        return [row[1] for row in cursor.execute("PRAGMA database_list;").fetchall() if row[1] != "temp" and row[1] not in read_only]
+
+    def _partition_group(self, schema):
+        return next(group for group in self.PARTITION_GROUPS if schema.startswith(group + "_"))
+
+    def _ensure_partition(self, schema):
+        # Creates the partition file with the tables of its group, copying their schema from the main database
+        path = os.path.join(self.partition_dir, f"{schema}.db")
+        if os.path.exists(path):
+            return schema, path
+
+        tables = self.PARTITION_GROUPS[self._partition_group(schema)]
+        main = sqlite3.connect(self.db_path)
+        try:
+            statements = [row[0] for row in main.execute(
+                f"SELECT sql FROM sqlite_master WHERE tbl_name IN ({', '.join('?' for _ in tables)}) AND type IN ('table', 'index') AND sql IS NOT NULL ORDER BY type DESC",
+                tables)]
+        finally:
+            main.close()
+
+        # Build the partition under a temporary name, so that it never appears without its tables
+        os.makedirs(self.partition_dir, exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        partition = sqlite3.connect(temporary_path)
+        try:
+            for statement in statements:
+                partition.execute(statement)
+            partition.commit()
+            partition.execute("PRAGMA journal_mode=WAL;")
+        finally:
+            partition.close()
+        try:
+            # Another process may have created the same partition in the meantime
+            os.link(temporary_path, path)
+            logger.info(f"Created database partition {schema}")
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temporary_path)
+        return schema, path
+
+    def _attach_partitions(self, conn, partitions, read_only=False):
+        if isinstance(conn, _StatementRecorder):
+            conn.attach_partitions(partitions)
+            return
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        attached = {row[1] for row in cursor.execute("PRAGMA database_list;").fetchall()}
+        for schema, path in partitions:
+            if schema not in attached:
+                writable = not read_only and not os.path.exists(path + ".readonly")
+                if not writable:
+                    path = f"file:{urllib.parse.quote(path)}?mode=ro"
+                cursor.execute("ATTACH DATABASE ? AS ?;", (path, schema))
+                if writable:
+                    self._create_aggregate_triggers(conn, schema)
+                else:
+                    self._read_only_partitions().add(schema)
+
+    def _read_only_partitions(self):
+        # The partitions attached read-only to this thread's connection
+        if not hasattr(self.local_storage, "read_only_partitions"):
+            self.local_storage.read_only_partitions = set()
+        return self.local_storage.read_only_partitions
+
+    def list_partitions(self, group=None):
+        """
+        Lists the partition files of the database.
+
+        :param str group: Optional. Only list the partitions of ``bets`` or ``contract_metrics_from``. Default is all.
+        :return: A list of dicts with the ``group``, ``schema`` (the name it is attached as), ``path``, ``size`` in bytes and ``read_only`` flag of each partition.
+        :rtype: list[dict]
+        """
+        if not os.path.isdir(self.partition_dir):
+            return []
+        partitions = []
+        for file_name in sorted(os.listdir(self.partition_dir)):
+            schema, extension = os.path.splitext(file_name)
+            if extension != ".db":
+                continue
+            for partition_group in self.PARTITION_GROUPS:
+                if schema.startswith(partition_group + "_") and (group is None or group == partition_group):
+                    path = os.path.join(self.partition_dir, file_name)
+                    partitions.append({"group": partition_group, "schema": schema, "path": path,
+                                       "size": os.path.getsize(path), "read_only": os.path.exists(path + ".readonly")})
+        return partitions
+
+    def enable_partition_views(self, conn):
+        """
+        Attaches every partition to ``conn`` and shadows the partitioned tables with temporary views over the main database and
+        all partitions, so that unqualified queries (``SELECT ... FROM bets``) read every partition. Only for reading connections,
+        the views cannot be written to. Cheap to call before every query: the views are only rebuilt when the partitions change.
+
+        :param sqlite3.Connection conn: Required. This thread's connection.
+        """
+        try:
+            version = os.stat(self.partition_dir).st_mtime_ns
+        except FileNotFoundError:
+            version = None
+        if getattr(self.local_storage, "partition_views", None) == version:
+            return
+
+        partitions = self.list_partitions()
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        attached = {row[1] for row in cursor.execute("PRAGMA database_list;").fetchall()}
+        current = {partition["schema"] for partition in partitions}
+        for schema in attached - current - {"main", "temp"}:
+            cursor.execute(f"DETACH DATABASE {schema};")
+            self._read_only_partitions().discard(schema)
+        self._attach_partitions(conn, [(partition["schema"], partition["path"]) for partition in partitions], read_only=True)
+
+        for group, tables in self.PARTITION_GROUPS.items():
+            schemas = ["main"] + [partition["schema"] for partition in partitions if partition["group"] == group]
+            for table in tables:
+                cursor.execute(f"DROP VIEW IF EXISTS temp.{table};")
+                if len(schemas) > 1:
+                    cursor.execute(f"CREATE TEMP VIEW {table} AS " + " UNION ALL ".join(f"SELECT * FROM {schema}.{table}" for schema in schemas))
+        self.local_storage.partition_views = version
+
+    @writes_tables()
+    def compact_partition(self, schema):
+        """
+        Rebuilds a partition file with VACUUM, returning its free pages to the file system.
+
+        :param str schema: Required. The partition's schema name (see ``list_partitions``).
+        """
+        conn = self.get_conn()
+        self._attach_partitions(conn, [(schema, os.path.join(self.partition_dir, f"{schema}.db"))])
+        conn.execute(f"VACUUM {schema};")
+
+    @writes_tables()
+    def set_partition_read_only(self, schema, read_only=True):
+        """
+        Makes a partition read-only (or writable again). The partition is attached read-only from then on and writes routed to it fail.
+
+        :param str schema: Required. The partition's schema name (see ``list_partitions``).
+        :param bool read_only: Optional. Default is True.
+        """
+        marker = os.path.join(self.partition_dir, f"{schema}.db.readonly")
+        self._detach_partition(schema)
+        if read_only:
+            open(marker, "w").close()
+        elif os.path.exists(marker):
+            os.remove(marker)
+
+    @writes_tables("bets", "bet_fees", "bet_fills", "contract_metrics_from")
+    def archive_partition(self, schema, archive_dir):
+        """
+        Moves a partition file out of the database into ``archive_dir``. Its rows are no longer read or written.
+
+        :param str schema: Required. The partition's schema name (see ``list_partitions``).
+        :param str archive_dir: Required. The directory the partition file is moved to.
+        :return: The new path of the partition file.
+        :rtype: str
+        """
+        path = os.path.join(self.partition_dir, f"{schema}.db")
+        self._detach_partition(schema)
+        partition = sqlite3.connect(path)
+        try:
+            partition.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+        finally:
+            partition.close()
+        os.makedirs(archive_dir, exist_ok=True)
+        destination = os.path.join(archive_dir, f"{schema}.db")
+        shutil.move(path, destination)
+        # Frames readers kept from being checkpointed stay with the partition
+        if os.path.exists(path + "-wal"):
+            shutil.move(path + "-wal", destination + "-wal")
+        for suffix in ("-shm", ".readonly"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        logger.info(f"Archived database partition {schema} to {destination}")
+        return destination
+
+    def _detach_partition(self, schema):
+        conn = self.get_conn()
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        if schema in {row[1] for row in cursor.execute("PRAGMA database_list;").fetchall()}:
+            # TEMP triggers would outlive the attachment
+            for table in self.PARTITION_GROUPS[self._partition_group(schema)]:
+                for event in ("insert", "delete", "update"):
+                    cursor.execute(f"DROP TRIGGER IF EXISTS temp.{schema}_{table}_aggregates_{event};")
+            cursor.execute(f"DETACH DATABASE {schema};")
+            self._read_only_partitions().discard(schema)
+
+    '''
+    ########################################################
+    ####                  MAINTENANCE                   ####
+    ########################################################
+    '''
+    def get_wal_size(self):
+        """
+        Returns the size of the write-ahead log file in bytes (0 if it does not exist).
+        """
+        try:
+            return os.path.getsize(self.db_path + "-wal")
+        except OSError:
+            return 0
+
+    # Write functions bulk_write runs, the dump imports' upserts
+    BULK_WRITES = ("upsert_binary_choice_markets", "upsert_multiple_choice_markets", "upsert_bets")
+
+    @writes_tables(*upsert_binary_choice_markets.tables, *upsert_multiple_choice_markets.tables, *upsert_bets.tables)
+    def bulk_write(self, operation):
+        """
+        Runs one write operation with durability traded for speed, then restores the connection's settings, so
+        that only the operation's own transactions skip syncing. Queue this through the ``ManifoldDatabaseWriter``
+        (or its client) to load large amounts of data without affecting other writes on the writer connection.
+
+        :param tuple operation: Required. The name of a write function of ``BULK_WRITES`` and the data passed to it.
+        :raises ValueError: If the write function is not one of ``BULK_WRITES``.
+        :return: The result of the write function.
+        """
+        name, data = operation
+        if name not in self.BULK_WRITES:
+            raise ValueError(f"{name} cannot be run by bulk_write")
+        function = getattr(self, name)
+        conn = self.get_conn()
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        synchronous = cursor.execute("PRAGMA synchronous;").fetchone()[0]
+        temp_store = cursor.execute("PRAGMA temp_store;").fetchone()[0]
+        conn.execute("PRAGMA synchronous = OFF;")
+        conn.execute("PRAGMA temp_store = MEMORY;")
+        try:
+            return function(data)
+        finally:
+            conn.execute(f"PRAGMA synchronous = {int(synchronous)};")
+            conn.execute(f"PRAGMA temp_store = {int(temp_store)};")
+
+    def checkpoint(self, mode="PASSIVE"):
+        """
+        Runs a WAL checkpoint of the main database and the partitions attached writable to the calling thread's connection.
+
+        :param str mode: Optional. One of PASSIVE, FULL, RESTART or TRUNCATE. Default is PASSIVE.
+        :return: A dict with the ``busy`` flag, the number of frames in the ``log``, the number of frames ``checkpointed`` and the ``duration`` in seconds, summed over the databases.
+        :rtype: dict
+        """
+        mode = mode.upper()
+        if mode not in ("PASSIVE", "FULL", "RESTART", "TRUNCATE"):
+            raise ValueError(f"Unknown checkpoint mode {mode}")
+
+        conn = self.get_conn()
+        cursor = conn.cursor()
+        cursor.row_factory = None
+
+        start = time.perf_counter()
+        busy = log = checkpointed = 0
+        # Checkpointing a read-only attachment fails, so checkpoint every writable schema on its own
+        for schema in self._writable_schemas(conn):
+            schema_busy, schema_log, schema_checkpointed = cursor.execute(f"PRAGMA {schema}.wal_checkpoint({mode});").fetchone()
+            busy = max(busy, schema_busy)
+            log += max(schema_log, 0)
+            checkpointed += max(schema_checkpointed, 0)
+        duration = time.perf_counter() - start
+
+        logger.debug(f"Checkpoint {mode}: busy={busy}, log={log}, checkpointed={checkpointed} in {duration:.3f}s")
+        return {"mode": mode, "busy": busy, "log": log, "checkpointed": checkpointed, "duration": duration}
+
+    def incremental_vacuum(self, pages=1000):
+        """
+        Returns up to ``pages`` free pages to the filesystem. Does nothing unless the database was created with auto_vacuum=INCREMENTAL.
+
+        :param int pages: Optional. The maximum number of pages to free. Default is 1000.
+        :return: The number of free pages before vacuuming.
+        :rtype: int
+        """
+        conn = self.get_conn()
+        cursor = conn.cursor()
+        cursor.row_factory = None
+
+        if cursor.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+            return 0
+        freelist_count = cursor.execute("PRAGMA freelist_count;").fetchone()[0]
+        if freelist_count:
+            # Frees one page per step, and the sqlite3 module only steps execute() once; executescript runs it to completion
+            conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        return freelist_count
+
+    def analyze(self, analysis_limit=1000):
+        """
+        Refreshes the query planner statistics of the main database and the partitions attached writable to the calling thread's connection.
+
+        :param int analysis_limit: Optional. The approximate number of rows examined per index. Default is 1000.
+        """
+        conn = self.get_conn()
+        conn.execute(f"PRAGMA analysis_limit = {int(analysis_limit)};")
+        for schema in self._writable_schemas(conn):
+            conn.execute(f"ANALYZE {schema};")
+        conn.commit()
+
+    @writes_tables("bets", "bet_fees", "bet_fills", "market_traders", "market_trader_counts", "market_volume_hourly")
+    def prune_bets(self, older_than, batch_size=5000):
+        """
+        Deletes one batch of bets (and their fees and fills) created before ``older_than``.
+
+        :param int older_than: Required. Cutoff as a UNIX epoch time in seconds.
+        :param int batch_size: Optional. The maximum number of bets to delete. Default is 5000.
+        :return: The number of bets deleted.
+        :rtype: int
+        """
+        conn = self.get_conn()
+        cursor = conn.cursor()
+        cursor.row_factory = None
+
+        partitions = [(partition["schema"], partition["path"]) for partition in self.list_partitions("bets") if not partition["read_only"]]
+        self._attach_partitions(conn, partitions)
+
+        # Bet createdTime is in milliseconds
+        bet_ids = {}
+        for schema in ["main"] + [schema for schema, _ in partitions]:
+            remaining = batch_size - sum(len(ids) for ids in bet_ids.values())
+            if remaining <= 0:
+                break
+            ids = cursor.execute(f"SELECT id FROM {schema}.bets WHERE createdTime < ? LIMIT ?;", (int(older_than * 1000), remaining)).fetchall()
+            if ids:
+                bet_ids[schema] = ids
+        if not bet_ids:
+            return 0
+
+        conn.execute("BEGIN TRANSACTION;")
+        try:
+            for schema, ids in bet_ids.items():
+                prepare_and_execute_multi_deletion(conn=conn, query=f"DELETE FROM {schema}.bet_fees WHERE betId = ?", ids=ids)
+                prepare_and_execute_multi_deletion(conn=conn, query=f"DELETE FROM {schema}.bet_fills WHERE betId = ?", ids=ids)
+                prepare_and_execute_multi_deletion(conn=conn, query=f"DELETE FROM {schema}.bets WHERE id = ?", ids=ids)
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Database error in prune_bets: {e}")
+            conn.rollback()
+            return 0
+
+        pruned = sum(len(ids) for ids in bet_ids.values())
+        logger.debug(f"Pruned {pruned} bets")
+        return pruned
+
+    '''
+    ########################################################
+    ####                    CHANGES                     ####
+    ########################################################
+    '''
+    # Key columns of the tables subscriptions can track
+    CHANGE_KEYS = {
+        "users": ("id",),
+        "binary_choice_markets": ("id",),
+        "multiple_choice_markets": ("id",),
+        "bets": ("id",),
+        "contract_metrics": ("contractId", "userId"),
+    }
+
+    def diff_rows(self, table, rows, fields, scope=None):
+        """
+        Compares rows about to be upserted with the rows stored in the database. Must be called before the upsert is written,
+        ``upsert_with_changes`` does both on the writer thread.
+
+        Fields are column names of the table, other fields are ignored. Columns of nested objects are looked up in the row's object
+        (``pool_YES`` is ``row["pool"]["YES"]``).
+
+        :param str table: Required. The table, a key of ``CHANGE_KEYS``.
+        :param list[dict] rows: Required. The rows in the API's format.
+        :param list[str] fields: Required. The fields whose changes are reported.
+        :param dict scope: Optional. Column values the rows are the complete set of (``{"contractId": ...}``). Stored rows in the scope
+            that are missing from ``rows`` are reported as deleted. Default is None (no deletions are reported).
+        :return: The changes.
+        :rtype: ChangeEvent
+        """
+        key_fields = self.CHANGE_KEYS[table]
+        cursor = self.get_conn().cursor()
+        cursor.row_factory = None
+        columns = {row[1] for row in cursor.execute(f"PRAGMA table_info({table});").fetchall()}
+        fields = [field for field in fields if field in columns and field not in key_fields]
+
+        def key_of(row):
+            return row.get(key_fields[0]) if len(key_fields) == 1 else tuple(row.get(field) for field in key_fields)
+
+        def value_of(row, field):
+            if field in row:
+                return row[field]
+            parent, _, child = field.partition("_")
+            nested = row.get(parent)
+            return nested.get(child) if isinstance(nested, dict) else None
+
+        new = {key_of(row): {field: value_of(row, field) for field in fields} for row in rows}
+        new.pop(None, None)
+
+        self.enable_partition_views(self.get_conn())
+        columns = ", ".join(key_fields + tuple(fields))
+        old = {}
+        if scope:
+            query = f"SELECT {columns} FROM {table} WHERE " + " AND ".join(f"{column} = ?" for column in scope)
+            results = cursor.execute(query, list(scope.values())).fetchall()
+        else:
+            results = []
+            keys = list(new)
+            condition = "id IN ({})" if len(key_fields) == 1 else f"({', '.join(key_fields)}) IN (VALUES {{}})"
+            placeholder = "?" if len(key_fields) == 1 else f"({', '.join('?' for _ in key_fields)})"
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                params = chunk if len(key_fields) == 1 else [value for key in chunk for value in key]
+                query = f"SELECT {columns} FROM {table} WHERE " + condition.format(", ".join(placeholder for _ in chunk))
+                results.extend(cursor.execute(query, params).fetchall())
+        for result in results:
+            key = result[0] if len(key_fields) == 1 else tuple(result[:len(key_fields)])
+            old[key] = dict(zip(fields, result[len(key_fields):]))
+
+        event = ChangeEvent(table)
+        for key, values in new.items():
+            if key not in old:
+                event.inserted.append(key)
+                event.new[key] = values
+            elif old[key] != values:
+                event.updated.append(key)
+                event.old[key] = old[key]
+                event.new[key] = values
+        if scope:
+            for key in old.keys() - new.keys():
+                event.deleted.append(key)
+                event.old[key] = old[key]
+        return event
+
+    # Upsert function of each table changes are tracked in
+    CHANGE_UPSERTS = {
+        "users": "upsert_users",
+        "binary_choice_markets": "upsert_binary_choice_markets",
+        "multiple_choice_markets": "upsert_multiple_choice_markets",
+        "bets": "upsert_bets",
+        "contract_metrics": "upsert_contract_metrics",
+    }
+
+    @writes_tables(*upsert_users.tables, *upsert_binary_choice_markets.tables, *upsert_multiple_choice_markets.tables,
+                   *upsert_bets.tables, *upsert_contract_metrics.tables)
+    def upsert_with_changes(self, operation):
+        """
+        Upserts rows and returns the changes of their tracked fields (see ``diff_rows``). Queue this through the ``ManifoldDatabaseWriter``
+        (or its client): the rows are compared on the writer's connection right before they are written, so no other write can land in between.
+
+        :param tuple operation: Required. The table (a key of ``CHANGE_UPSERTS``), the rows in the API's format, the tracked fields
+            and the scope (see ``diff_rows``) or None.
+        :return: The changes.
+        :rtype: ChangeEvent
+        """
+        table, rows, fields, scope = operation
+        changes = self.diff_rows(table, rows, fields, scope)
+        getattr(self, self.CHANGE_UPSERTS[table])(rows)
+        return changes
+
+    '''
+    ########################################################
+    ####                 SUBSCRIPTIONS                  ####
+    ########################################################
+    '''
+    @writes_tables("subscriptions")
+    def upsert_subscriptions(self, subscriptions: list[dict]):
+        """
+        Saves the definitions and sync state of subscriber interval jobs.
+
+        :param list[dict] subscriptions: Required. Rows of the subscriptions table with their ``owner``, ``params`` JSON encoded.
+        """
+        conn = self.get_conn()
+        conn.execute("BEGIN TRANSACTION;")
+        try:
+            prepare_and_execute_multi_upsert(
+                conn=conn,
+                query="INSERT OR REPLACE INTO subscriptions ({fields}) VALUES ({placeholders})",
+                fields=["owner", "function", "params", "polling_time", "max_polling_time", "last_execution_time", "cursor", "full_sync_time"],
+                data=subscriptions,
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Database error in upsert_subscriptions: {e}")
+            conn.rollback()
+
+    @writes_tables("subscriptions")
+    def delete_subscriptions(self, subscriptions: list[tuple]):
+        """
+        Deletes subscriber interval jobs.
+
+        :param list[tuple] subscriptions: Required. ``(owner, function, params)`` keys, ``params`` JSON encoded.
+        """
+        conn = self.get_conn()
+        conn.execute("BEGIN TRANSACTION;")
+        try:
+            prepare_and_execute_multi_deletion(conn=conn, query="DELETE FROM subscriptions WHERE owner = ? AND function = ? AND params = ?", ids=subscriptions)
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Database error in delete_subscriptions: {e}")
+            conn.rollback()
+
+    def get_subscriptions(self, owner):
+        """
+        Returns the saved subscriber interval jobs of one owner.
+
+        :param str owner: Required. The owner the subscriber saved its jobs under.
+        :rtype: list[dict]
+        """
+        cursor = self.get_conn().cursor()
+        cursor.row_factory = None
+        columns = ["function", "params", "polling_time", "max_polling_time", "last_execution_time", "cursor", "full_sync_time"]
+        query = f"SELECT {', '.join(columns)} FROM subscriptions WHERE owner = ?;"
+        return [dict(zip(columns, row)) for row in cursor.execute(query, (owner,)).fetchall()]
+
+class QueryCache:
+    '''
+    Bounded LRU cache of read query results, keyed on the SQL and its parameters.
+
+    Every entry remembers the tables its query read. ``invalidate`` evicts the entries of the modified tables, and results
+    computed while one of their tables was being modified are never stored, so a cached result is never older than the last
+    write committed through the ``ManifoldDatabaseWriter``.
+
+    :param int max_entries: Required. The maximum number of cached results.
+    '''
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (rows, tables)
+        self._keys_by_table = defaultdict(set)
+        self._table_versions = defaultdict(int)
+        self._global_version = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def versions(self, tables):
+        """
+        Returns a snapshot of the versions of ``tables``. Take it before running the query whose result will be stored.
+        """
+        with self._lock:
+            return (self._global_version, tuple(self._table_versions[table] for table in tables))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[0]
+
+    def put(self, key, rows, tables, versions):
+        with self._lock:
+            # A write committed while the query ran, the result may already be stale
+            if versions != (self._global_version, tuple(self._table_versions[table] for table in tables)):
+                return
+
+            self._remove(key)
+            self._entries[key] = (rows, tables)
+            for table in tables:
+                self._keys_by_table[table].add(key)
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def invalidate(self, tables=None):
+        """
+        Evicts the cached results that read any of ``tables``.
+
+        :param tables: Optional. The modified table names. If None, everything is evicted.
+        """
+        with self._lock:
+            self._stats["invalidations"] += 1
+            if tables is None:
+                self._global_version += 1
+                self._entries.clear()
+                self._keys_by_table.clear()
+                return
+            for table in tables:
+                self._table_versions[table] += 1
+                for key in list(self._keys_by_table.pop(table, ())):
+                    self._remove(key)
+
+    def stats(self):
+        """
+        Returns the number of cache ``hits``, ``misses``, ``evictions``, ``invalidations`` and current ``entries``.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries)}
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for table in entry[1]:
+            keys = self._keys_by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_table[table]
+
+
+# Functions whose results change without any table changing
+_VOLATILE_FUNCTIONS = {"random", "randomblob", "changes", "total_changes", "last_insert_rowid",
+                       "date", "time", "datetime", "julianday", "unixepoch", "strftime", "current_date",
+                       "current_time", "current_timestamp"}
+
+
 class ManifoldDatabaseReader:
-    def __init__(self, manifold_db):
+    '''
+    Read interface to the manifold database.
+
+    :param ManifoldDatabase manifold_db: Required. The database to read from.
+    :param int cache_size: Optional. If set, the results of up to this many distinct read queries are cached and invalidated per table
+        by writes through the ``ManifoldDatabaseWriter``. Writes made any other way (another process, direct upserts) are not seen by the cache.
+        Cached rows are shared between callers and must not be modified. Default is 0 (no caching).
+    :param refresher: Optional. Retrieves stale rows for reads with a ``max_staleness``, usually the ``ManifoldSubscriber`` (its ``refresh_markets`` and ``refresh_users``). Default is None.
+    '''
+    # Maximum number of IDs per query, below SQLite's limit of host parameters
+    MAX_QUERY_IDS = 500
+
+    def __init__(self, manifold_db, cache_size=0, refresher=None):
         self.manifold_db = manifold_db
+        self.refresher = refresher
         self.manifold_db.get_conn().row_factory = self.dict_factory
 
+        self.cache = None
+        self._query_tables = {}
+        if cache_size:
+            self.cache = QueryCache(cache_size)
+            self.manifold_db.add_change_listener(self.cache.invalidate)
+
     def dict_factory(self, cursor, row):
         """Row factory to produce dictionary results."""
         return {col[0]: row[idx] for idx, col in enumerate(cursor.description)}
 
-    def execute_query(self, query, params=None):
+    def execute_query(self, query, params=None, use_cache=True):
         """
         Execute a read query and return the results.
 
         :param query: The SQL query string.
         :param params: Any parameters for the query (optional).
+        :param bool use_cache: Whether the result may come from (and is stored in) the query cache, if the reader has one (optional).
         :return: The query results.
         """
         conn = self.manifold_db.get_conn()
         
-        logger.debug(f"Executing query {query} with params {params}")
-        
         # Set row factory here so it returns dicts.
         conn.row_factory = self.dict_factory
+
+        if self.cache is not None and use_cache:
+            key = self._cache_key(query, params)
+            tables = self._get_query_tables(conn, query, params) if key is not None else None
+            if tables is not None:
+                rows = self.cache.get(key)
+                if rows is not None:
+                    return rows
+                logger.debug(f"Executing query {query} with params {params}")
+                self.manifold_db.enable_partition_views(conn)
+                versions = self.cache.versions(tables)
+                rows = conn.execute(query, params or []).fetchall()
+                self.cache.put(key, rows, tables, versions)
+                return rows
+
+        logger.debug(f"Executing query {query} with params {params}")
+        self.manifold_db.enable_partition_views(conn)
         
         cursor = conn.cursor()
         cursor.execute(query, params or [])
         return cursor.fetchall()
 
+    def _cache_key(self, query, params):
+        if params is None:
+            return (query, ())
+        if isinstance(params, dict):
+            key = (query, tuple(sorted(params.items())))
+        else:
+            key = (query, tuple(params))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _get_query_tables(self, conn, query, params):
+        """
+        Returns the tables read by ``query``, or None if its result cannot be cached (it writes, or calls a volatile function).
+        """
+        if query in self._query_tables:
+            return self._query_tables[query]
+
+        # The authorizer is consulted while SQLite compiles the statement, which lists every table it reads
+        tables = set()
+        cacheable = True
+
+        def authorizer(action, arg1, arg2, db_name, trigger):
+            nonlocal cacheable
+            if action == sqlite3.SQLITE_READ:
+                tables.add(arg1)
+            elif action == sqlite3.SQLITE_FUNCTION:
+                if arg2.lower() in _VOLATILE_FUNCTIONS:
+                    cacheable = False
+            elif action not in (sqlite3.SQLITE_SELECT, sqlite3.SQLITE_RECURSIVE):
+                cacheable = False
+            return sqlite3.SQLITE_OK
+
+        conn.set_authorizer(authorizer)
+        try:
+            conn.execute("EXPLAIN " + query, params or []).fetchall()
+        except sqlite3.Error:
+            cacheable = False
+        finally:
+            conn.set_authorizer(None)
+
+        result = frozenset(tables) if cacheable and tables else None
+        if len(self._query_tables) < 10 * self.cache.max_entries:
+            self._query_tables[query] = result
+        return result
+
+    def search_markets_local(self, term, outcome_type=None, is_resolved=None, creator_id=None,
+                             min_volume=None, closes_after=None, order_by="rank", limit=100, raw=False):
+        """
+        Full-text search over the question and description of binary and multiple choice markets in the local database.
+
+        :param str term: Required. The search term. Every word must match (prefix matches are not implied).
+        :param str outcome_type: Optional. Only return markets of this outcome type, either ``BINARY`` or ``MULTIPLE_CHOICE``.
+        :param bool is_resolved: Optional. Only return resolved (True) or unresolved (False) markets.
+        :param str creator_id: Optional. Only return markets created by this user ID.
+        :param float min_volume: Optional. Only return markets with at least this total volume.
+        :param int closes_after: Optional. Only return markets closing after this time (milliseconds since epoch).
+        :param str order_by: Optional. ``rank`` (best match first, question matches weigh more than description matches), ``volume``, ``volume24Hours``, ``createdTime`` or ``closeTime`` (descending). Default is ``rank``.
+        :param int limit: Optional. The maximum number of markets to return. Default is 100.
+        :param bool raw: Optional. Pass ``term`` to SQLite unchanged as an FTS5 query expression (allows ``OR``, ``NEAR``, ``prefix*``, ...). Default is False.
+        :return: A list of dicts with ``id``, ``outcomeType``, ``question``, ``url``, ``isResolved``, ``closeTime``, ``createdTime``, ``volume``, ``volume24Hours``, ``probability`` (None for multiple choice markets) and ``rank`` (lower is better).
+        :rtype: list[dict]
+        """
+        if order_by not in ("rank", "volume", "volume24Hours", "createdTime", "closeTime"):
+            raise ValueError(f"Cannot order search results by {order_by}")
+
+        if not raw:
+            # Quote every word so punctuation in the term is not parsed as FTS5 syntax
+            term = " ".join('"' + word.replace('"', '""') + '"' for word in term.split())
+        if not term:
+            return []
+
+        filters = ""
+        filter_params = []
+        if is_resolved is not None:
+            filters += " AND m.isResolved = ?"
+            filter_params.append(int(is_resolved))
+        if creator_id is not None:
+            filters += " AND m.creatorId = ?"
+            filter_params.append(creator_id)
+        if min_volume is not None:
+            filters += " AND m.volume >= ?"
+            filter_params.append(min_volume)
+        if closes_after is not None:
+            filters += " AND m.closeTime > ?"
+            filter_params.append(closes_after)
+
+        selects = []
+        params = []
+        for table, market_type, probability in (("binary_choice_markets", "BINARY", "m.probability"),
+                                                ("multiple_choice_markets", "MULTIPLE_CHOICE", "NULL")):
+            if outcome_type is not None and outcome_type != market_type:
+                continue
+            selects.append(f"""
+                SELECT m.id, m.outcomeType, m.question, m.url, m.isResolved, m.closeTime, m.createdTime,
+                       m.volume, m.volume24Hours, {probability} AS probability, bm25(markets_fts, 10.0, 1.0) AS rank
+                FROM markets_fts
+                JOIN markets_fts_docs d ON d.docId = markets_fts.rowid
+                JOIN {table} m ON m.id = d.id
+                WHERE markets_fts MATCH ?{filters}
+            """)
+            params += [term, *filter_params]
+        if not selects:
+            return []
+
+        order = "rank ASC" if order_by == "rank" else f"{order_by} DESC"
+        query = " UNION ALL ".join(selects) + f" ORDER BY {order} LIMIT ?"
+        params.append(limit)
+
+        return self.execute_query(query, params)
+
+    def get_markets(self, market_ids, max_staleness=None, timeout=None):
+        """
+        Returns binary and multiple choice markets by ID from the local database.
+
+        With ``max_staleness``, markets retrieved longer ago than that (or not in the database) are retrieved first through the ``refresher``,
+        all in one batch. Callers asking for the same markets at the same time share the retrieval, so reads can state how fresh they need
+        the data instead of subscribing at a short polling time just in case.
+
+        **Example**
+
+        .. code-block:: python
+
+            # Markets at most 10 seconds old
+            markets = self.manifold_db_reader.get_markets(market_ids, max_staleness=10)
+
+        :param list[str] market_ids: Required. The market IDs.
+        :param float max_staleness: Optional. The maximum age of the returned markets in seconds (by their ``retrievedTimestamp``). Default is None (any age, nothing is retrieved).
+        :param float timeout: Optional. The maximum number of seconds to wait for the retrieval. Default is None (no limit).
+        :return: The markets found, in the order of ``market_ids``.
+        :rtype: list[dict]
+        :raises concurrent.futures.TimeoutError: If the retrieval did not finish within ``timeout``.
+        """
+        return self._get_fresh_rows(("binary_choice_markets", "multiple_choice_markets"), market_ids, max_staleness, timeout,
+                                    lambda ids: self.refresher.refresh_markets(ids))
+
+    def get_users(self, user_ids, max_staleness=None, timeout=None):
+        """
+        Returns users by ID from the local database.
+
+        With ``max_staleness``, users retrieved longer ago than that (or not in the database) are retrieved first through the ``refresher``
+        (see ``get_markets``).
+
+        :param list[str] user_ids: Required. The user IDs.
+        :param float max_staleness: Optional. The maximum age of the returned users in seconds (by their ``retrievedTimestamp``). Default is None (any age, nothing is retrieved).
+        :param float timeout: Optional. The maximum number of seconds to wait for the retrieval. Default is None (no limit).
+        :return: The users found, in the order of ``user_ids``.
+        :rtype: list[dict]
+        :raises concurrent.futures.TimeoutError: If the retrieval did not finish within ``timeout``.
+        """
+        return self._get_fresh_rows(("users",), user_ids, max_staleness, timeout, lambda ids: self.refresher.refresh_users(ids))
+
+    def _get_rows_by_id(self, tables, ids):
+        rows = {}
+        ids = list(dict.fromkeys(ids))
+        for start in range(0, len(ids), self.MAX_QUERY_IDS):
+            chunk = ids[start:start + self.MAX_QUERY_IDS]
+            placeholders = ", ".join("?" * len(chunk))
+            for table in tables:
+                for row in self.execute_query(f"SELECT * FROM {table} WHERE id IN ({placeholders})", chunk):
+                    rows[row["id"]] = row
+        return rows
+
+    def _get_fresh_rows(self, tables, ids, max_staleness, timeout, refresh):
+        rows = self._get_rows_by_id(tables, ids)
+        if max_staleness is not None:
+            if self.refresher is None:
+                raise ValueError("Reads with max_staleness need a ManifoldDatabaseReader with a refresher")
+            oldest = time.time() - max_staleness
+            stale = [row_id for row_id in dict.fromkeys(ids)
+                     if row_id not in rows or (rows[row_id]["retrievedTimestamp"] or 0) < oldest]
+            if stale:
+                logger.debug(f"Refreshing {len(stale)} stale rows of {', '.join(tables)}")
+                refresh(stale).result(timeout=timeout)
+                rows.update(self._get_rows_by_id(tables, stale))
+        return [rows[row_id] for row_id in ids if row_id in rows]
+
+    def get_market_trader_count(self, contract_id):
+        """
+        Returns the number of unique users with bets on a market in the local database.
+
+        :param str contract_id: Required. The market ID.
+        :rtype: int
+        """
+        rows = self.execute_query("SELECT traders FROM market_trader_counts WHERE contractId = ?", [contract_id])
+        return rows[0]["traders"] if rows else 0
+
+    def get_market_traders(self, contract_id):
+        """
+        Returns the users with bets on a market in the local database.
+
+        :param str contract_id: Required. The market ID.
+        :return: A list of dicts with the ``userId`` and its number of ``bets``.
+        :rtype: list[dict]
+        """
+        return self.execute_query("SELECT userId, bets FROM market_traders WHERE contractId = ?", [contract_id])
+
+    def get_user_shares(self, contract_id, user_id=None):
+        """
+        Returns the YES and NO shares held in a binary market, from the latest contract metrics in the local database.
+
+        :param str contract_id: Required. The market ID.
+        :param str user_id: Optional. Only return the shares of this user. Default is every user.
+        :return: A list of dicts with the ``userId``, ``yesShares``, ``noShares`` and ``netShares`` (YES minus NO).
+        :rtype: list[dict]
+        """
+        query = "SELECT userId, yesShares, noShares, yesShares - noShares AS netShares FROM user_contract_shares WHERE contractId = ?"
+        params = [contract_id]
+        if user_id is not None:
+            query += " AND userId = ?"
+            params.append(user_id)
+        return self.execute_query(query, params)
+
+    def get_market_volume_by_hour(self, contract_id, since=None, until=None):
+        """
+        Returns the bet volume (sum of absolute bet amounts) of a market per hour, from the bets in the local database.
+
+        :param str contract_id: Required. The market ID.
+        :param int since: Optional. Only return hours starting at or after this time (milliseconds since epoch).
+        :param int until: Optional. Only return hours starting before this time (milliseconds since epoch).
+        :return: A list of dicts with the ``hour`` start time (milliseconds since epoch), ``volume`` and number of ``bets``, oldest first.
+        :rtype: list[dict]
+        """
+        query = "SELECT hour * 3600000 AS hour, volume, bets FROM market_volume_hourly WHERE contractId = ? AND bets > 0"
+        params = [contract_id]
+        if since is not None:
+            query += " AND hour >= ?"
+            params.append(-(-since // 3600000))
+        if until is not None:
+            query += " AND hour < ?"
+            params.append(-(-until // 3600000))
+        return self.execute_query(query + " ORDER BY hour", params)
+
+# Write priorities, lower is served first
+WRITE_PRIORITY_INTERACTIVE = 0
+WRITE_PRIORITY_NORMAL = 1
+WRITE_PRIORITY_BULK = 2
+_WRITE_PRIORITY_NAMES = {WRITE_PRIORITY_INTERACTIVE: "interactive", WRITE_PRIORITY_NORMAL: "normal", WRITE_PRIORITY_BULK: "bulk"}
+
+
+class WriteQueueFull(queue.Full):
+    """
+    Raised when a write operation cannot be queued because its lane of the write queue is full.
+    """
+
+
+def estimate_size(data, samples=8):
+    """
+    Roughly estimates the memory held by ``data`` in bytes. Lists are estimated from up to ``samples`` evenly spaced records.
+    """
+    if isinstance(data, tuple):
+        return sys.getsizeof(data) + sum(estimate_size(item, samples) for item in data)
+    if isinstance(data, list):
+        if not data:
+            return sys.getsizeof(data)
+        step = max(len(data) // samples, 1)
+        sampled = data[::step][:samples]
+        return sys.getsizeof(data) + sum(_deep_size(record) for record in sampled) * len(data) // len(sampled)
+    return _deep_size(data)
+
+def _deep_size(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_deep_size(key) + _deep_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_deep_size(item) for item in value)
+    return size
+
+
+class WriteQueue:
+    '''
+    Bounded priority queue of write operations.
+
+    Every priority has its own lane, bounded by a number of items and by the estimated bytes of the queued data, so
+    that a full bulk lane never holds up interactive writes. ``get`` always serves the highest priority lane first.
+    An item is always accepted into an empty lane, whatever its size.
+
+    :param int max_items: Optional. The maximum number of operations queued per lane. None for no limit.
+    :param int max_bytes: Optional. The maximum estimated bytes of data queued per lane. None for no limit.
+    '''
+    def __init__(self, max_items=None, max_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._lanes = {priority: deque() for priority in _WRITE_PRIORITY_NAMES}
+        self._bytes = {priority: 0 for priority in _WRITE_PRIORITY_NAMES}
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def _has_room(self, priority, size):
+        lane = self._lanes[priority]
+        if not lane:
+            return True
+        if self.max_items is not None and len(lane) >= self.max_items:
+            return False
+        if self.max_bytes is not None and self._bytes[priority] + size > self.max_bytes:
+            return False
+        return True
+
+    def put(self, item, priority=WRITE_PRIORITY_NORMAL, size=0, block=True, timeout=None):
+        """
+        Queues ``item`` in the lane of ``priority``.
+
+        :raises WriteQueueFull: If the lane is full and ``block`` is False, or it is still full after ``timeout`` seconds.
+        :return: The number of seconds spent waiting for room.
+        :rtype: float
+        """
+        start = time.time()
+        with self._not_full:
+            if not self._has_room(priority, size):
+                if not block:
+                    raise WriteQueueFull(f"{_WRITE_PRIORITY_NAMES[priority]} write lane is full")
+                deadline = None if timeout is None else start + timeout
+                while not self._has_room(priority, size):
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        raise WriteQueueFull(f"{_WRITE_PRIORITY_NAMES[priority]} write lane is still full after {timeout}s")
+                    self._not_full.wait(remaining)
+            self._lanes[priority].append((item, size))
+            self._bytes[priority] += size
+            self._not_empty.notify()
+        return time.time() - start
+
+    def get(self, timeout=None):
+        """
+        Removes and returns ``(item, priority)`` from the highest priority lane holding an item.
+
+        :raises queue.Empty: If nothing was queued within ``timeout`` seconds.
+        """
+        with self._not_empty:
+            if not self._not_empty.wait_for(self._total_items, timeout):
+                raise queue.Empty
+            for priority, lane in self._lanes.items():
+                if lane:
+                    item, size = lane.popleft()
+                    self._bytes[priority] -= size
+                    self._not_full.notify_all()
+                    return item, priority
+
+    def _total_items(self):
+        return sum(len(lane) for lane in self._lanes.values())
+
+    def qsize(self):
+        with self._lock:
+            return self._total_items()
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def depths(self):
+        """
+        Returns the number of ``items`` and estimated ``bytes`` queued in each lane, keyed on the lane name.
+        """
+        with self._lock:
+            return {name: {"items": len(self._lanes[priority]), "bytes": self._bytes[priority]}
+                    for priority, name in _WRITE_PRIORITY_NAMES.items()}
+
+
 class ManifoldDatabaseWriter:
-    def __init__(self, manifold_db):
+    '''
+    Serializes every write to the manifold database on a single thread.
+
+    Operations are queued in a bounded ``WriteQueue`` with three priority lanes (``WRITE_PRIORITY_INTERACTIVE``, ``WRITE_PRIORITY_NORMAL``
+    and ``WRITE_PRIORITY_BULK``), so that small interactive writes are executed ahead of queued bulk loads. When a lane is full,
+    ``queue_write_operation`` blocks until the writer catches up (``full_policy="block"``) or raises ``WriteQueueFull`` (``full_policy="fail"``).
+    Operations of one lane run in the order they were queued; operations of different lanes may be reordered.
+
+    :param ManifoldDatabase manifold_db: Required. The database to write to.
+    :param int max_queue_items: Optional. The maximum number of operations queued per priority lane. None for no limit. Default is 1000.
+    :param int max_queue_bytes: Optional. The maximum estimated bytes of data queued per priority lane. None for no limit. Default is 256 MiB.
+    :param str full_policy: Optional. ``block`` or ``fail`` when a lane is full. Default is ``block``.
+    :param float put_timeout: Optional. With the ``block`` policy, the maximum number of seconds to wait for room before raising ``WriteQueueFull``. Default is no limit.
+    '''
+    def __init__(self, manifold_db, max_queue_items=1000, max_queue_bytes=256 * 1024 * 1024, full_policy="block", put_timeout=None):
+        if full_policy not in ("block", "fail"):
+            raise ValueError(f"Unknown full policy {full_policy}")
         self.manifold_db = manifold_db
-        self.write_queue = queue.Queue()
+        self.full_policy = full_policy
+        self.put_timeout = put_timeout
+        self.write_queue = WriteQueue(max_items=max_queue_items, max_bytes=max_queue_bytes)
+        self.last_write_time = 0
+        self._stats_lock = threading.Lock()
+        self._stats = {name: {"queued": 0, "completed": 0, "failed": 0, "rejected": 0, "blocked": 0, "blocked_time": 0.0,
+                              "wait_time": 0.0, "max_wait_time": 0.0, "execution_time": 0.0, "max_execution_time": 0.0}
+                       for name in _WRITE_PRIORITY_NAMES.values()}
         self.shutdown_flag = threading.Event()
         self.worker_thread = threading.Thread(target=self._write_thread, name="MF_DB_WRITE")
         self.worker_thread.start()
@@ -744,12 +2402,30 @@ class ManifoldDatabaseWriter:
     def _write_thread(self):
         while not self.shutdown_flag.is_set():
             try:
-                function, future, data = self.write_queue.get(timeout=1)
+                (function, future, data, queued_time), priority = self.write_queue.get(timeout=1)
+                start = time.time()
+                exception = None
+                result = None
                 try:
-                    function(data)
-                    future.set_result(True)
+                    result = function(data)
                 except Exception as e:
-                    future.set_exception(e)
+                    exception = e
+
+                # Invalidate cached reads before anyone waiting on the future reads again
+                self.manifold_db.notify_tables_changed(getattr(function, "tables", None))
+                if exception is None:
+                    future.set_result(True if result is None else result)
+                else:
+                    future.set_exception(exception)
+                self.last_write_time = time.time()
+
+                with self._stats_lock:
+                    stats = self._stats[_WRITE_PRIORITY_NAMES[priority]]
+                    stats["completed" if exception is None else "failed"] += 1
+                    stats["wait_time"] += start - queued_time
+                    stats["max_wait_time"] = max(stats["max_wait_time"], start - queued_time)
+                    stats["execution_time"] += self.last_write_time - start
+                    stats["max_execution_time"] = max(stats["max_execution_time"], self.last_write_time - start)
             except queue.Empty:
                 continue
 
@@ -758,16 +2434,236 @@ class ManifoldDatabaseWriter:
         self.shutdown_flag.set()
         self.worker_thread.join()
 
-    def queue_write_operation(self, function, data):
+    def queue_write_operation(self, function, data, priority=WRITE_PRIORITY_NORMAL, block=None, timeout=None):
         """
         Queue a write operation to the database.
 
         :param function: The function to execute (a write function from ManifoldDatabase class).
         :param data: The data to write.
-        :return: Future object representing the execution of the operations.
+        :param int priority: Optional. ``WRITE_PRIORITY_INTERACTIVE``, ``WRITE_PRIORITY_NORMAL`` or ``WRITE_PRIORITY_BULK``. Default is normal.
+        :param bool block: Optional. Overrides the writer's full policy for this operation (True to block, False to fail).
+        :param float timeout: Optional. Overrides the writer's ``put_timeout`` for this operation.
+        :raises WriteQueueFull: If the lane of ``priority`` is full and the operation could not be queued.
+        :return: Future object representing the execution of the operations, resolved with the function's result (True if it returns None).
         """
-        logger.debug(f"Queueing write operation {function.__name__} with {len(data)} data items")
-        
+        if isinstance(data, list):
+            logger.debug(f"Queueing write operation {function.__name__} with {len(data)} data items")
+        else:
+            logger.debug(f"Queueing write operation {function.__name__}")
+
+        if block is None:
+            block = self.full_policy == "block"
+        if timeout is None:
+            timeout = self.put_timeout
+
+        stats = self._stats[_WRITE_PRIORITY_NAMES[priority]]
         future = concurrent.futures.Future()
-        self.write_queue.put((function, future, data))
+        try:
+            blocked_time = self.write_queue.put((function, future, data, time.time()), priority=priority,
+                                                size=estimate_size(data), block=block, timeout=timeout)
+        except WriteQueueFull:
+            with self._stats_lock:
+                stats["rejected"] += 1
+            logger.warning(f"Write queue full, rejected write operation {function.__name__}")
+            raise
+
+        with self._stats_lock:
+            stats["queued"] += 1
+            if blocked_time > 0.001:
+                stats["blocked"] += 1
+                stats["blocked_time"] += blocked_time
         return future
+
+    def is_idle(self, idle_time):
+        """
+        Checks if the write queue is empty and nothing has been written for ``idle_time`` seconds.
+
+        :param float idle_time: Required. The number of seconds without writes.
+        :rtype: bool
+        """
+        return self.write_queue.empty() and time.time() - self.last_write_time >= idle_time
+
+    def stats(self):
+        """
+        Returns the write metrics of each priority lane: the current queue depth (``items``, estimated ``bytes``), the number of operations
+        ``queued``, ``completed``, ``failed``, ``rejected`` and ``blocked`` on a full lane, and the total/max seconds spent blocked,
+        waiting in the queue (``wait_time``) and executing (``execution_time``).
+
+        :rtype: dict
+        """
+        depths = self.write_queue.depths()
+        with self._stats_lock:
+            return {name: {**depths[name], **stats} for name, stats in self._stats.items()}
+
+
+class ManifoldDatabaseMaintainer:
+    '''
+    Runs periodic maintenance on the manifold database in a background thread.
+
+    Every operation is queued through the ``ManifoldDatabaseWriter`` so that maintenance never competes with upserts for the write lock.
+    Automatic checkpoints are turned off on the writer connection; instead the maintainer runs a PASSIVE checkpoint every ``checkpoint_interval``
+    seconds and a TRUNCATE checkpoint once the writer has been idle for ``idle_time`` seconds and every WAL frame has been copied back.
+
+    Attributes:
+    -----------
+    - ``manifold_db``: The ManifoldDatabase instance
+    - ``manifold_db_writer``: The ManifoldDatabaseWriter instance
+
+    :param ManifoldDatabase manifold_db: Required. The database to maintain.
+    :param ManifoldDatabaseWriter manifold_db_writer: Required. The writer maintenance operations are queued on.
+    :param float checkpoint_interval: Optional. Seconds between checkpoints. Default is 30.
+    :param float idle_time: Optional. Seconds without writes before the WAL is truncated. Default is 5.
+    :param float vacuum_interval: Optional. Seconds between incremental vacuums. Default is 3600.
+    :param int vacuum_pages: Optional. Maximum pages freed per incremental vacuum. Default is 1000.
+    :param float analyze_interval: Optional. Seconds between ANALYZE runs. Default is 21600 (6 hours).
+    :param float bet_retention: Optional. Bets older than this many seconds are deleted. Default is None (keep everything).
+    :param float retention_interval: Optional. Seconds between retention pruning runs. Default is 3600.
+    '''
+    def __init__(self, manifold_db, manifold_db_writer, checkpoint_interval=30, idle_time=5,
+                 vacuum_interval=3600, vacuum_pages=1000, analyze_interval=6 * 3600,
+                 bet_retention=None, retention_interval=3600):
+        self.manifold_db = manifold_db
+        self.manifold_db_writer = manifold_db_writer
+        self.idle_time = idle_time
+        self.vacuum_pages = vacuum_pages
+        self.bet_retention = bet_retention
+        self._last_pruned = 0
+
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "checkpoints": 0,
+            "truncate_checkpoints": 0,
+            "busy_checkpoints": 0,
+            "last_checkpoint": None,
+            "max_checkpoint_duration": 0.0,
+            "total_checkpoint_duration": 0.0,
+            "max_wal_size": 0,
+            "vacuums": 0,
+            "analyzes": 0,
+            "pruned_bets": 0,
+        }
+
+        now = time.time()
+        self._tasks = [
+            {"name": "checkpoint", "function": self._checkpoint, "interval": checkpoint_interval, "next_run_time": now + checkpoint_interval},
+            {"name": "vacuum", "function": self._vacuum, "interval": vacuum_interval, "next_run_time": now + vacuum_interval},
+            {"name": "analyze", "function": self._analyze, "interval": analyze_interval, "next_run_time": now + analyze_interval},
+        ]
+        if bet_retention is not None:
+            self._tasks.append({"name": "prune", "function": self._prune, "interval": retention_interval, "next_run_time": now})
+
+        self.shutdown_flag = threading.Event()
+        self.worker_thread = threading.Thread(target=self._run, name="MF_DB_MAINTENANCE")
+        self.worker_thread.start()
+
+    def is_alive(self):
+        """
+        Checks if the worker_thread is running.
+
+        :return: True if worker_thread is running, False otherwise.
+        :rtype: bool
+        """
+        return self.worker_thread.is_alive()
+
+    def shutdown(self):
+        logger.debug("Shutting down manifold database maintainer")
+        self.shutdown_flag.set()
+        self.worker_thread.join()
+
+    def stats(self):
+        """
+        Returns a snapshot of the maintenance metrics, including the current WAL size in bytes and checkpoint durations in seconds.
+
+        :rtype: dict
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["wal_size"] = self.manifold_db.get_wal_size()
+        return stats
+
+    def _run(self):
+        logger.debug("Starting manifold database maintainer")
+
+        # Checkpoints are only run by the maintainer from now on
+        self._queue(self._disable_autocheckpoint)
+
+        while not self.shutdown_flag.is_set():
+            now = time.time()
+            for task in self._tasks:
+                if task["next_run_time"] <= now and not self.shutdown_flag.is_set():
+                    try:
+                        task["function"]()
+                    except Exception as e:
+                        logger.error(f"Database maintenance task {task['name']} failed: {e}")
+                    task["next_run_time"] = time.time() + task["interval"]
+
+            next_run_time = min(task["next_run_time"] for task in self._tasks)
+            self.shutdown_flag.wait(timeout=max(0, next_run_time - time.time()))
+
+    def _queue(self, function, data=None):
+        return self.manifold_db_writer.queue_write_operation(function=function, data=data).result()
+
+    @writes_tables()
+    def _disable_autocheckpoint(self, _):
+        self.manifold_db.get_conn().execute("PRAGMA wal_autocheckpoint = 0;")
+
+    def _checkpoint(self):
+        wal_size = self.manifold_db.get_wal_size()
+        with self._stats_lock:
+            self._stats["max_wal_size"] = max(self._stats["max_wal_size"], wal_size)
+
+        # Checked before our own checkpoint goes through the writer
+        idle = self.manifold_db_writer.is_idle(self.idle_time)
+
+        self._queue(self._run_checkpoint, "PASSIVE")
+
+        # Truncating is only cheap when no reader pins old frames and no writes are pending
+        last_checkpoint = self._stats["last_checkpoint"]
+        if (idle and not last_checkpoint["busy"]
+                and last_checkpoint["log"] == last_checkpoint["checkpointed"] and wal_size > 0):
+            self._queue(self._run_checkpoint, "TRUNCATE")
+
+    @writes_tables()
+    def _run_checkpoint(self, mode):
+        result = self.manifold_db.checkpoint(mode)
+        with self._stats_lock:
+            self._stats["checkpoints"] += 1
+            if mode == "TRUNCATE":
+                self._stats["truncate_checkpoints"] += 1
+            if result["busy"]:
+                self._stats["busy_checkpoints"] += 1
+            self._stats["last_checkpoint"] = result
+            self._stats["max_checkpoint_duration"] = max(self._stats["max_checkpoint_duration"], result["duration"])
+            self._stats["total_checkpoint_duration"] += result["duration"]
+
+    def _vacuum(self):
+        self._queue(self._run_vacuum)
+
+    @writes_tables()
+    def _run_vacuum(self, _):
+        self.manifold_db.incremental_vacuum(self.vacuum_pages)
+        with self._stats_lock:
+            self._stats["vacuums"] += 1
+
+    def _analyze(self):
+        self._queue(self._run_analyze)
+
+    @writes_tables()
+    def _run_analyze(self, _):
+        self.manifold_db.analyze()
+        with self._stats_lock:
+            self._stats["analyzes"] += 1
+
+    def _prune(self):
+        older_than = time.time() - self.bet_retention
+        # Prune in batches so interactive writes can interleave
+        while not self.shutdown_flag.is_set():
+            self._queue(self._run_prune, older_than)
+            if self._last_pruned == 0:
+                break
+
+    @writes_tables("bets", "bet_fees", "bet_fills", "market_traders", "market_trader_counts", "market_volume_hourly")
+    def _run_prune(self, older_than):
+        self._last_pruned = self.manifold_db.prune_bets(older_than)
+        with self._stats_lock:
+            self._stats["pruned_bets"] += self._last_pruned
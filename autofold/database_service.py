@@ -0,0 +1,372 @@
+import argparse
+import concurrent.futures
+import itertools
+import os
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from loguru import logger
+
+from autofold.database import ManifoldDatabase
+from autofold.database import ManifoldDatabaseWriter
+from autofold.database import ManifoldDatabaseMaintainer
+from autofold.database import StatementRecordingError
+from autofold.database import WRITE_PRIORITY_NORMAL
+from autofold.database import WriteQueueFull
+from autofold.database import writes_tables
+
+'''
+Protocol
+
+Messages are pickled tuples sent over a ``multiprocessing.connection`` Unix socket.
+
+Client to service:
+- ``("statements", request_id, priority, block, timeout, tables, statements)``: Replay statements recorded by ``ManifoldDatabase.record_statements``.
+- ``("call", request_id, priority, block, timeout, name, data)``: Run the write function ``name`` of the service's ManifoldDatabase on ``data``.
+
+``block`` and ``timeout`` override how the service queues the write on a full lane; None blocks without a time limit.
+
+Service to client:
+- ``("queued", request_id, None)`` once the write is queued, only if ``block`` or ``timeout`` was given.
+- ``("result", request_id, result)`` or ``("error", request_id, exception)`` once the write has been committed, ``result`` is the return value of a called
+  write function (``upsert_with_changes`` returns the changes) and None for replayed statements.
+- ``("changed", None, tables)`` to every client after every write, so that their query caches stay coherent.
+'''
+
+
+class ManifoldDatabaseWriterService:
+    '''
+    Standalone writer for a manifold database shared by several processes on one host.
+
+    The service owns the only ``ManifoldDatabaseWriter`` (and ``ManifoldDatabaseMaintainer``) of the database and accepts write operations
+    from ``ManifoldDatabaseWriterClient`` instances over a Unix socket. Clients encode the rows in their own process, the service only executes
+    the recorded statements, so row preparation scales with the number of client processes instead of being bound by one GIL.
+
+    **Example**
+
+    .. code-block:: bash
+
+        python -m autofold.database_service --db manifold_database.db --socket /tmp/autofold_writer.sock
+
+    :param str db_path: Required. The path to the SQLite3 database file.
+    :param str socket_path: Required. The path of the Unix socket to listen on.
+    :param bytes authkey: Optional. Shared secret clients must present. Default is None (the socket is only accessible to the current user).
+    :param bool maintenance: Optional. Whether to run a ManifoldDatabaseMaintainer. Default is True.
+    :param str bet_partition_period: Optional. See ``ManifoldDatabase``. Clients must use the same partitioning.
+    :param int metrics_from_partitions: Optional. See ``ManifoldDatabase``. Clients must use the same partitioning.
+    :param writer_kwargs: Optional. Passed to the ManifoldDatabaseWriter (queue bounds and full policy).
+    '''
+    def __init__(self, db_path, socket_path, authkey=None, maintenance=True, bet_partition_period=None, metrics_from_partitions=0, **writer_kwargs):
+        self.db_path = db_path
+        self.bet_partition_period = bet_partition_period
+        self.metrics_from_partitions = metrics_from_partitions
+        self.socket_path = socket_path
+        self.authkey = authkey
+        self.maintenance = maintenance
+        self.writer_kwargs = writer_kwargs
+
+        self.manifold_db = None
+        self.manifold_db_writer = None
+        self.manifold_db_maintainer = None
+
+        self._listener = None
+        self._connections = {}
+        self._connections_lock = threading.Lock()
+        self.shutdown_flag = threading.Event()
+
+    def serve_forever(self):
+        """
+        Opens the database and serves clients until ``shutdown`` is called.
+
+        .. note::
+            This function is blocking.
+        """
+        self.manifold_db = ManifoldDatabase(self.db_path, bet_partition_period=self.bet_partition_period,
+                                            metrics_from_partitions=self.metrics_from_partitions)
+        self.manifold_db.create_tables()
+        self.manifold_db.add_change_listener(self._broadcast_changes)
+        self.manifold_db_writer = ManifoldDatabaseWriter(self.manifold_db, **self.writer_kwargs)
+        if self.maintenance:
+            self.manifold_db_maintainer = ManifoldDatabaseMaintainer(self.manifold_db, self.manifold_db_writer)
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        # Create the socket accessible to the current user only, so that no one else can connect between bind and chmod
+        umask = os.umask(0o077)
+        try:
+            self._listener = Listener(self.socket_path, family="AF_UNIX", authkey=self.authkey)
+        finally:
+            os.umask(umask)
+        logger.info(f"Manifold database writer service listening on {self.socket_path}")
+
+        try:
+            while not self.shutdown_flag.is_set():
+                try:
+                    conn = self._listener.accept()
+                except (OSError, EOFError) as e:
+                    if not self.shutdown_flag.is_set():
+                        logger.error(f"Failed to accept writer client: {e}")
+                    continue
+                threading.Thread(target=self._serve_client, args=(conn,), name="MF_DB_SERVICE_CLIENT", daemon=True).start()
+        finally:
+            self._close()
+
+    def start(self):
+        """
+        Runs ``serve_forever`` in a background thread.
+        """
+        self.thread = threading.Thread(target=self.serve_forever, name="MF_DB_SERVICE", daemon=True)
+        self.thread.start()
+
+    def shutdown(self):
+        logger.debug("Shutting down manifold database writer service")
+        self.shutdown_flag.set()
+        if self._listener:
+            # Unblock accept()
+            try:
+                Client(self.socket_path, family="AF_UNIX", authkey=self.authkey).close()
+            except OSError:
+                pass
+
+    def _close(self):
+        self._listener.close()
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        if self.manifold_db_maintainer:
+            self.manifold_db_maintainer.shutdown()
+        self.manifold_db_writer.shutdown()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def _send(self, conn, message):
+        with self._connections_lock:
+            lock = self._connections.get(conn)
+        if lock is None:
+            return
+        try:
+            with lock:
+                conn.send(message)
+        except (OSError, ValueError) as e:
+            logger.debug(f"Dropping writer client: {e}")
+
+    def _broadcast_changes(self, tables):
+        with self._connections_lock:
+            connections = list(self._connections)
+        for conn in connections:
+            self._send(conn, ("changed", None, tables))
+
+    def _serve_client(self, conn):
+        with self._connections_lock:
+            self._connections[conn] = threading.Lock()
+        try:
+            while not self.shutdown_flag.is_set():
+                try:
+                    if not conn.poll(1):
+                        continue
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    break
+                self._handle(conn, message)
+        finally:
+            with self._connections_lock:
+                self._connections.pop(conn, None)
+            conn.close()
+
+    def _handle(self, conn, message):
+        kind, request_id, priority, block, timeout = message[:5]
+        try:
+            if kind == "statements":
+                tables, data = message[5:]
+
+                def execute_statements(statements):
+                    self.manifold_db.execute_statements(statements)
+                function = writes_tables(*tables)(execute_statements) if tables is not None else execute_statements
+            elif kind == "call":
+                name, data = message[5:]
+                function = getattr(self.manifold_db, name, None)
+                if not hasattr(function, "tables"):
+                    raise ValueError(f"{name} is not a ManifoldDatabase write function")
+            else:
+                raise ValueError(f"Unknown message {kind}")
+
+            # Blocks while the writer's lane is full, which in turn stops reading from this client
+            future = self.manifold_db_writer.queue_write_operation(function=function, data=data, priority=priority,
+                                                                   block=True if block is None else block, timeout=timeout)
+        except Exception as e:
+            self._send(conn, ("error", request_id, e))
+            return
+        if block is not None or timeout is not None:
+            self._send(conn, ("queued", request_id, None))
+
+        def reply(future):
+            exception = future.exception()
+            if exception is None:
+                result = future.result()
+                self._send(conn, ("result", request_id, None if result is True else result))
+            else:
+                self._send(conn, ("error", request_id, exception))
+        future.add_done_callback(reply)
+
+
+class ManifoldDatabaseWriterClient:
+    '''
+    Drop-in replacement for ``ManifoldDatabaseWriter`` that sends write operations to a ``ManifoldDatabaseWriterService``.
+
+    Write functions are run locally against a recording connection (see ``ManifoldDatabase.record_statements``), so rows are encoded in
+    the calling process and only the resulting statements are sent. Write functions that read from the database are executed by the service instead.
+    Table change notifications of every client's writes are forwarded to ``manifold_db``'s change listeners, keeping query caches coherent across processes.
+
+    :param ManifoldDatabase manifold_db: Required. This process's ManifoldDatabase instance of the shared database.
+    :param str socket_path: Required. The Unix socket of the writer service.
+    :param bytes authkey: Optional. The service's shared secret.
+    '''
+    def __init__(self, manifold_db, socket_path, authkey=None):
+        self.manifold_db = manifold_db
+        self.socket_path = socket_path
+        self.last_write_time = 0
+        self._conn = Client(socket_path, family="AF_UNIX", authkey=authkey)
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._request_ids = itertools.count()
+        self.shutdown_flag = threading.Event()
+        self.worker_thread = threading.Thread(target=self._receive_thread, name="MF_DB_CLIENT", daemon=True)
+        self.worker_thread.start()
+
+    def is_alive(self):
+        """
+        Checks if the connection to the writer service is open.
+
+        :rtype: bool
+        """
+        return self.worker_thread.is_alive()
+
+    def _receive_thread(self):
+        while not self.shutdown_flag.is_set():
+            try:
+                if not self._conn.poll(1):
+                    continue
+                kind, request_id, payload = self._conn.recv()
+            except (EOFError, OSError):
+                break
+
+            if kind == "changed":
+                self.manifold_db.notify_tables_changed(payload)
+                continue
+
+            with self._pending_lock:
+                if kind == "queued":
+                    queued = self._pending.get(request_id, (None, None))[1]
+                    if queued is not None:
+                        queued.set_result(True)
+                    continue
+                future, queued = self._pending.pop(request_id, (None, None))
+            if future is None:
+                continue
+            if queued is not None and not queued.done():
+                # Rejected before it was queued
+                queued.set_exception(payload)
+            self.last_write_time = time.time()
+            if kind == "result":
+                future.set_result(True if payload is None else payload)
+            else:
+                future.set_exception(payload)
+
+        # Fail everything still waiting for the service
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for future, queued in pending.values():
+            exception = ConnectionError("Lost connection to the manifold database writer service")
+            if queued is not None and not queued.done():
+                queued.set_exception(exception)
+            future.set_exception(exception)
+
+    def shutdown(self):
+        logger.debug("Shutting down manifold database writer client")
+        self.shutdown_flag.set()
+        self.worker_thread.join()
+        self._conn.close()
+
+    def queue_write_operation(self, function, data, priority=WRITE_PRIORITY_NORMAL, block=None, timeout=None):
+        """
+        Queue a write operation on the writer service.
+
+        :param function: The function to execute (a write function of ``manifold_db``).
+        :param data: The data to write.
+        :param int priority: Optional. The priority lane of the operation (see ``ManifoldDatabaseWriter``).
+        :param bool block: Optional. True to wait while the service's lane of ``priority`` is full, False to fail. By default the
+            operation is sent without waiting for the service to queue it, and the service blocks until its lane has room.
+        :param float timeout: Optional. The maximum number of seconds the service waits for room in the lane.
+        :raises WriteQueueFull: If ``block`` or ``timeout`` is given and the service could not queue the operation.
+        :raises ConnectionError: If the connection to the service is closed.
+        :return: Future object representing the execution of the operations, resolved with the function's result (True if it returns None).
+        """
+        if isinstance(data, list):
+            logger.debug(f"Sending write operation {function.__name__} with {len(data)} data items")
+        else:
+            logger.debug(f"Sending write operation {function.__name__}")
+
+        message = ("call", function.__name__, data)
+        if getattr(function, "__self__", None) is self.manifold_db:
+            try:
+                message = ("statements", getattr(function, "tables", None), self.manifold_db.record_statements(function, data))
+            except StatementRecordingError:
+                pass
+
+        future = concurrent.futures.Future()
+        # Resolved once the service has queued the operation, when the caller waits for that
+        queued = concurrent.futures.Future() if block is not None or timeout is not None else None
+        request_id = next(self._request_ids)
+        with self._pending_lock:
+            self._pending[request_id] = (future, queued)
+        try:
+            with self._send_lock:
+                self._conn.send((message[0], request_id, priority, block, timeout, *message[1:]))
+        except (OSError, ValueError) as e:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            raise ConnectionError(f"Lost connection to the manifold database writer service: {e}")
+
+        if queued is not None:
+            try:
+                queued.result()
+            except WriteQueueFull:
+                logger.warning(f"Write queue full, rejected write operation {function.__name__}")
+                raise
+        return future
+
+    def is_idle(self, idle_time):
+        """
+        Checks if no write of this client is pending and none completed in the last ``idle_time`` seconds.
+
+        :param float idle_time: Required. The number of seconds without writes.
+        :rtype: bool
+        """
+        with self._pending_lock:
+            pending = len(self._pending)
+        return pending == 0 and time.time() - self.last_write_time >= idle_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manifold database writer service")
+    parser.add_argument("--db", required=True, help="Path to the manifold database")
+    parser.add_argument("--socket", required=True, help="Path of the Unix socket to listen on")
+    parser.add_argument("--authkey", default=None, help="Shared secret clients must present")
+    parser.add_argument("--no-maintenance", action="store_true", help="Do not run periodic database maintenance")
+    parser.add_argument("--bet-partition-period", choices=["year", "month"], default=None, help="Partition bets by year or month")
+    parser.add_argument("--metrics-from-partitions", type=int, default=0, help="Number of contract_metrics_from hash partitions")
+    args = parser.parse_args()
+
+    service = ManifoldDatabaseWriterService(args.db, args.socket, authkey=args.authkey.encode() if args.authkey else None,
+                                            maintenance=not args.no_maintenance, bet_partition_period=args.bet_partition_period,
+                                            metrics_from_partitions=args.metrics_from_partitions)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        service.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import NamedTuple
+from loguru import logger
+
+
+MARKETS = "markets"
+BETS = "bets"
+POSITIONS = "positions"
+USERS = "users"
+
+
+class MarketEvent(NamedTuple):
+    '''
+    A market was retrieved. ``market`` is the market in the API's format.
+    '''
+    market_id: str
+    market: dict
+    time: float
+
+    topic = MARKETS
+
+    @classmethod
+    def from_row(cls, market, time):
+        return cls(market["id"], market, time)
+
+    @property
+    def key(self):
+        return self.market_id
+
+    @property
+    def filter_key(self):
+        return self.market_id
+
+
+class BetEvent(NamedTuple):
+    '''
+    A bet was retrieved. ``bet`` is the bet in the API's format.
+    '''
+    bet_id: str
+    contract_id: str
+    user_id: str
+    bet: dict
+    time: float
+
+    topic = BETS
+
+    @classmethod
+    def from_row(cls, bet, time):
+        return cls(bet["id"], bet.get("contractId"), bet.get("userId"), bet, time)
+
+    @property
+    def key(self):
+        return self.bet_id
+
+    @property
+    def filter_key(self):
+        return self.contract_id
+
+
+class PositionEvent(NamedTuple):
+    '''
+    A position (contract metric) of a user in a market was retrieved. ``position`` is the position in the API's format.
+    '''
+    contract_id: str
+    user_id: str
+    position: dict
+    time: float
+
+    topic = POSITIONS
+
+    @classmethod
+    def from_row(cls, position, time):
+        return cls(position.get("contractId"), position.get("userId"), position, time)
+
+    @property
+    def key(self):
+        return (self.contract_id, self.user_id)
+
+    @property
+    def filter_key(self):
+        return self.contract_id
+
+
+class UserEvent(NamedTuple):
+    '''
+    A user was retrieved. ``user`` is the user in the API's format.
+    '''
+    user_id: str
+    user: dict
+    time: float
+
+    topic = USERS
+
+    @classmethod
+    def from_row(cls, user, time):
+        return cls(user["id"], user, time)
+
+    @property
+    def key(self):
+        return self.user_id
+
+    @property
+    def filter_key(self):
+        return self.user_id
+
+
+EVENT_TYPES = {event_type.topic: event_type for event_type in (MarketEvent, BetEvent, PositionEvent, UserEvent)}
+
+
+class EventSubscription:
+    '''
+    A bounded queue of the events of an ``EventBus`` subscription, consumed by one automation.
+
+    When the queue is full, the ``policy`` decides which event is lost:
+
+    - ``coalesce``: Events of the same market, bet, position or user replace the queued one in place, so a slow consumer only sees the latest state
+      of each. When the queue holds ``max_queue`` different keys, the oldest is dropped.
+    - ``drop_oldest``: The oldest queued event is dropped.
+    - ``drop_newest``: The new event is dropped.
+
+    :param EventBus bus: Required. The bus the subscription belongs to.
+    :param list[str] topics: Required. The topics.
+    :param set keys: Optional. The market IDs (market, bet and position events) or user IDs (user events) to receive events of. Default is None (all events).
+    :param int max_queue: Optional. The maximum number of queued events. Default is 1000.
+    :param str policy: Optional. ``coalesce``, ``drop_oldest`` or ``drop_newest``. Default is coalesce.
+    '''
+    POLICIES = ("coalesce", "drop_oldest", "drop_newest")
+
+    def __init__(self, bus, topics, keys=None, max_queue=1000, policy="coalesce"):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown event subscription policy {policy}")
+        self.bus = bus
+        self.topics = tuple(topics)
+        self.keys = frozenset(keys) if keys is not None else None
+        self.max_queue = max_queue
+        self.policy = policy
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self._queue = OrderedDict() if policy == "coalesce" else deque()
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def _offer(self, events):
+        # Called by the publishing thread
+        with self._condition:
+            for event in events:
+                if self.policy == "coalesce":
+                    key = (event.topic, event.key)
+                    if key in self._queue:
+                        self._queue[key] = event
+                        self.coalesced += 1
+                        continue
+                    if len(self._queue) >= self.max_queue:
+                        self._queue.popitem(last=False)
+                        self.dropped += 1
+                    self._queue[key] = event
+                elif len(self._queue) < self.max_queue:
+                    self._queue.append(event)
+                elif self.policy == "drop_oldest":
+                    self._queue.popleft()
+                    self._queue.append(event)
+                    self.dropped += 1
+                else:
+                    self.dropped += 1
+            self._condition.notify()
+
+    def _pop(self):
+        return self._queue.popitem(last=False)[1] if self.policy == "coalesce" else self._queue.popleft()
+
+    def get(self, timeout=None):
+        """
+        Waits for the next event.
+
+        :param float timeout: Optional. The maximum number of seconds to wait. Default is None (wait until an event arrives).
+        :return: The event, or None if the timeout expired.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._queue, timeout=timeout):
+                return None
+            self.delivered += 1
+            return self._pop()
+
+    def get_batch(self, max_events=None, timeout=None):
+        """
+        Waits for events and returns all queued events at once.
+
+        **Example**
+
+        .. code-block:: python
+
+            while self.running:
+                for event in subscription.get_batch(timeout=1):
+                    ...
+
+        :param int max_events: Optional. The maximum number of events returned. Default is None (all queued events).
+        :param float timeout: Optional. The maximum number of seconds to wait for the first event. Default is None (wait until an event arrives).
+        :return: The events, oldest first. Empty if the timeout expired.
+        :rtype: list
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._queue, timeout=timeout):
+                return []
+            count = len(self._queue) if max_events is None else min(max_events, len(self._queue))
+            self.delivered += count
+            return [self._pop() for _ in range(count)]
+
+    def close(self):
+        """
+        Stops the subscription. Queued events can still be read.
+        """
+        self.bus.unsubscribe(self)
+
+    def stats(self):
+        """
+        :return: The ``topics``, ``queued``, ``delivered``, ``coalesced`` and ``dropped`` events of the subscription.
+        :rtype: dict
+        """
+        with self._condition:
+            return {"topics": self.topics, "queued": len(self._queue), "delivered": self.delivered,
+                    "coalesced": self.coalesced, "dropped": self.dropped}
+
+
+class EventBus:
+    '''
+    In-process publish/subscribe bus for the data retrieved by the ``ManifoldSubscriber``, shared by every automation of a bot.
+
+    The subscriber publishes every market, bet, position and user it retrieves (after it is written to the database) as a typed event
+    (``MarketEvent``, ``BetEvent``, ``PositionEvent``, ``UserEvent``) on the ``markets``, ``bets``, ``positions`` or ``users`` topic.
+    Each subscription has its own bounded queue (see ``EventSubscription``), so any number of automations receive the same events
+    without querying the database, and a slow automation only loses its own events.
+
+    Subscriptions are indexed by topic and key, so publishing a batch costs one dict lookup per event however many subscriptions filter on keys.
+    Topics without subscriptions cost nothing, publishers check ``has_subscribers`` before building events.
+
+    **Example**
+
+    .. code-block:: python
+
+        subscription = event_bus.subscribe([BETS], keys=[market_id])
+        manifold_subscriber.subscribe_to_bets(None, None, market_id, None, polling_time=5, callback=None)
+        while self.running:
+            for event in subscription.get_batch(timeout=1):
+                logger.info(f"Bet {event.bet_id} of {event.user_id}: {event.bet['amount']}")
+    '''
+    def __init__(self):
+        # Per topic: subscriptions to every event, and subscriptions by filter key. Replaced rather than modified, so publishing takes no lock.
+        self._topics = {topic: ((), {}) for topic in EVENT_TYPES}
+        self._lock = threading.Lock()
+
+    def subscribe(self, topics, keys=None, max_queue=1000, policy="coalesce"):
+        """
+        Subscribes to topics.
+
+        :param list[str] topics: Required. The topics: ``markets``, ``bets``, ``positions`` and/or ``users``.
+        :param list[str] keys: Optional. Only receive events of these market IDs (market, bet and position events) or user IDs (user events). Default is None (all events).
+        :param int max_queue: Optional. The maximum number of queued events. Default is 1000.
+        :param str policy: Optional. What to do when the queue is full: ``coalesce``, ``drop_oldest`` or ``drop_newest`` (see ``EventSubscription``). Default is coalesce.
+        :return: The subscription.
+        :rtype: EventSubscription
+        """
+        for topic in topics:
+            if topic not in EVENT_TYPES:
+                raise ValueError(f"Unknown topic {topic}")
+        subscription = EventSubscription(self, topics, keys=keys, max_queue=max_queue, policy=policy)
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers, by_key = self._topics[topic]
+                if subscription.keys is None:
+                    subscribers = subscribers + (subscription,)
+                else:
+                    by_key = dict(by_key)
+                    for key in subscription.keys:
+                        by_key[key] = by_key.get(key, ()) + (subscription,)
+                self._topics[topic] = (subscribers, by_key)
+        logger.debug(f"Event subscription to {', '.join(subscription.topics)} with policy {policy}")
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Removes a subscription.
+
+        :param EventSubscription subscription: Required. The subscription.
+        """
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers, by_key = self._topics[topic]
+                subscribers = tuple(other for other in subscribers if other is not subscription)
+                if subscription.keys is not None:
+                    by_key = dict(by_key)
+                    for key in subscription.keys:
+                        remaining = tuple(other for other in by_key.get(key, ()) if other is not subscription)
+                        if remaining:
+                            by_key[key] = remaining
+                        else:
+                            by_key.pop(key, None)
+                self._topics[topic] = (subscribers, by_key)
+
+    def has_subscribers(self, topic):
+        """
+        :param str topic: Required. The topic.
+        :rtype: bool
+        """
+        subscribers, by_key = self._topics[topic]
+        return bool(subscribers or by_key)
+
+    def publish(self, events):
+        """
+        Delivers events of one topic to their subscriptions.
+
+        :param list events: Required. Events of the same type.
+        """
+        if not events:
+            return
+        subscribers, by_key = self._topics[events[0].topic]
+        for subscription in subscribers:
+            subscription._offer(events)
+        if by_key:
+            deliveries = {}
+            for event in events:
+                for subscription in by_key.get(event.filter_key, ()):
+                    deliveries.setdefault(subscription, []).append(event)
+            for subscription, subscription_events in deliveries.items():
+                subscription._offer(subscription_events)
+
+    def publish_rows(self, topic, rows):
+        """
+        Publishes rows in the API's format as events of a topic, if the topic has subscriptions.
+
+        :param str topic: Required. The topic.
+        :param list[dict] rows: Required. The markets, bets, positions or users.
+        """
+        if not rows or not self.has_subscribers(topic):
+            return
+        event_type = EVENT_TYPES[topic]
+        now = time.time()
+        self.publish([event_type.from_row(row, now) for row in rows])
+
+    def stats(self):
+        """
+        :return: The statistics of every subscription (see ``EventSubscription.stats``).
+        :rtype: list[dict]
+        """
+        with self._lock:
+            subscriptions = {}
+            for subscribers, by_key in self._topics.values():
+                for subscription in subscribers:
+                    subscriptions[id(subscription)] = subscription
+                for key_subscribers in by_key.values():
+                    for subscription in key_subscribers:
+                        subscriptions[id(subscription)] = subscription
+        return [subscription.stats() for subscription in subscriptions.values()]
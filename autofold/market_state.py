@@ -0,0 +1,207 @@
+import threading
+import time
+from collections import defaultdict
+from typing import NamedTuple, Optional
+from loguru import logger
+
+
+class MarketState(NamedTuple):
+    '''
+    Immutable snapshot of the live state of one market. Multiple choice markets have no ``probability``, ``p`` or pools;
+    their ``answers`` are tuples of ``(answerIndex, text, probability)``.
+    '''
+    id: str
+    outcomeType: Optional[str]
+    probability: Optional[float]
+    p: Optional[float]
+    pool_YES: Optional[float]
+    pool_NO: Optional[float]
+    totalLiquidity: Optional[float]
+    volume: Optional[float]
+    volume24Hours: Optional[float]
+    isResolved: bool
+    closeTime: Optional[int]
+    lastUpdatedTime: Optional[int]
+    answers: tuple
+    updated: float
+
+
+def _market_state(market, updated):
+    pool = market.get("pool") or {}
+    return MarketState(
+        id=market["id"],
+        outcomeType=market.get("outcomeType"),
+        probability=market.get("probability"),
+        p=market.get("p"),
+        pool_YES=pool.get("YES", market.get("pool_YES")),
+        pool_NO=pool.get("NO", market.get("pool_NO")),
+        totalLiquidity=market.get("totalLiquidity"),
+        volume=market.get("volume"),
+        volume24Hours=market.get("volume24Hours"),
+        isResolved=bool(market.get("isResolved")),
+        closeTime=market.get("closeTime"),
+        lastUpdatedTime=market.get("lastUpdatedTime"),
+        answers=tuple((answer.get("answerIndex"), answer.get("text"), answer.get("probability"))
+                      for answer in market.get("answers") or ()),
+        updated=updated,
+    )
+
+
+class MarketStateStore:
+    '''
+    In-memory view of the markets being watched, shared by every automation of a bot.
+
+    Each market is one immutable ``MarketState`` tuple. Writers (the ``ManifoldSubscriber``) build new tuples and swap them into the store,
+    so reads never take a lock and always see a consistent market: ``get`` is a single dict lookup.
+    The SQLite database stays the durable store: watched markets are loaded from it and every subscriber update is written to it before the store is updated.
+
+    **Example**
+
+    .. code-block:: python
+
+        manifold_subscriber.subscribe_to_market(market_id, polling_time=10, callback=on_update)
+        state = market_state_store.get(market_id)
+        if state and state.probability > 0.9:
+            ...
+
+    :param ManifoldDatabaseReader manifold_db_reader: Optional. The reader watched markets are loaded from. Default is None (markets appear after their first update).
+    '''
+    def __init__(self, manifold_db_reader=None):
+        self.manifold_db_reader = manifold_db_reader
+        self._states = {}
+        self._watched = {}  # market ID -> owners watching it
+        self._write_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, market_id):
+        return market_id in self._states
+
+    def get(self, market_id):
+        """
+        Returns the current state of a market.
+
+        :param str market_id: Required. The market ID.
+        :return: The market state, or None if the market is not in the store.
+        :rtype: MarketState
+        """
+        return self._states.get(market_id)
+
+    def snapshot(self):
+        """
+        Returns the state of every market in the store at one point in time.
+
+        :return: A dict mapping each market ID to its ``MarketState``.
+        :rtype: dict
+        """
+        return self._states.copy()
+
+    def watch(self, market_id, owner=None):
+        """
+        Keeps a market in the store, loading its last known state from the database if it is not there yet.
+
+        :param str market_id: Required. The market ID.
+        :param owner: Optional. Who watches the market, e.g. a subscription. A market stays in the store until every owner unwatched it. Default is None.
+        """
+        self.watch_markets([market_id], owner=owner)
+
+    def watch_markets(self, market_ids, owner=None):
+        """
+        Keeps markets in the store, loading the last known state of those not there yet from the database in one go.
+        Watching a market again with the same owner has no effect.
+
+        :param list[str] market_ids: Required. The market IDs.
+        :param owner: Optional. Who watches the markets, see ``watch``. Default is None.
+        """
+        with self._write_lock:
+            for market_id in market_ids:
+                self._watched.setdefault(market_id, set()).add(owner)
+        self.load([market_id for market_id in market_ids if market_id not in self._states])
+
+    def unwatch(self, market_id, owner=None):
+        """
+        Stops watching a market for ``owner``. Once no owner watches it, the market's state is dropped.
+
+        :param str market_id: Required. The market ID.
+        :param owner: Optional. The owner passed to ``watch``. Default is None.
+        """
+        self.unwatch_markets([market_id], owner=owner)
+
+    def unwatch_markets(self, market_ids, owner=None):
+        """
+        Stops watching markets for ``owner``. The state of markets no other owner watches is dropped.
+
+        :param list[str] market_ids: Required. The market IDs.
+        :param owner: Optional. The owner passed to ``watch_markets``. Default is None.
+        """
+        with self._write_lock:
+            for market_id in market_ids:
+                owners = self._watched.get(market_id)
+                if owners is None:
+                    continue
+                owners.discard(owner)
+                if not owners:
+                    del self._watched[market_id]
+                    self._states.pop(market_id, None)
+
+    def is_watched(self, market_id):
+        """
+        :param str market_id: Required. The market ID.
+        :rtype: bool
+        """
+        return market_id in self._watched
+
+    def update_markets(self, markets, watched_only=False):
+        """
+        Replaces the state of the given markets. Updates older than the stored state (by ``lastUpdatedTime``) are ignored.
+
+        :param list[dict] markets: Required. Markets in the API's (or the database's) format.
+        :param bool watched_only: Optional. Only update markets that are watched. Default is False.
+        """
+        now = time.time()
+        with self._write_lock:
+            for market in markets:
+                market_id = market.get("id")
+                if market_id is None or (watched_only and market_id not in self._watched):
+                    continue
+                current = self._states.get(market_id)
+                if current is not None and (current.lastUpdatedTime or 0) > (market.get("lastUpdatedTime") or 0):
+                    continue
+                # Lite markets carry no answers, keep the last known ones
+                state = _market_state(market, now)
+                if current is not None and not state.answers and current.answers:
+                    state = state._replace(answers=current.answers)
+                self._states[market_id] = state
+
+    def load(self, market_ids):
+        """
+        Loads the last known state of markets from the database.
+
+        :param list[str] market_ids: Required. The market IDs.
+        """
+        if self.manifold_db_reader is None or not market_ids:
+            return
+        market_ids = list(market_ids)
+        # Stay below SQLite's limit on the number of query parameters
+        if len(market_ids) > 500:
+            for start in range(0, len(market_ids), 500):
+                self.load(market_ids[start:start + 500])
+            return
+        placeholders = ", ".join("?" for _ in market_ids)
+        markets = self.manifold_db_reader.execute_query(
+            f"SELECT id, outcomeType, probability, p, pool_YES, pool_NO, totalLiquidity, volume, volume24Hours, isResolved, closeTime, lastUpdatedTime "
+            f"FROM binary_choice_markets WHERE id IN ({placeholders})", market_ids)
+        multiple_choice_markets = self.manifold_db_reader.execute_query(
+            f"SELECT id, outcomeType, totalLiquidity, volume, volume24Hours, isResolved, closeTime, lastUpdatedTime "
+            f"FROM multiple_choice_markets WHERE id IN ({placeholders})", market_ids)
+        if multiple_choice_markets:
+            answers = defaultdict(list)
+            for answer in self.manifold_db_reader.execute_query(
+                    f"SELECT contractId, answerIndex, text, probability FROM multiple_choice_market_answers "
+                    f"WHERE contractId IN ({placeholders}) ORDER BY answerIndex", market_ids):
+                answers[answer["contractId"]].append(answer)
+            # Query results may be shared by the reader's cache, so they are copied rather than modified
+            multiple_choice_markets = [dict(market, answers=answers[market["id"]]) for market in multiple_choice_markets]
+        logger.debug(f"Loaded {len(markets) + len(multiple_choice_markets)} of {len(market_ids)} markets into the market state store")
+        self.update_markets(markets + multiple_choice_markets)
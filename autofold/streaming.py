@@ -0,0 +1,312 @@
+from abc import ABC, abstractmethod
+import json
+import socket
+import socketserver
+import threading
+import time
+from loguru import logger
+from autofold.event_bus import MARKETS, BETS, POSITIONS, USERS
+
+
+class StreamSource(ABC):
+    '''
+    Base class of live data sources for the ``ManifoldSubscriber``. A source pushes markets, bets, positions and users as they change,
+    and the subscriber writes them to the database and delivers them to callbacks and the event bus like polled data.
+
+    The source runs on its own thread and reconnects with exponential backoff. While it is connected the subscriber polls the
+    streamed topics less often (polls only reconcile what the stream missed). While it is disconnected, polling takes over again.
+    A message that cannot be parsed or processed is logged, counted in ``errors`` and skipped.
+
+    Subclasses implement ``_open``, ``_receive`` and ``_close``, and may override ``parse`` to translate the messages of their feed.
+
+    :param list[str] topics: Optional. The topics the source streams. Default is all of ``markets``, ``bets``, ``positions`` and ``users``.
+    :param float reconnect_delay: Optional. Seconds before the first reconnection attempt, doubled after every failed attempt. Default is 1.
+    :param float max_reconnect_delay: Optional. The maximum number of seconds between reconnection attempts. Default is 60.
+    '''
+    def __init__(self, topics=None, reconnect_delay=1, max_reconnect_delay=60):
+        self.topics = tuple(topics) if topics is not None else (MARKETS, BETS, POSITIONS, USERS)
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.connected = False
+        self.messages = 0
+        self.errors = 0
+        self._stop_event = threading.Event()
+        self._connection = None
+        self._thread = None
+
+    def start(self, on_rows, on_state):
+        """
+        Starts receiving.
+
+        :param function on_rows: Required. Called for every message with a topic, a list of rows in the API's format and the UNIX time
+            the message was published (the time it was received if the feed does not tell).
+        :param function on_state: Required. Called with True when the source connects and False when it disconnects.
+        """
+        self._on_rows = on_rows
+        self._on_state = on_state
+        self._thread = threading.Thread(target=self._run, name="MF_STREAM", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops receiving and closes the connection.
+        """
+        self._stop_event.set()
+        connection = self._connection
+        if connection is not None:
+            try:
+                self._close(connection)
+            except Exception:
+                pass
+        if self._thread is not None:
+            self._thread.join()
+
+    def parse(self, message):
+        """
+        Translates a message of the feed. The default format is JSON: ``{"topic": "bets", "rows": [...], "time": 1700000000.0}``,
+        ``time`` being the optional UNIX time the message was published.
+
+        :param message: Required. The message as received.
+        :return: The topic, the rows and optionally the publish time, or None to ignore the message.
+        :rtype: tuple
+        """
+        message = json.loads(message)
+        return message["topic"], message["rows"], message.get("time")
+
+    @abstractmethod
+    def _open(self):
+        # Returns the connection
+        pass
+
+    @abstractmethod
+    def _receive(self, connection):
+        # Returns the next message, or None once the connection is closed
+        pass
+
+    @abstractmethod
+    def _close(self, connection):
+        pass
+
+    def _run(self):
+        delay = self.reconnect_delay
+        while not self._stop_event.is_set():
+            try:
+                self._connection = self._open()
+                self.connected = True
+                delay = self.reconnect_delay
+                logger.info(f"{type(self).__name__} connected")
+                self._on_state(True)
+                while not self._stop_event.is_set():
+                    message = self._receive(self._connection)
+                    if message is None:
+                        break
+                    received_time = time.time()
+                    # A bad message must not drop the connection
+                    try:
+                        parsed = self.parse(message)
+                        if parsed is None:
+                            continue
+                        topic, rows, *published_time = parsed
+                        self.messages += 1
+                        if topic in self.topics and rows:
+                            self._on_rows(topic, rows, published_time[0] if published_time and published_time[0] is not None else received_time)
+                    except Exception as e:
+                        self.errors += 1
+                        logger.error(f"{type(self).__name__} skipped a message it could not process: {e}")
+            except Exception as e:
+                if not self._stop_event.is_set():
+                    logger.warning(f"{type(self).__name__} failed: {e}")
+            finally:
+                if self._connection is not None:
+                    try:
+                        self._close(self._connection)
+                    except Exception:
+                        pass
+                    self._connection = None
+                if self.connected:
+                    self.connected = False
+                    logger.info(f"{type(self).__name__} disconnected")
+                    self._on_state(False)
+            if self._stop_event.wait(delay):
+                break
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+
+class JsonLinesStreamSource(StreamSource):
+    '''
+    Receives newline-delimited JSON messages over a TCP connection, for example from a ``LocalFeedServer``.
+
+    :param str host: Required. The host of the feed.
+    :param int port: Required. The port of the feed.
+    :param kwargs: Optional. The parameters of ``StreamSource``.
+    '''
+    def __init__(self, host, port, **kwargs):
+        super().__init__(**kwargs)
+        self.host = host
+        self.port = port
+
+    def _open(self):
+        connection = socket.create_connection((self.host, self.port))
+        return connection, connection.makefile("r", encoding="utf-8")
+
+    def _receive(self, connection):
+        line = connection[1].readline()
+        return line if line else None
+
+    def _close(self, connection):
+        try:
+            connection[0].shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        connection[0].close()
+
+
+class WebSocketStreamSource(StreamSource):
+    '''
+    Receives messages from a websocket, such as a realtime database feed. Use ``parse`` to translate the feed's messages into topics and rows.
+
+    Requires the optional ``websocket-client`` dependency.
+
+    **Example**
+
+    .. code-block:: python
+
+        def parse(message):
+            message = json.loads(message)
+            if message.get("event") != "INSERT":
+                return None
+            return "bets", [message["payload"]["record"]["data"]]
+
+        stream_source = WebSocketStreamSource(url, subscribe_messages=[json.dumps(join_message)], parse=parse, topics=["bets"])
+
+    :param str url: Required. The websocket URL.
+    :param list[str] subscribe_messages: Optional. Messages sent after connecting. Default is None.
+    :param dict headers: Optional. HTTP headers of the handshake. Default is None.
+    :param function parse: Optional. Replaces ``parse``. Default is None (JSON ``{"topic": ..., "rows": [...]}`` messages).
+    :param kwargs: Optional. The parameters of ``StreamSource``.
+    '''
+    def __init__(self, url, subscribe_messages=None, headers=None, parse=None, **kwargs):
+        super().__init__(**kwargs)
+        self.url = url
+        self.subscribe_messages = subscribe_messages or []
+        self.headers = headers or {}
+        if parse is not None:
+            self.parse = parse
+        self._websocket = _import_websocket()
+
+    def _open(self):
+        connection = self._websocket.create_connection(self.url, header=[f"{name}: {value}" for name, value in self.headers.items()])
+        for message in self.subscribe_messages:
+            connection.send(message)
+        return connection
+
+    def _receive(self, connection):
+        try:
+            return connection.recv() or None
+        except self._websocket.WebSocketConnectionClosedException:
+            return None
+
+    def _close(self, connection):
+        connection.close()
+
+
+def _import_websocket():
+    try:
+        import websocket
+    except ImportError:
+        raise ImportError("WebSocketStreamSource requires websocket-client. Install it with: pip install autofold[streaming]")
+    return websocket
+
+
+class LocalFeedServer:
+    '''
+    Stand-in for a live feed, for testing streaming ingestion and measuring its latency without the real service.
+    Serves newline-delimited JSON messages to every connected ``JsonLinesStreamSource``.
+
+    **Example**
+
+    .. code-block:: python
+
+        feed = LocalFeedServer()
+        feed.start()
+        subscriber = ManifoldSubscriber(api, db, writer, stream_source=JsonLinesStreamSource(*feed.address))
+        feed.publish("bets", [bet])
+
+    :param str host: Optional. The host to listen on. Default is 127.0.0.1.
+    :param int port: Optional. The port to listen on. Default is 0 (any free port).
+    '''
+    def __init__(self, host="127.0.0.1", port=0):
+        self._clients = set()
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                with server._lock:
+                    server._clients.add(self.request)
+                # Wait until the client disconnects, messages are sent by publish
+                try:
+                    while self.request.recv(1024):
+                        pass
+                except OSError:
+                    pass
+                finally:
+                    with server._lock:
+                        server._clients.discard(self.request)
+
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="MF_FEED_SERVER", daemon=True)
+
+    @property
+    def address(self):
+        """
+        The ``(host, port)`` the server listens on.
+        """
+        return self._server.server_address
+
+    @property
+    def clients(self):
+        """
+        The number of connected clients.
+        """
+        with self._lock:
+            return len(self._clients)
+
+    def start(self):
+        self._thread.start()
+
+    def shutdown(self):
+        self.disconnect_clients()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def publish(self, topic, rows):
+        """
+        Sends rows to every connected client.
+
+        :param str topic: Required. The topic.
+        :param list[dict] rows: Required. The rows in the API's format.
+        """
+        message = (json.dumps({"topic": topic, "rows": rows, "time": time.time()}) + "\n").encode("utf-8")
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.sendall(message)
+            except OSError:
+                with self._lock:
+                    self._clients.discard(client)
+
+    def disconnect_clients(self):
+        """
+        Drops every connection, for testing the fallback to polling.
+        """
+        with self._lock:
+            clients = list(self._clients)
+            self._clients.clear()
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
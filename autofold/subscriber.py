@@ -1,13 +1,25 @@
+import json
+import sys
 import time
+import traceback
 import threading
+import heapq
+import itertools
+import math
+import random
 from concurrent.futures import ThreadPoolExecutor, Future
-from queue import Queue, Full
+from queue import Queue, Full, Empty
 from loguru import logger
-from collections import defaultdict
+from collections import Counter, defaultdict, deque
 from typing import List, Callable, Dict, DefaultDict
 from autofold.api import ManifoldAPI
+from autofold.api import READS_PER_SECOND
 from autofold.database import ManifoldDatabase
 from autofold.database import ManifoldDatabaseWriter
+from autofold.database import ChangeEvent
+from autofold.market_state import MarketStateStore
+from autofold.event_bus import EventBus, MARKETS, BETS, POSITIONS, USERS
+from autofold.streaming import StreamSource
 from typing import Callable, List, Any, Union
 from concurrent.futures import Future
 
@@ -29,7 +41,8 @@ class JobAction(Enum):
     
 class Job:
 	def __init__(self, action: str, function: Callable, params: Any,
-				 job_type: str, callbacks: list[dict] = None, future: Union[None, Future] = None):
+				 job_type: str = None, callbacks: list[dict] = None, future: Union[None, Future] = None,
+				 max_interval: float = None, activity_fields: list[str] = None):
 		self.action = action  # JobAction.ADD or JobAction.REMOVE
 		self.status = JobStatus.PENDING # The current status of the job (pending, executing, finished) 
 		self.function = function  # Function responsible for the task
@@ -40,6 +53,19 @@ class Job:
 		self.last_execution_time = 0  # Timestamp of the last update
 		self.next_execution_time = None  # When the job is set to be executed next
 		self.update_interval = None if len(self.callbacks) == 0 else min(cb['polling_time'] for cb in self.callbacks)    # Derived from min polling_times of callbacks
+		self.timer = None  # Sequence number of the job's entry in the scheduler's timer heap
+		self.due_time = None  # When the timer of the job's current execution was due
+		self.phase = None  # (interval group, slot, offset as a fraction of the interval) of an interval job's executions
+		self.cursor = None  # Sync cursor of incremental jobs, the ID of the newest item retrieved
+		self.full_sync_time = 0  # Timestamp of the last execution that retrieved all data rather than only new data
+		self.activity_fields = activity_fields if activity_fields else []  # Fields whose changes count as activity for adaptive polling
+		self.changes_lock = threading.Lock()  # Guards the changes kept for change-data callbacks, merged by executor threads and taken by the scheduler
+		# Adaptive polling bounds and current interval, None for a fixed update_interval
+		self.adaptive = None if max_interval is None else {
+			'min_interval': self.update_interval,
+			'max_interval': max(max_interval, self.update_interval),
+			'interval': self.update_interval,
+		}
 
 	def add_callback(self, callback):
 		"""
@@ -48,6 +74,8 @@ class Job:
 		callback = {
 			'function': callback['function'],
 			'polling_time': callback['polling_time'],
+			'fields': callback.get('fields'),
+			'keys': callback.get('keys'),
 			'next_call_time': time.time() + callback['polling_time']
 		}
 		self.callbacks.append(callback)
@@ -63,11 +91,77 @@ class Job:
 		else:
 			self.update_interval = None
 
+	def tracked_fields(self):
+		"""
+		The fields whose changes are delivered to at least one callback, or None.
+		"""
+		fields = {field for cb in self.callbacks if cb.get('fields') is not None for field in cb['fields']}
+		if self.adaptive is not None:
+			return sorted(fields.union(self.activity_fields))
+		return sorted(fields) if any(cb.get('fields') is not None for cb in self.callbacks) else None
+
+	def interval(self):
+		"""
+		The number of seconds until the next execution.
+		"""
+		return self.adaptive['interval'] if self.adaptive is not None else self.update_interval
+
+	def make_adaptive(self, min_interval, max_interval, activity_fields):
+		"""
+		Narrows the adaptive polling bounds to those of another subscription. A fixed subscription has equal bounds.
+		"""
+		if self.adaptive is None:
+			if self.update_interval is not None:
+				# Keep polling at least as often as the existing fixed subscriptions
+				min_interval = min(min_interval, self.update_interval)
+				max_interval = min(max_interval, self.update_interval)
+			self.adaptive = {'min_interval': min_interval, 'max_interval': max_interval, 'interval': min_interval}
+		else:
+			self.adaptive['min_interval'] = min(self.adaptive['min_interval'], min_interval)
+			self.adaptive['max_interval'] = max(min(self.adaptive['max_interval'], max_interval), self.adaptive['min_interval'])
+		self.adaptive['interval'] = min(max(self.adaptive['interval'], self.adaptive['min_interval']), self.adaptive['max_interval'])
+		self.activity_fields = sorted(set(self.activity_fields).union(activity_fields))
+
+	def add_changes(self, callback, changes):
+		"""
+		Keeps changes for a change-data callback until it is called.
+		"""
+		if not changes:
+			return
+		with self.changes_lock:
+			callback['changes'] = callback['changes'].merge(changes) if callback.get('changes') else changes
+
+	def deliver_changes(self, callback, submit):
+		"""
+		Passes the changes kept for a change-data callback to ``submit``, and keeps them if it does not accept them.
+		"""
+		with self.changes_lock:
+			changes = callback.pop('changes', None)
+			if changes and not submit(callback, changes):
+				callback['changes'] = changes
+
+	def _adapt(self, active):
+		# Poll twice as often after a poll that found changes, back off exponentially otherwise
+		interval = self.adaptive['interval'] / 2 if active else self.adaptive['interval'] * 2
+		self.adaptive['interval'] = min(max(interval, self.adaptive['min_interval']), self.adaptive['max_interval'])
+
 	def execute(self):
 		"""
 		Executes the job's function with its parameters.
 		"""
-		self.function(*self.params)
+		tracked_fields = self.tracked_fields()
+		if tracked_fields is None:
+			self.function(*self.params)
+		else:
+			# Keep the changes for every change-data callback until it is called
+			changes = self.function(*self.params, tracked_fields=tracked_fields)
+			if self.adaptive is not None:
+				# Jobs that cannot tell what changed count as active
+				self._adapt(changes is None or bool(changes.select(self.activity_fields)))
+			for cb in self.callbacks:
+				if cb.get('fields') is None or not changes:
+					continue
+				self.add_changes(cb, changes.select(cb['fields'], cb.get('keys')))
 		self.last_execution_time = time.time()  # Record the last execution time
  
 		if self.future:
@@ -78,32 +172,423 @@ class Job:
 			self.status = JobStatus.FINISHED
   
 		if self.job_type == JobType.INTERVAL:
-			self.next_execution_time = self.last_execution_time + self.update_interval # Set next execution time
+			self.next_execution_time = self.last_execution_time + self.interval() # Set next execution time
 			self.status = JobStatus.PENDING
 
 
 	def __repr__(self):
 		return f"<Job(function={self.function.__name__}, params={self.params})>"
 
+class CallbackExecutor:
+	'''
+	Runs subscriber callbacks on their own bounded pool of worker threads, so that a slow callback cannot delay the scheduler.
+
+	- A callback function never runs concurrently with itself, even when several subscriptions share it. If it is still running when it is due again,
+	  that call is skipped and counted as an overrun.
+	- At most ``max_pending`` callbacks are queued or running at once, further calls are dropped.
+	- The number of calls, overruns, drops, errors and the run times of every callback function are recorded (see ``stats``).
+
+	:param int max_workers: Optional. The number of worker threads. Default is 4.
+	:param int max_pending: Optional. The maximum number of queued and running callbacks. Default is 100.
+	'''
+	def __init__(self, max_workers=4, max_pending=100):
+		self._executor = ThreadPoolExecutor(thread_name_prefix="MF_SUBSCRIBER_CALLBACK", max_workers=max_workers)
+		self._slots = threading.BoundedSemaphore(max_pending)
+		self._running = set()
+		self._stats = {}
+		self._lock = threading.Lock()
+
+	def submit(self, callback, *args):
+		"""
+		Queues a call of a callback.
+
+		:param dict callback: Required. A job callback with its ``function`` and ``polling_time``.
+		:param args: Optional. Arguments the callback is called with.
+		:return: Whether the call was queued.
+		:rtype: bool
+		"""
+		function = callback["function"]
+		with self._lock:
+			stats = self._stats.get(function)
+			if stats is None:
+				stats = self._stats[function] = {"callback": getattr(function, "__qualname__", repr(function)), "calls": 0, "overruns": 0,
+												 "dropped": 0, "errors": 0, "total_time": 0.0, "max_time": 0.0, "last_time": 0.0}
+			if function in self._running:
+				stats["overruns"] += 1
+				logger.warning(f"Callback {stats['callback']} is still running, skipping this call")
+				return False
+			if not self._slots.acquire(blocking=False):
+				stats["dropped"] += 1
+				logger.warning(f"Callback executor is full, dropping call of {stats['callback']}")
+				return False
+			self._running.add(function)
+
+		self._executor.submit(self._call, callback, stats, args)
+		return True
+
+	def _call(self, callback, stats, args):
+		start = time.perf_counter()
+		try:
+			callback["function"](*args)
+		except Exception as e:
+			with self._lock:
+				stats["errors"] += 1
+			logger.error(f"Callback {stats['callback']} raised: {e}")
+		finally:
+			duration = time.perf_counter() - start
+			with self._lock:
+				stats["calls"] += 1
+				stats["total_time"] += duration
+				stats["last_time"] = duration
+				stats["max_time"] = max(stats["max_time"], duration)
+				self._running.discard(callback["function"])
+			self._slots.release()
+			if duration > callback["polling_time"]:
+				logger.warning(f"Callback {stats['callback']} took {duration:.3f}s, longer than its polling time of {callback['polling_time']}s")
+
+	def stats(self):
+		"""
+		Returns the statistics of every callback function: the number of ``calls``, ``overruns`` (skipped because the previous call was still running),
+		``dropped`` calls (executor full), ``errors``, and the ``total_time``, ``max_time`` and ``last_time`` run times in seconds.
+
+		:rtype: list[dict]
+		"""
+		with self._lock:
+			return [dict(stats) for stats in self._stats.values()]
+
+	def shutdown(self, wait=True):
+		self._executor.shutdown(wait=wait)
+
+
+class JobMetrics:
+	'''
+	Records the executions of the subscriber's jobs: runs, failures, run times, API reads, rows written and schedule lag
+	(the seconds between the time a job was due and the time it started, including the wait for an executor thread).
+
+	Run times are also counted in a histogram with the upper bounds of ``DURATION_BUCKETS`` seconds.
+
+	With a ``slow_job_threshold``, a sampling profiler records the stacks of jobs running longer than the threshold every ``sample_interval`` seconds.
+	The most recent ``max_profiles`` profiles are kept (see ``profiles``).
+
+	:param float slow_job_threshold: Optional. The run time in seconds after which a job is profiled. Default is None (no profiling).
+	:param float sample_interval: Optional. The number of seconds between stack samples of a slow job. Default is 0.01.
+	:param int max_profiles: Optional. The number of profiles kept. Default is 20.
+	'''
+	DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, math.inf)
+
+	def __init__(self, slow_job_threshold=None, sample_interval=0.01, max_profiles=20):
+		self.slow_job_threshold = slow_job_threshold
+		self.sample_interval = sample_interval
+		self._stats = {}
+		self._profiles = deque(maxlen=max_profiles)
+		# Running jobs by thread ID: the job, its start time and its stack samples
+		self._running = {}
+		self._lock = threading.Lock()
+		self._stop_event = threading.Event()
+		self._sampler = None
+		if slow_job_threshold is not None:
+			self._sampler = threading.Thread(target=self._sample, name="MF_SUBSCRIBER_PROFILER", daemon=True)
+			self._sampler.start()
+
+	def start(self, job):
+		"""
+		Records the start of a job's execution on the calling thread.
+
+		:param Job job: Required. The job.
+		"""
+		if self._sampler is not None:
+			with self._lock:
+				self._running[threading.get_ident()] = (job, time.perf_counter(), Counter())
+
+	def finish(self, job, duration, lag, reads, rows, error=None):
+		"""
+		Records the end of a job's execution on the calling thread.
+
+		:param Job job: Required. The job.
+		:param float duration: Required. The run time in seconds.
+		:param float lag: Required. The seconds between the time the job was due and the time it started.
+		:param int reads: Required. The number of API reads.
+		:param int rows: Required. The number of rows written.
+		:param Exception error: Optional. The exception the job raised. Default is None.
+		"""
+		key = (job.function, job.params)
+		with self._lock:
+			stats = self._stats.get(key)
+			if stats is None:
+				stats = self._stats[key] = {"job": job.function.__name__, "params": job.params, "runs": 0, "failures": 0, "last_error": None,
+											"total_time": 0.0, "max_time": 0.0, "last_time": 0.0, "histogram": [0] * len(self.DURATION_BUCKETS),
+											"reads": 0, "rows": 0, "total_lag": 0.0, "max_lag": 0.0, "last_lag": 0.0}
+			stats["runs"] += 1
+			if error is not None:
+				stats["failures"] += 1
+				stats["last_error"] = repr(error)
+			stats["total_time"] += duration
+			stats["max_time"] = max(stats["max_time"], duration)
+			stats["last_time"] = duration
+			stats["histogram"][next(i for i, bound in enumerate(self.DURATION_BUCKETS) if duration <= bound)] += 1
+			stats["reads"] += reads
+			stats["rows"] += rows
+			stats["total_lag"] += lag
+			stats["max_lag"] = max(stats["max_lag"], lag)
+			stats["last_lag"] = lag
+			running = self._running.pop(threading.get_ident(), None)
+		if running is not None and running[2]:
+			samples = running[2]
+			self._profiles.append({"job": job.function.__name__, "params": job.params, "time": time.time(), "duration": duration,
+								   "samples": sum(samples.values()), "stacks": samples.most_common()})
+			logger.warning(f"Job {job} took {duration:.3f}s, profiled with {sum(samples.values())} stack samples")
+
+	def _sample(self):
+		while not self._stop_event.wait(self.sample_interval):
+			now = time.perf_counter()
+			with self._lock:
+				slow = [(thread_id, samples) for thread_id, (job, start, samples) in self._running.items() if now - start >= self.slow_job_threshold]
+			if not slow:
+				continue
+			frames = sys._current_frames()
+			for thread_id, samples in slow:
+				frame = frames.get(thread_id)
+				if frame is not None:
+					# Outermost call first, one "file:line function" entry per frame
+					stack = tuple(f"{entry.filename}:{entry.lineno} {entry.name}" for entry in traceback.extract_stack(frame))
+					samples[stack] += 1
+
+	def stats(self):
+		"""
+		Returns the statistics of every job: its function name (``job``) and ``params``, the number of ``runs`` and ``failures``, the ``last_error``,
+		the ``total_time``, ``max_time`` and ``last_time`` run times in seconds, the run time ``histogram`` (counts per bucket of ``DURATION_BUCKETS``),
+		the API ``reads``, the ``rows`` written, and the ``total_lag``, ``max_lag`` and ``last_lag`` schedule lags in seconds.
+
+		:rtype: list[dict]
+		"""
+		with self._lock:
+			return [dict(stats, histogram=list(stats["histogram"])) for stats in self._stats.values()]
+
+	def profiles(self):
+		"""
+		Returns the profiles of slow jobs, oldest first: the job's function name (``job``), ``params``, ``time``, ``duration``,
+		number of ``samples``, and the sampled ``stacks`` with their counts, most frequent first.
+
+		:rtype: list[dict]
+		"""
+		return list(self._profiles)
+
+	def shutdown(self):
+		self._stop_event.set()
+		if self._sampler is not None:
+			self._sampler.join()
+
+
+class ReadBudgetExceeded(Exception):
+	'''
+	Raised when a subscription does not fit into the read budget of a ``ReadBudgetPlanner`` with the ``reject`` policy.
+	'''
+	pass
+
+
+class ReadBudgetPlanner:
+	'''
+	Plans the API reads of the subscriber's interval jobs so that together they stay within a fraction of ``READS_PER_SECOND``.
+
+	Each job costs an estimated number of reads per execution (one per page for jobs that page through ``retrieve_all_data``),
+	learnt from the reads of its past executions. The planned rate is the sum of every job's reads divided by its interval.
+	When the planned rate exceeds the budget, subscriptions are either rejected (``reject``) or every interval is stretched
+	by the same factor (``stretch``). Estimates can grow after admission, so intervals are stretched under both policies.
+	Adaptive jobs are planned at their current interval (see ``update_interval``).
+
+	:param float reads_per_second: Optional. The API's read rate limit. Default is READS_PER_SECOND.
+	:param float utilization: Optional. The fraction of the rate limit subscriptions may use, the rest is left for one-off reads. Default is 0.8.
+	:param str policy: Optional. ``stretch`` or ``reject``. Default is stretch.
+	:param float window: Optional. The number of seconds the actual read rate is measured over. Default is 60.
+	'''
+	# Initial reads per execution of jobs that page through retrieve_all_data, before their first execution
+	INITIAL_READS = {
+		"_update_all_users": 30,
+		"_update_all_markets": 150,
+		"_update_bets": 2,
+		"_update_markets": 50,
+	}
+
+	def __init__(self, reads_per_second=READS_PER_SECOND, utilization=0.8, policy="stretch", window=60):
+		if policy not in ("stretch", "reject"):
+			raise ValueError(f"Unknown read budget policy {policy}")
+		self.budget = reads_per_second * utilization
+		self.policy = policy
+		self.window = window
+		self._jobs = {}
+		self._planned = 0.0
+		self._reads = deque()
+		self._start = time.time()
+		self._lock = threading.Lock()
+
+	def admit(self, key, name, interval):
+		"""
+		Adds an interval job to the plan, or shortens its interval.
+
+		:param key: Required. The job's key.
+		:param str name: Required. The name of the job's function.
+		:param float interval: Required. The requested number of seconds between executions.
+		:raises ReadBudgetExceeded: If the policy is ``reject`` and the job does not fit into the budget.
+		"""
+		with self._lock:
+			job = self._jobs.get(key)
+			reads = job["reads"] if job else self.INITIAL_READS.get(name, 1)
+			interval = min(interval, job["interval"]) if job else interval
+			planned = self._planned - (job["reads"] / job["interval"] if job else 0) + reads / interval
+			if self.policy == "reject" and planned > self.budget and (not job or interval < job["interval"]):
+				raise ReadBudgetExceeded(f"{name} every {interval}s needs {reads / interval:.2f} reads/s, "
+										 f"{self.budget - self._planned:.2f} of the {self.budget:.2f} reads/s budget are left")
+			self._jobs[key] = {"name": name, "reads": reads, "interval": interval}
+			self._planned = planned
+
+	def release(self, key):
+		"""
+		Removes a job from the plan.
+
+		:param key: Required. The job's key.
+		"""
+		with self._lock:
+			job = self._jobs.pop(key, None)
+			if job:
+				self._planned -= job["reads"] / job["interval"]
+
+	def update_interval(self, key, interval):
+		"""
+		Changes the requested interval of a planned job (adaptive polling).
+
+		:param key: Required. The job's key.
+		:param float interval: Required. The number of seconds between executions.
+		"""
+		with self._lock:
+			job = self._jobs.get(key)
+			if job:
+				self._planned += job["reads"] / interval - job["reads"] / job["interval"]
+				job["interval"] = interval
+
+	def observe(self, key, reads):
+		"""
+		Records the reads of one execution of a job, planned or not.
+
+		:param key: Required. The job's key.
+		:param int reads: Required. The number of reads.
+		"""
+		now = time.time()
+		with self._lock:
+			self._reads.append((now, reads))
+			while self._reads and self._reads[0][0] < now - self.window:
+				self._reads.popleft()
+			job = self._jobs.get(key)
+			if job and reads:
+				# Exponentially weighted, page counts change slowly
+				estimate = 0.8 * job["reads"] + 0.2 * reads
+				self._planned += (estimate - job["reads"]) / job["interval"]
+				job["reads"] = estimate
+
+	def stretch(self):
+		"""
+		The factor every interval is multiplied by to stay within the budget.
+
+		:rtype: float
+		"""
+		return max(self._planned / self.budget, 1.0)
+
+	def report(self):
+		"""
+		Returns the ``budget``, ``planned`` and ``actual`` read rates in reads per second, the ``stretch`` factor
+		and the plan of every job (its estimated ``reads`` per execution, requested ``interval`` and ``reads_per_second``).
+
+		:rtype: dict
+		"""
+		now = time.time()
+		with self._lock:
+			window = max(min(self.window, now - self._start), 1e-9)
+			actual = sum(reads for time_, reads in self._reads if time_ >= now - window) / window
+			stretch = max(self._planned / self.budget, 1.0)
+			return {
+				"budget": self.budget,
+				"planned": self._planned,
+				"actual": actual,
+				"stretch": stretch,
+				"jobs": [{"job": job["name"], "params": key[1], "reads": job["reads"], "interval": job["interval"],
+						  "reads_per_second": job["reads"] / (job["interval"] * stretch)} for key, job in self._jobs.items()],
+			}
+
+
 class ManifoldSubscriber():
-	def __init__(self, manifold_api: ManifoldAPI, manifold_db: ManifoldDatabase, manifold_db_writer: ManifoldDatabaseWriter):
+	def __init__(self, manifold_api: ManifoldAPI, manifold_db: ManifoldDatabase, manifold_db_writer: ManifoldDatabaseWriter,
+				 market_state_store: MarketStateStore = None, callback_workers: int = 4, max_pending_callbacks: int = 100,
+				 read_budget_utilization: float = 0.8, read_budget_policy: str = "stretch",
+				 resume_subscriptions: bool = False, subscription_owner: str = "default", resume_timeout: float = 600, full_sync_interval: float = 600, market_batch_size: int = 50,
+				 max_position_user_reads: int = 100, event_bus: EventBus = None, stream_source: StreamSource = None, stream_poll_factor: float = 10,
+				 slow_job_threshold: float = None):
 		logger.debug("Initializing ManifoldSubscriber")
 		self._manifold_api = manifold_api
 		self._manifold_db = manifold_db
 		self._manifold_db_writer = manifold_db_writer
+		self._market_state_store = market_state_store
+		self._event_bus = event_bus
  
-		self._jobs = []
-  
-		self._thread = threading.Thread(target=self._run, name="MF_SUBSCRIBER") 
+		# Jobs keyed by (function, params)
+		self._jobs = {}
+		# Timer heap of (due time, sequence number, job, callback or None). Rescheduling pushes a new entry,
+		# entries whose sequence number no longer matches their job or callback are stale and skipped.
+		self._timers = []
+		self._timer_sequence = itertools.count()
+		# Jobs whose execution finished, rescheduled by the scheduler thread
+		self._finished_jobs = deque()
+		# Bets already reported as deleted to change-data callbacks, by bet subscription
+		self._deleted_bets = {}
+		# Reads of all interval jobs, and the reads of the job executing on each executor thread
+		self._read_planner = ReadBudgetPlanner(utilization=read_budget_utilization, policy=read_budget_policy)
+		# Phase slots of interval jobs by polling interval: the next unused slot and a heap of released ones
+		self._phase_slots = defaultdict(lambda: {"next": 0, "free": [], "used": 0})
+		self._execution = threading.local()
+		self._job_metrics = JobMetrics(slow_job_threshold=slow_job_threshold)
+		# Subscriptions saved to the database under subscription_owner when resume_subscriptions is enabled: changed jobs by key,
+		# None for removed ones, saved every REGISTRY_FLUSH_INTERVAL seconds. Subscribers sharing a database need their own owner.
+		self._registry_changes = {}
+		self._registry_flush_time = 0
+		self._resume_subscriptions = resume_subscriptions
+		self._subscription_owner = subscription_owner
+		self._resume_deadline = time.time() + resume_timeout if resume_subscriptions else None
+		self._full_sync_interval = full_sync_interval
+		# Markets subscribed to with subscribe_to_markets and their number of subscriptions, and the markets
+		# left to retrieve in the current round of the shared job
+		self._market_set = {}
+		self._market_round = deque()
+		self._market_batch_size = market_batch_size
+		self._market_set_lock = threading.Lock()
+		self._max_position_user_reads = max_position_user_reads
+		# Traders of each market whose position query returned nothing, with the time of the query
+		self._positionless_traders = defaultdict(dict)
+		# Markets and users being refreshed on demand, by ID, with the Future of their retrieval
+		self._refreshing = {MARKETS: {}, USERS: {}}
+		self._refresh_lock = threading.Lock()
+		# Live data: rows received by the stream source wait here for the scheduler to call the callbacks of their jobs,
+		# None signals that the stream disconnected. Streamed jobs poll stream_poll_factor times less often while it is connected.
+		self._stream_source = stream_source
+		self._stream_poll_factor = stream_poll_factor
+		self._stream_connected = False
+		self._stream_deliveries = deque()
+		# Streamed messages, rows and event-to-callback latencies by topic
+		self._stream_stats = {}
+		self._stream_stats_lock = threading.Lock()
+		self._streamed_functions = set() if stream_source is None else {
+			function for topic in stream_source.topics for function in self.STREAM_FUNCTIONS.get(topic, ())}
+
+		self._thread = threading.Thread(target=self._run, name="MF_SUBSCRIBER")
 		self._executor = ThreadPoolExecutor(thread_name_prefix="MF_SUBSCRIBER_EXECUTOR", max_workers=20)
+		self._callback_executor = CallbackExecutor(max_workers=callback_workers, max_pending=max_pending_callbacks)
 		self._jobs_queue = Queue(maxsize=20)
- 
+
 		self.running = True
-	
+
 		self._thread.start()
+		if self._stream_source is not None:
+			self._stream_source.start(self._on_stream_rows, self._on_stream_state)
 		logger.debug("ManifoldSubscriber initialized")
-  
-  
+
+
 	def is_alive(self):
 		"""
 		Checks if the scheduler is running.
@@ -115,95 +600,596 @@ class ManifoldSubscriber():
 
 	def shutdown(self):
 		logger.debug("Shutting down manifold subscriber")
+		if self._stream_source is not None:
+			self._stream_source.stop()
 		self.running = False
-		self._executor.shutdown(wait=True)
+		self._wakeup()
 		self._thread.join()
+		self._executor.shutdown(wait=True)
+		self._callback_executor.shutdown(wait=True)
+		self._job_metrics.shutdown()
+		# Save the sync state of every subscription for the next start
+		for key, job in self._jobs.items():
+			if job.job_type == JobType.INTERVAL:
+				self._registry_changes[key] = job
+		self._flush_registry(wait=True)
 		logger.debug("Manifold subscriber shut down")
 
+	def callback_stats(self):
+		"""
+		Returns the run statistics of the subscription callbacks (see ``CallbackExecutor.stats``).
+
+		:rtype: list[dict]
+		"""
+		return self._callback_executor.stats()
+
+	def stats(self):
+		"""
+		Returns a snapshot of the subscriber's statistics: the execution statistics of every job (``jobs``, see ``JobMetrics.stats``),
+		the profiles of slow jobs (``slow_jobs``, see ``JobMetrics.profiles``), the statistics of the callbacks (``callbacks``, see ``CallbackExecutor.stats``),
+		the read budget (``read_budget``, see ``ReadBudgetPlanner.report``), the number of subscribed jobs (``subscriptions``) and, per streamed topic,
+		the number of ``messages`` and ``rows`` written, the number of ``deliveries`` of messages to the callbacks of a subscription and their
+		``total_latency``, ``max_latency`` and ``last_latency`` in seconds from the event behind a message (e.g. a bet being placed, see
+		``STREAM_EVENT_TIME_FIELDS``, or the publication of the message for users) to its callbacks being dispatched (``stream``).
+
+		:rtype: dict
+		"""
+		return {
+			"jobs": self._job_metrics.stats(),
+			"slow_jobs": self._job_metrics.profiles(),
+			"callbacks": self._callback_executor.stats(),
+			"read_budget": self._read_planner.report(),
+			"subscriptions": sum(1 for job in list(self._jobs.values()) if job.job_type == JobType.INTERVAL),
+			"stream": self._stream_stats_snapshot(),
+		}
+
+	def _stream_stats_snapshot(self):
+		with self._stream_stats_lock:
+			return [dict(stats) for stats in self._stream_stats.values()]
+
+	def read_budget_report(self):
+		"""
+		Returns the planned and actual read rates of the subscriptions (see ``ReadBudgetPlanner.report``).
+
+		:rtype: dict
+		"""
+		return self._read_planner.report()
+
+	def _queue_job(self, job):
+		# Subscriptions are planned when they are made, so that rejections reach the caller
+		key = (job.function, job.params)
+		if job.action == JobAction.ADD and job.job_type == JobType.INTERVAL:
+			self._read_planner.admit(key, job.function.__name__, job.update_interval)
+		elif job.action == JobAction.REMOVE and not job.callbacks:
+			self._read_planner.release(key)
+		self._jobs_queue.put(job)
+
+	def _publish(self, topic, rows):
+		# Retrieved rows are published once they are written to the database, and counted as written by the executing job
+		self._execution.rows = getattr(self._execution, "rows", 0) + len(rows)
+		if self._event_bus is not None:
+			self._event_bus.publish_rows(topic, rows)
+
+	def _upsert(self, table, rows, tracked_fields=None, scope=None):
+		# Writes rows to their table. With tracked fields the rows are compared with the stored rows in the same write operation
+		# on the writer thread, so that no other write lands in between, and the changes are returned (see ManifoldDatabase.diff_rows).
+		if not rows and not scope:
+			return ChangeEvent(table) if tracked_fields is not None else None
+		if tracked_fields is None:
+			upsert = getattr(self._manifold_db, ManifoldDatabase.CHANGE_UPSERTS[table])
+			self._manifold_db_writer.queue_write_operation(function=upsert, data=rows).result()
+			return None
+		return self._manifold_db_writer.queue_write_operation(function=self._manifold_db.upsert_with_changes,
+															  data=(table, rows, tracked_fields, scope)).result()
+
+	def _upsert_markets(self, binary_choice_markets, multiple_choice_markets, tracked_fields=None):
+		# Market IDs are unique across both tables, so their changes are reported as one event
+		binary_changes = self._upsert("binary_choice_markets", binary_choice_markets, tracked_fields)
+		multiple_changes = self._upsert("multiple_choice_markets", multiple_choice_markets, tracked_fields)
+		if tracked_fields is None:
+			return None
+		changes = binary_changes.merge(multiple_changes)
+		changes.table = "markets"
+		return changes
+
+	def _count_reads(self, reads):
+		# Called by job functions for the API reads they made
+		self._execution.reads = getattr(self._execution, "reads", 0) + reads
+
+	def _execute_job(self, job):
+		self._execution.job = job
+		self._execution.reads = 0
+		self._execution.rows = 0
+		lag = max(time.time() - job.due_time, 0) if job.due_time is not None else 0.0
+		error = None
+		self._job_metrics.start(job)
+		start = time.perf_counter()
+		try:
+			job.execute()
+		except Exception as e:
+			error = e
+			raise
+		finally:
+			self._read_planner.observe((job.function, job.params), self._execution.reads)
+			self._job_metrics.finish(job, time.perf_counter() - start, lag, self._execution.reads, self._execution.rows, error)
+
+	def _wakeup(self):
+		# None in the jobs queue only wakes the scheduler. If the queue is full the scheduler is about to wake anyway.
+		try:
+			self._jobs_queue.put_nowait(None)
+		except Full:
+			pass
+
+	def _schedule(self, due_time, job, callback=None):
+		sequence = next(self._timer_sequence)
+		if callback is None:
+			job.timer = sequence
+		else:
+			callback["timer"] = sequence
+		heapq.heappush(self._timers, (due_time, sequence, job, callback))
+
 	def _run(self):
 		logger.debug("Starting ManifoldSubscriber scheduler")
+		if self._resume_subscriptions:
+			self._restore_subscriptions()
 		while self.running:
-			# Process adding/removing jobs
-			while not self._jobs_queue.empty():
-				job = self._jobs_queue.get()
-				if job.action == JobAction.ADD:
-					logger.debug(f"Adding job {job}")
-					self._add_job(job)
-				elif job.action == JobAction.REMOVE:
-					logger.debug(f"Removing job {job}")
-					self._remove_job(job)
-
-			# Execute jobs
+			# Sleep until the next timer or registry task is due or a job is added/removed
+			due_times = [self._timers[0][0]] if self._timers else []
+			if self._registry_changes:
+				due_times.append(self._registry_flush_time)
+			if self._resume_deadline is not None:
+				due_times.append(self._resume_deadline)
+			timeout = max(min(due_times) - time.time(), 0) if due_times else None
+			try:
+				job = self._jobs_queue.get(timeout=timeout)
+				while True:
+					if job is not None:
+						if job.action == JobAction.ADD:
+							logger.debug(f"Adding job {job}")
+							self._add_job(job)
+						elif job.action == JobAction.REMOVE:
+							logger.debug(f"Removing job {job}")
+							self._remove_job(job)
+					job = self._jobs_queue.get_nowait()
+			except Empty:
+				pass
+
+			# Reschedule jobs that finished executing
+			while self._finished_jobs:
+				self._reschedule_job(self._finished_jobs.popleft())
+
+			# Call the callbacks of streamed rows, or resume polling after the stream disconnected
+			while self._stream_deliveries:
+				delivery = self._stream_deliveries.popleft()
+				if delivery is None:
+					self._resume_polling()
+				else:
+					self._deliver_stream(*delivery)
+
+			# Fire due timers
 			current_time = time.time()
-			for job in self._jobs:
-				# Check if it's time for the job to be executed
-				if job.next_execution_time <= current_time and job.status == JobStatus.PENDING:
-					job.status = JobStatus.EXECUTING
-					logger.debug(f"Executing job {job}")
-					future = self._executor.submit(job.execute)
-
-				# Check callbacks
-				for callback in job.callbacks:
-					if callback["next_call_time"] <= current_time and job.status != JobStatus.EXECUTING:
-						logger.debug(f"Firing callback {callback} from job {job}")
-						# Execute the callback
-						callback["function"]()
-						# Update next call time
-						callback["next_call_time"] = current_time + callback["polling_time"]
-	  
-			time.sleep(0.1)
+			while self._timers and self._timers[0][0] <= current_time:
+				due_time, sequence, job, callback = heapq.heappop(self._timers)
+				if callback is None:
+					if job.timer != sequence:
+						continue
+					job.timer = None
+					if job.status == JobStatus.PENDING:
+						job.status = JobStatus.EXECUTING
+						job.due_time = due_time
+						logger.debug(f"Executing job {job}")
+						self._executor.submit(self._execute_job, job).add_done_callback(lambda future, job=job: self._job_done(job, future))
+					continue
+
+				if callback.get("timer") != sequence:
+					continue
+				callback["timer"] = None
+				# Callbacks wait for a running job, they are rescheduled once it finishes
+				if job.status == JobStatus.EXECUTING:
+					continue
+				logger.debug(f"Firing callback {callback} from job {job}")
+				if callback.get("fields") is not None:
+					# Change-data callbacks are only called when something changed
+					job.deliver_changes(callback, self._callback_executor.submit)
+				elif callback["function"]:
+					self._callback_executor.submit(callback)
+				callback["next_call_time"] = current_time + callback["polling_time"]
+				self._schedule(callback["next_call_time"], job, callback)
+
+			# Save changed subscriptions, and drop restored subscriptions that were not subscribed to again
+			if self._registry_changes and current_time >= self._registry_flush_time:
+				self._flush_registry()
+			if self._resume_deadline is not None and current_time >= self._resume_deadline:
+				self._expire_restored_jobs()
+
+	def _job_done(self, job, future):
+		# Runs on the executor thread
+		exception = future.exception()
+		if exception is not None:
+			logger.error(f"Job {job} failed: {exception}")
+			if job.future:
+				job.future.set_exception(exception)
+				job.future = None
+			job.status = JobStatus.PENDING if job.job_type == JobType.INTERVAL else JobStatus.FINISHED
+			job.last_execution_time = time.time()
+			job.next_execution_time = job.last_execution_time + (job.update_interval or 0)
+		self._finished_jobs.append(job)
+		self._wakeup()
+
+	def _reschedule_job(self, job):
+		if self._jobs.get((job.function, job.params)) is not job:
+			return
+		if job.status == JobStatus.PENDING:
+			if job.job_type == JobType.INTERVAL:
+				# Adaptive intervals are planned like fixed ones, the planner stretches every interval by the same factor
+				# while together they would exceed the read budget, so the busiest jobs keep the largest share of the reads
+				if job.adaptive is not None:
+					self._read_planner.update_interval((job.function, job.params), job.adaptive['interval'])
+				interval = job.interval() * self._read_planner.stretch()
+				if self._is_streamed(job):
+					interval *= self._stream_poll_factor
+				job.next_execution_time = self._next_phase_time(job, job.last_execution_time, interval)
+				self._registry_changes[(job.function, job.params)] = job
+			self._schedule(job.next_execution_time, job)
+		for callback in job.callbacks:
+			if callback.get("timer") is None:
+				self._schedule(callback["next_call_time"], job, callback)
+
+	# Job functions whose data a stream topic carries
+	STREAM_FUNCTIONS = {
+		MARKETS: ("_update_market", "_update_markets", "_update_all_markets"),
+		BETS: ("_update_bets",),
+		POSITIONS: ("_update_market_positions",),
+		USERS: ("_update_user", "_update_all_users"),
+	}
+
+	def _is_streamed(self, job):
+		return self._stream_connected and job.function.__name__ in self._streamed_functions
+
+	def _on_stream_state(self, connected):
+		# Runs on the stream source's thread
+		self._stream_connected = connected
+		if not connected:
+			self._stream_deliveries.append(None)
+			self._wakeup()
+
+	def _resume_polling(self):
+		# Streamed jobs were scheduled stream_poll_factor intervals ahead, bring them back to their normal interval
+		now = time.time()
+		for job in self._jobs.values():
+			if job.job_type != JobType.INTERVAL or job.status != JobStatus.PENDING or job.update_interval is None:
+				continue
+			if job.function.__name__ not in self._streamed_functions:
+				continue
+			due = self._next_phase_time(job, now, job.interval() * self._read_planner.stretch())
+			if job.next_execution_time is None or due < job.next_execution_time:
+				job.next_execution_time = due
+				self._schedule(due, job)
+
+	def _stream_jobs(self, topic, rows):
+		# The interval jobs each streamed row belongs to, looked up by key
+		jobs = {}
+		def add(key, row):
+			job = self._jobs.get(key)
+			if job is not None and job.job_type == JobType.INTERVAL:
+				jobs.setdefault(job, []).append(row)
+		for row in rows:
+			if topic == MARKETS:
+				add((self._update_market, (row["id"],)), row)
+				add((self._update_all_markets, ()), row)
+				if row["id"] in self._market_set:
+					add((self._update_markets, ()), row)
+			elif topic == BETS:
+				add((self._update_bets, (None, None, row.get("contractId"), None)), row)
+				add((self._update_bets, (row.get("userId"), None, None, None)), row)
+				add((self._update_bets, (row.get("userId"), None, row.get("contractId"), None)), row)
+			elif topic == POSITIONS:
+				add((self._update_market_positions, (row.get("contractId"), None)), row)
+				add((self._update_market_positions, (row.get("contractId"), row.get("userId"))), row)
+			elif topic == USERS:
+				add((self._update_user, (row["id"],)), row)
+				add((self._update_all_users, ()), row)
+		return jobs
+
+	def _on_stream_rows(self, topic, rows, published_time=None):
+		# Runs on the stream source's thread. Streamed rows take the path of polled rows: the database, the market state store
+		# and the event bus, then the callbacks of the jobs they belong to are called by the scheduler.
+		jobs = self._stream_jobs(topic, rows)
+		tracked_fields = sorted({field for job in jobs for field in job.tracked_fields() or ()})
+		changes = self._write_rows(topic, rows, tracked_fields or None)
+		self._record_stream_stats(topic, rows=len(rows))
+		event_time = self._stream_event_time(topic, rows, published_time)
+		for job, job_rows in jobs.items():
+			keys = {(row.get("contractId"), row.get("userId")) if topic == POSITIONS else row.get("id") for row in job_rows}
+			self._stream_deliveries.append((job, changes, keys, topic, event_time))
+		if jobs:
+			self._wakeup()
+
+	# The field holding the UNIX time in milliseconds of the event behind a streamed row (a bet being placed, a market or position changing)
+	STREAM_EVENT_TIME_FIELDS = {
+		MARKETS: "lastUpdatedTime",
+		BETS: "createdTime",
+		POSITIONS: "lastBetTime",
+	}
+
+	def _stream_event_time(self, topic, rows, published_time):
+		# The time of the oldest event of a message, or its publish time for rows without one (users)
+		field = self.STREAM_EVENT_TIME_FIELDS.get(topic)
+		times = [row[field] for row in rows if field is not None and isinstance(row.get(field), (int, float))]
+		return min(times) / 1000 if times else published_time
+
+	def _record_stream_stats(self, topic, rows=0, latency=None):
+		with self._stream_stats_lock:
+			stats = self._stream_stats.get(topic)
+			if stats is None:
+				stats = self._stream_stats[topic] = {"topic": topic, "messages": 0, "rows": 0, "deliveries": 0,
+													 "total_latency": 0.0, "max_latency": 0.0, "last_latency": 0.0}
+			if latency is None:
+				stats["messages"] += 1
+				stats["rows"] += rows
+			else:
+				stats["deliveries"] += 1
+				stats["total_latency"] += latency
+				stats["max_latency"] = max(stats["max_latency"], latency)
+				stats["last_latency"] = latency
+
+	def _write_rows(self, topic, rows, tracked_fields=None):
+		if topic == MARKETS:
+			for market in rows:
+				market.setdefault("lite", False)
+			binary_choice_markets = [market for market in rows if market.get("outcomeType") == "BINARY"]
+			multiple_choice_markets = [market for market in rows if market.get("outcomeType") == "MULTIPLE_CHOICE"]
+			changes = self._upsert_markets(binary_choice_markets, multiple_choice_markets, tracked_fields)
+			rows = binary_choice_markets + multiple_choice_markets
+			if self._market_state_store is not None:
+				self._market_state_store.update_markets(rows, watched_only=True)
+		else:
+			table = {BETS: "bets", POSITIONS: "contract_metrics", USERS: "users"}[topic]
+			changes = self._upsert(table, rows, tracked_fields)
+		self._publish(topic, rows)
+		return changes
+
+	def _deliver_stream(self, job, changes, keys, topic, event_time):
+		if self._jobs.get((job.function, job.params)) is not job:
+			return
+		dispatched = False
+		for callback in job.callbacks:
+			if callback.get("fields") is not None:
+				if changes:
+					job.add_changes(callback, changes.select(callback["fields"], keys if callback.get("keys") is None else keys & callback["keys"]))
+					dispatched = True
+				job.deliver_changes(callback, self._callback_executor.submit)
+			elif callback["function"]:
+				self._callback_executor.submit(callback)
+				dispatched = True
+		if dispatched and event_time is not None:
+			self._record_stream_stats(topic, latency=max(time.time() - event_time, 0))
+
+	# Golden ratio conjugate: slots 0, 1, 2, ... are placed at fractions 0, 0.618, 0.236, ... of the interval,
+	# so any number of consecutive slots stays close to evenly spread
+	PHASE_STEP = (math.sqrt(5) - 1) / 2
+	# Random jitter of a phase, as a fraction of the average gap between jobs of the same interval
+	PHASE_JITTER = 0.25
+
+	def _assign_phase(self, job):
+		# Jobs of the same interval get spread phases. Released slots are reused lowest first, keeping the spread when jobs come and go.
+		group = job.adaptive['min_interval'] if job.adaptive is not None else job.update_interval
+		slots = self._phase_slots[group]
+		if slots["free"]:
+			slot = heapq.heappop(slots["free"])
+		else:
+			slot = slots["next"]
+			slots["next"] += 1
+		slots["used"] += 1
+		jitter = random.uniform(-self.PHASE_JITTER, self.PHASE_JITTER) / slots["used"]
+		job.phase = (group, slot, (slot * self.PHASE_STEP + jitter) % 1.0)
+
+	def _release_phase(self, job):
+		if job.phase is None:
+			return
+		group, slot, _ = job.phase
+		slots = self._phase_slots[group]
+		heapq.heappush(slots["free"], slot)
+		slots["used"] -= 1
+		if slots["used"] == 0:
+			del self._phase_slots[group]
+		job.phase = None
+
+	def _next_phase_time(self, job, after, interval):
+		# The first time after ``after`` on the job's phase grid: offset + k * interval
+		if job.phase is None:
+			self._assign_phase(job)
+		offset = job.phase[2] * interval
+		return offset + (math.floor((after - offset) / interval) + 1) * interval
 
 	def _add_job(self, new_job):
-	 
+
 		# Coalesce into existing job
 		# An interval job always takes precedence for the job type
-		for job in self._jobs:
-			if job.function == new_job.function and job.params == new_job.params:
-				# One-off job
-				if new_job.job_type == JobType.ONEOFF:
-					# Change status if applicable
-					if job.status == JobStatus.FINISHED:
-						job.status = JobStatus.PENDING
-					# Set the next execution time to now
-					job.next_execution_time = time.time()
-					# Set the future
-					job.future = new_job.future
-					# Done
-					return
-   
-				# Interval job
-				if new_job.job_type == JobType.INTERVAL:
-					# Job becomes an interval type
-					job.job_type = JobType.INTERVAL
-					# Change status if applicable
-					if job.status == JobStatus.FINISHED:
-						job.status = JobStatus.PENDING
-					# Is there a callback?
-					if len(new_job.callbacks) != 0:
-						# Yes, add the new callback
-						new_callback = new_job.callbacks[0]
-						job.add_callback(new_callback)
-						# Done
-						return
-  
+		job = self._jobs.get((new_job.function, new_job.params))
+		if job is not None:
+			# One-off job
+			if new_job.job_type == JobType.ONEOFF:
+				# Change status if applicable
+				if job.status == JobStatus.FINISHED:
+					job.status = JobStatus.PENDING
+				# Set the next execution time to now
+				job.next_execution_time = time.time()
+				# Set the future
+				job.future = new_job.future
+				if job.status == JobStatus.PENDING:
+					self._schedule(job.next_execution_time, job)
+				# Done
+				return
+
+			# Interval job
+			if new_job.job_type == JobType.INTERVAL:
+				# Job becomes an interval type
+				job.job_type = JobType.INTERVAL
+				# Change status if applicable
+				if job.status == JobStatus.FINISHED:
+					job.status = JobStatus.PENDING
+					self._schedule(job.next_execution_time, job)
+				# A restored job is claimed by its first new subscription, which replaces its saved polling
+				claimed = len(new_job.callbacks) != 0 and any(callback.get("restored") for callback in job.callbacks)
+				if claimed:
+					job.callbacks = []
+					self._release_phase(job)
+				# Is there a callback?
+				if len(new_job.callbacks) != 0:
+					# Yes, add the new callback
+					new_callback = new_job.callbacks[0]
+					job.add_callback(new_callback)
+					self._schedule(job.callbacks[-1]["next_call_time"], job, job.callbacks[-1])
+				# Adaptive polling stays within the bounds of every subscription
+				if claimed:
+					job.adaptive = dict(new_job.adaptive) if new_job.adaptive is not None else None
+					job.activity_fields = list(new_job.activity_fields)
+					self._read_planner.update_interval((job.function, job.params), job.update_interval)
+				elif new_job.adaptive is not None:
+					job.make_adaptive(new_job.adaptive['min_interval'], new_job.adaptive['max_interval'], new_job.activity_fields)
+				elif job.adaptive is not None:
+					job.make_adaptive(new_job.update_interval, new_job.update_interval, [])
+				self._registry_changes[(job.function, job.params)] = job
+				# Done
+				return
+
 		# New job
 		if new_job.job_type == JobType.ONEOFF:
 			# Set next execution time to now
 			new_job.next_execution_time = time.time()
-  
-		elif new_job.job_type == JobType.INTERVAL:
-			# Set next execution time
-			new_job.next_execution_time = time.time() + new_job.update_interval
-			# Set callback next call time
-			new_job.callbacks[0]["next_call_time"] = time.time() + new_job.callbacks[0]["polling_time"]
 
-		self._jobs.append(new_job)
+		elif new_job.job_type == JobType.INTERVAL:
+			# Set next execution time, at the job's phase within the next interval (after its last execution for restored jobs)
+			new_job.next_execution_time = self._next_phase_time(new_job, max(time.time(), new_job.last_execution_time), new_job.update_interval)
+			# Set callback next call time, it fires once the first execution finished
+			new_job.callbacks[0]["next_call_time"] = new_job.next_execution_time
+			self._registry_changes[(new_job.function, new_job.params)] = new_job
+
+		self._jobs[(new_job.function, new_job.params)] = new_job
+		if new_job.function == self._update_market and new_job.job_type == JobType.INTERVAL and self._market_state_store is not None:
+			self._market_state_store.watch(new_job.params[0], owner="subscribe_to_market")
+		self._schedule(new_job.next_execution_time, new_job)
+		for callback in new_job.callbacks:
+			self._schedule(callback["next_call_time"], new_job, callback)
 
 	def _remove_job(self, job_to_remove):
-		# Remove the job by comparing function and parameters
-		self._jobs = [job for job in self._jobs if not (job.function == job_to_remove.function and job.params == job_to_remove.params)]
-
-	def subscribe_to_user(self, user_id, polling_time, callback):
+		key = (job_to_remove.function, job_to_remove.params)
+		# Only remove the given callbacks while other callbacks remain
+		job = self._jobs.get(key)
+		if job is not None and job_to_remove.callbacks:
+			functions = [callback['function'] for callback in job_to_remove.callbacks]
+			for callback in job.callbacks:
+				if callback['function'] in functions:
+					callback["timer"] = None
+			for function in functions:
+				job.remove_callback(function)
+			if job.callbacks:
+				if job.adaptive is None:
+					self._read_planner.update_interval(key, job.update_interval)
+				self._registry_changes[key] = job
+				return
+			self._read_planner.release(key)
+		# Remove the job by comparing function and parameters, its timers become stale
+		job = self._jobs.pop(key, None)
+		if job is not None:
+			job.timer = None
+			self._release_phase(job)
+			for callback in job.callbacks:
+				callback["timer"] = None
+			if job.job_type == JobType.INTERVAL:
+				self._registry_changes[key] = None
+				if job.function == self._update_market and self._market_state_store is not None:
+					self._market_state_store.unwatch(job.params[0], owner="subscribe_to_market")
+
+	# Seconds between saves of changed subscriptions to the database
+	REGISTRY_FLUSH_INTERVAL = 30
+	# Fields whose changes count as activity for adaptive polling, by job function
+	ACTIVITY_FIELDS = {
+		"_update_bets": ["isFilled", "isCancelled"],
+		"_update_market_positions": ["lastBetTime"],
+		"_update_market": ["lastUpdatedTime"],
+	}
+
+	def _flush_registry(self, wait=False):
+		# Saves the definitions and sync state of changed interval jobs, and deletes removed ones
+		changes, self._registry_changes = self._registry_changes, {}
+		self._registry_flush_time = time.time() + self.REGISTRY_FLUSH_INTERVAL
+		if not self._resume_subscriptions:
+			return
+		subscriptions = []
+		removed = []
+		for (function, params), job in changes.items():
+			if job is None:
+				removed.append((self._subscription_owner, function.__name__, json.dumps(params)))
+			elif job.update_interval is not None:
+				subscriptions.append({
+					"owner": self._subscription_owner,
+					"function": function.__name__,
+					"params": json.dumps(params),
+					"polling_time": job.adaptive['min_interval'] if job.adaptive is not None else job.update_interval,
+					"max_polling_time": job.adaptive['max_interval'] if job.adaptive is not None else None,
+					"last_execution_time": job.last_execution_time,
+					"cursor": job.cursor,
+					"full_sync_time": job.full_sync_time,
+				})
+		futures = []
+		if subscriptions:
+			futures.append(self._manifold_db_writer.queue_write_operation(function=self._manifold_db.upsert_subscriptions, data=subscriptions))
+		if removed:
+			futures.append(self._manifold_db_writer.queue_write_operation(function=self._manifold_db.delete_subscriptions, data=removed))
+		if wait:
+			for future in futures:
+				try:
+					future.result()
+				except Exception as e:
+					logger.error(f"Saving subscriptions failed: {e}")
+
+	def _restore_subscriptions(self):
+		# Resumes the interval jobs saved by the previous run. Callbacks cannot be saved, so a restored job polls
+		# with a placeholder callback until it is subscribed to again, and is dropped if it is not within resume_timeout seconds.
+		restored = 0
+		for subscription in self._manifold_db.get_subscriptions(self._subscription_owner):
+			function = getattr(self, subscription["function"], None) if subscription["function"].startswith("_update_") else None
+			if function is None:
+				logger.warning(f"Cannot restore unknown subscription {subscription['function']}")
+				continue
+			job = Job(action=JobAction.ADD,
+			 function=function,
+			 params=tuple(json.loads(subscription["params"])),
+			 job_type=JobType.INTERVAL,
+			 callbacks=[
+				 {
+					 "function": None,
+					 "polling_time": subscription["polling_time"],
+					 "fields": None,
+					 "restored": True,
+				 }
+			 ],
+			 max_interval=subscription["max_polling_time"],
+			 activity_fields=self.ACTIVITY_FIELDS.get(subscription["function"]))
+			job.last_execution_time = subscription["last_execution_time"] or 0
+			job.cursor = subscription["cursor"]
+			job.full_sync_time = subscription["full_sync_time"] or 0
+			try:
+				self._read_planner.admit((job.function, job.params), function.__name__, job.update_interval)
+			except ReadBudgetExceeded as e:
+				logger.warning(f"Not restoring subscription {job}: {e}")
+				self._registry_changes[(job.function, job.params)] = None
+				continue
+			self._add_job(job)
+			restored += 1
+		logger.debug(f"Restored {restored} subscriptions")
+
+	def _expire_restored_jobs(self):
+		self._resume_deadline = None
+		for key, job in list(self._jobs.items()):
+			if any(callback.get("restored") for callback in job.callbacks):
+				logger.debug(f"Dropping restored subscription {job}, it was not subscribed to again")
+				self._read_planner.release(key)
+				self._remove_job(job)
+
+	def subscribe_to_user(self, user_id, polling_time, callback, fields=None):
 		'''
 		Continuously retrieves the profile of a specified user and updates the database.
 
@@ -213,6 +1199,8 @@ class ManifoldSubscriber():
 			Required. The number of seconds between each profile update. 
 		:param function callback:
 			Required. A function to be called when the job finishes. The function should accept no arguments.
+		:param list[str] fields:
+			Optional. Columns of the users table to track. When set, the callback is called with a ``ChangeEvent`` of the rows whose tracked fields changed since its last call, and not called at all when nothing changed. Default is None.
 		
 		:return:
 			None
@@ -227,10 +1215,11 @@ class ManifoldSubscriber():
 				{
 					"function": callback,
 					"polling_time": polling_time,
+					"fields": fields,
 				}
 			])
   
-		self._jobs_queue.put(job)
+		self._queue_job(job)
 
 	def unsubscribe_to_user(self, user_id):
 		'''
@@ -249,7 +1238,7 @@ class ManifoldSubscriber():
 				function=self._update_user,
 			   	params=(user_id,))
 
-		self._jobs_queue.put(job)
+		self._queue_job(job)
 
 	def update_user(self, user_id):
 		'''
@@ -273,15 +1262,18 @@ class ManifoldSubscriber():
        			job_type=JobType.ONEOFF,
           		future=future)
 
-		self._jobs_queue.put(job)
+		self._queue_job(job)
 		return future
  
-	def _update_user(self, user_id):
+	def _update_user(self, user_id, tracked_fields=None):
 		logger.debug(f"Updating profile for user {user_id}")
 		user = self._manifold_api.get_user_by_id(user_id=user_id).result()
-		self._manifold_db_writer.queue_write_operation(function=self._manifold_db.upsert_users, data=[user]).result()
+		self._count_reads(1)
+		changes = self._upsert("users", [user], tracked_fields)
+		self._publish(USERS, [user])
+		return changes
 
-	def subscribe_to_all_users(self, polling_time, callback):
+	def subscribe_to_all_users(self, polling_time, callback, fields=None):
 		'''
 		Continuously retrieves the (LiteUser) profile of all users and updates the manifold database with it.
 
@@ -289,6 +1281,8 @@ class ManifoldSubscriber():
 			Required. The number of seconds between updates.
 		:param function callback:
 			Required. A function to be called when the job finishes. The function should accept no arguments.
+		:param list[str] fields:
+			Optional. Columns of the users table to track. When set, the callback is called with a ``ChangeEvent`` of the rows whose tracked fields changed since its last call, and not called at all when nothing changed. Default is None.
 
 		:returns: 
 			None
@@ -304,10 +1298,11 @@ class ManifoldSubscriber():
 			  {
 				  "function": callback,
 				  "polling_time": polling_time,
+				  "fields": fields,
 			  }
 		  ])
 
-		self._jobs_queue.put(job) 
+		self._queue_job(job)
 
 	def unsubscribe_to_all_users(self):
 		'''
@@ -320,7 +1315,7 @@ class ManifoldSubscriber():
 		  function=self._update_all_users,
 		  params=()) 
 
-		self._jobs_queue.put(job)
+		self._queue_job(job)
   
 	def update_all_users(self):
 		'''
@@ -342,16 +1337,19 @@ class ManifoldSubscriber():
 		  job_type=JobType.ONEOFF,
 		  future=future)
    
-		self._jobs_queue.put(job)
+		self._queue_job(job)
 		return future
   
-	def _update_all_users(self):
+	def _update_all_users(self, tracked_fields=None):
 		logger.debug(f"Updating profiles of all users")
   
 		users = self._manifold_api.retrieve_all_data(self._manifold_api.get_users, max_limit=1000)
-		self._manifold_db_writer.queue_write_operation(function=self._manifold_db.upsert_users, data=users).result()
+		self._count_reads(len(users) // 1000 + 1)
+		changes = self._upsert("users", users, tracked_fields)
+		self._publish(USERS, users)
+		return changes
 	
-	def subscribe_to_bets(self, user_id, username, contract_id, contract_slug, polling_time, callback):
+	def subscribe_to_bets(self, user_id, username, contract_id, contract_slug, polling_time, callback, fields=None, max_polling_time=None):
 		'''
 		Continuously retrieves bets based on a single value or a combination of the following:
 
@@ -376,6 +1374,10 @@ class ManifoldSubscriber():
 			Required. The number of seconds between each bet update.
 		:param function callback:
 			Required. A function to be called when the job finishes. The function should accept no arguments.
+		:param list[str] fields:
+			Optional. Columns of the bets table to track. When set, the callback is called with a ``ChangeEvent`` of the rows whose tracked fields changed since its last call, and not called at all when nothing changed. Default is None.
+		:param int max_polling_time:
+			Optional. Enables adaptive polling: polls as often as every polling_time seconds while polls find new, filled or cancelled bets, and backs off exponentially to every max_polling_time seconds while they do not. Default is None (fixed polling time).
 		
 		:return:
 			None
@@ -390,10 +1392,13 @@ class ManifoldSubscriber():
 			  {
 				  "function": callback,
 				  "polling_time": polling_time,
+				  "fields": fields,
 			  }
-		  ])
+		  ],
+		  max_interval=max_polling_time,
+		  activity_fields=self.ACTIVITY_FIELDS["_update_bets"])
 
-		self._jobs_queue.put(job)
+		self._queue_job(job)
 
 	def unsubscribe_to_bets(self, user_id, username=None, contract_id=None, contract_slug=None):
 		'''
@@ -422,7 +1427,7 @@ class ManifoldSubscriber():
 		  function=self._update_bets,
 		  params=(user_id, username, contract_id, contract_slug))
 
-		self._jobs_queue.put(job)
+		self._queue_job(job)
 
 	def update_bets(self, user_id, username=None, contract_id=None, contract_slug=None):
 		'''
@@ -458,19 +1463,45 @@ class ManifoldSubscriber():
 		  future=future)
 
    
-		self._jobs_queue.put(job)
+		self._queue_job(job)
 		return future
 		
-	def _update_bets(self, user_id, username=None, contract_id=None, contract_slug=None):
+	def _update_bets(self, user_id, username=None, contract_id=None, contract_slug=None, tracked_fields=None):
 		logger.debug(f"Updating bets with user_id={user_id}, username={username}, contract_id={contract_id} and contract_slug={contract_slug}")
   
-		bets = self._manifold_api.retrieve_all_data(api_call_func=self._manifold_api.get_bets, max_limit=1000, user_id=user_id, username=username, contract_id=contract_id,  contract_slug=contract_slug)
-		self._manifold_db_writer.queue_write_operation(function=self._manifold_db.upsert_bets, data=bets).result()
-
-	def subscribe_to_market_positions(self, market_id, user_id, polling_time=60, callback=None):
+		# Only retrieve the bets newer than the newest one already retrieved, and all bets every full_sync_interval seconds
+		# so that fills and cancellations of older limit orders are picked up
+		job = getattr(self._execution, "job", None)
+		incremental = job is not None and job.cursor is not None and time.time() - job.full_sync_time < self._full_sync_interval
+		bets = self._manifold_api.retrieve_all_data(api_call_func=self._manifold_api.get_bets, max_limit=1000, until_id=job.cursor if incremental else None,
+													user_id=user_id, username=username, contract_id=contract_id,  contract_slug=contract_slug)
+		self._count_reads(len(bets) // 1000 + 1)
+		# All bets of the user and/or market are retrieved, so stored bets that were not returned have been deleted
+		scope = {column: value for column, value in (("userId", user_id), ("contractId", contract_id)) if value is not None}
+		complete = scope and username is None and contract_slug is None and not incremental
+		changes = self._upsert("bets", bets, tracked_fields, scope=scope if complete else None)
+		# Deleted bets stay in the database, only report them the first time they are missing
+		if tracked_fields is not None and complete:
+			key = (user_id, username, contract_id, contract_slug)
+			reported = self._deleted_bets.get(key, set())
+			self._deleted_bets[key] = set(changes.deleted)
+			for bet_id in reported & self._deleted_bets[key]:
+				changes.deleted.remove(bet_id)
+				del changes.old[bet_id]
+		self._publish(BETS, bets)
+		if job is not None:
+			# Bets are returned newest first
+			if bets:
+				job.cursor = bets[0]["id"]
+			if not incremental:
+				job.full_sync_time = time.time()
+		return changes
+
+	def subscribe_to_market_positions(self, market_id, user_id, polling_time=60, callback=None, fields=None, max_polling_time=None):
 		'''
 		.. note:: 
-			Due to https://github.com/manifoldmarkets/manifold/issues/2031, this function will only subscribe to the top 4000 positions by order.
+			The API returns at most 4000 positions per query (https://github.com/manifoldmarkets/manifold/issues/2031). Positions of larger markets
+			are combined from several windows and per-user queries of the traders in the local bets, see ``sync_market_positions``.
 		
 		Continuously retrieves the positions of a market by its market_id and updates the manifold database. Optionally tracks positions of a specific user.
 
@@ -482,6 +1513,10 @@ class ManifoldSubscriber():
 			Required. The number of seconds between updates.
 		:param function callback:
 			Required. A function to be called when the job finishes. The function should accept no arguments.
+		:param list[str] fields:
+			Optional. Columns of the contract_metrics table to track. When set, the callback is called with a ``ChangeEvent`` of the rows whose tracked fields changed since its last call, and not called at all when nothing changed. Default is None.
+		:param int max_polling_time:
+			Optional. Enables adaptive polling: polls as often as every polling_time seconds while polls find traded positions, and backs off exponentially to every max_polling_time seconds while they do not. Default is None (fixed polling time).
 
 		:return:
 			None
@@ -495,10 +1530,13 @@ class ManifoldSubscriber():
 			  {
 				  "function": callback,
 				  "polling_time": polling_time,
+				  "fields": fields,
 			  }
-		  ])
+		  ],
+		  max_interval=max_polling_time,
+		  activity_fields=self.ACTIVITY_FIELDS["_update_market_positions"])
   
-		self._jobs_queue.put(job)
+		self._queue_job(job)
 
 	def unsubscribe_to_market_positions(self, market_id, user_id):
 		'''
@@ -516,12 +1554,13 @@ class ManifoldSubscriber():
 		  function=self._update_market_positions,
 		  params=(market_id, user_id))
 
-		self._jobs_queue.put(job)
+		self._queue_job(job)
   
 	def update_market_positions(self, market_id, user_id):
 		'''
 		.. note:: 
-			Due to https://github.com/manifoldmarkets/manifold/issues/2031 this function will only retrieve the top 4000 positions by order.
+			The API returns at most 4000 positions per query (https://github.com/manifoldmarkets/manifold/issues/2031). Positions of larger markets
+			are combined from several windows and per-user queries of the traders in the local bets, see ``sync_market_positions``.
 		
 		Retrieves the positions of a market by its market_id and updates the manifold database with the fetched data. Optionally retrieves positions for a specific user.
 
@@ -542,18 +1581,95 @@ class ManifoldSubscriber():
 		  params=(market_id, user_id),
 		  job_type=JobType.ONEOFF,
 		  future=future)
-		self._jobs_queue.put(job)
+		self._queue_job(job)
 		return future
 
-	def _update_market_positions(self, market_id, user_id):
+	def _update_market_positions(self, market_id, user_id, tracked_fields=None):
   
 		logger.debug(f"Updating market positions for market_id={market_id} and user_id={user_id}")
   
-		contract_metrics = self._manifold_api.get_market_positions(market_id=market_id, order='profit', top=2000, user_id=user_id).result()
-		self._manifold_db_writer.queue_write_operation(function=self._manifold_db.upsert_contract_metrics, data=contract_metrics).result()
+		if user_id is not None:
+			contract_metrics = self._manifold_api.get_market_positions(market_id=market_id, order='profit', top=self.POSITION_WINDOW, user_id=user_id).result()
+			self._count_reads(1)
+		else:
+			contract_metrics = self.sync_market_positions(market_id)
+		# Positions of large markets may be incomplete, so missing positions are not reported as deleted
+		changes = self._upsert("contract_metrics", contract_metrics, tracked_fields)
+		self._publish(POSITIONS, contract_metrics)
+		return changes
+
+
+	# Positions per query: the API fails for larger top or bottom windows
+	POSITION_WINDOW = 2000
 
+	def sync_market_positions(self, market_id):
+		'''
+		Retrieves every position of a market, also beyond the 4000 positions a single query can return.
+
+		- Markets with fewer than 2000 positions take one query (the top positions by profit).
+		- Otherwise the top and bottom 2000 positions by profit and by shares are retrieved in parallel. If a profit window returned fewer positions than its limit,
+		  or the top and bottom positions by profit overlap, they are complete.
+		- If not, the positions of traders of the market in the local ``bets`` table (see ``subscribe_to_bets``) that are missing from the windows are queried per user in parallel,
+		  those without a stored position first, then the longest unrefreshed. At most ``max_position_user_reads`` (a parameter of the subscriber) users are queried per call,
+		  so the positions of very large markets are completed over several calls. Every query counts against the read budget.
+		- A trader whose query returned no position is not queried again for ``full_sync_interval`` seconds, so a market of exactly 4000 positions, whose windows
+		  hold every position without overlapping, does not query its traders without a position on every call.
+
+		.. note::
+			This function is blocking. It does not write to the database.
+
+		:param str market_id:
+			Required. The ID of the market.
 
-	def subscribe_to_market(self, market_id, polling_time, callback):
+		:return:
+			The positions (contract metrics) of the market.
+		:rtype: list[dict]
+		'''
+		window = self.POSITION_WINDOW
+		top = self._manifold_api.get_market_positions(market_id=market_id, order='profit', top=window).result()
+		if len(top) < window:
+			self._count_reads(1)
+			return top
+
+		futures = [
+			self._manifold_api.get_market_positions(market_id=market_id, order='profit', bottom=window),
+			self._manifold_api.get_market_positions(market_id=market_id, order='shares', top=window),
+			self._manifold_api.get_market_positions(market_id=market_id, order='shares', bottom=window),
+		]
+		windows = [future.result() for future in futures]
+		reads = 1 + len(futures)
+		positions = {position["userId"]: position for position in top}
+		# A window shorter than its limit holds every position from its end, so together the profit windows hold them all
+		complete = len(windows[0]) < window or any(position["userId"] in positions for position in windows[0])
+		for window_positions in windows:
+			positions.update((position["userId"], position) for position in window_positions)
+
+		if not complete:
+			# The middle of the market by profit may be missing, fill it in from the known traders
+			now = time.time()
+			positionless = self._positionless_traders[market_id]
+			missing = [user_id for user_id in self._manifold_db.get_market_traders_by_staleness(market_id)
+					   if user_id not in positions and now - positionless.get(user_id, 0) >= self._full_sync_interval]
+			missing = missing[:self._max_position_user_reads]
+			futures = [(user_id, self._manifold_api.get_market_positions(market_id=market_id, order='profit', top=1, user_id=user_id)) for user_id in missing]
+			for user_id, future in futures:
+				try:
+					user_positions = future.result()
+				except Exception as e:
+					logger.error(f"Retrieving the position of user {user_id} in market {market_id} failed: {e}")
+					continue
+				if user_positions:
+					positionless.pop(user_id, None)
+					positions.update((position["userId"], position) for position in user_positions)
+				else:
+					positionless[user_id] = now
+			reads += len(futures)
+			logger.debug(f"Synced {len(positions)} positions of market {market_id}, queried {len(missing)} traders individually")
+
+		self._count_reads(reads)
+		return list(positions.values())
+
+	def subscribe_to_market(self, market_id, polling_time, callback, fields=None, max_polling_time=None):
 		'''
 		Continuously retrieves the (FullMarket) market for a specified market_id and updates the manifold database with the fetched data.
 
@@ -566,10 +1682,18 @@ class ManifoldSubscriber():
 			Required. The number of seconds between updates. 
 		:param callback:
 			Required. A function to be called when the job finishes. The function should accept no arguments.
+		:param list[str] fields:
+			Optional. Columns of the market (binary_choice_markets or multiple_choice_markets) table to track. When set, the callback is called with a ``ChangeEvent`` of the rows whose tracked fields changed since its last call, and not called at all when nothing changed. Default is None.
+		:param int max_polling_time:
+			Optional. Enables adaptive polling: polls as often as every polling_time seconds while polls find market updates, and backs off exponentially to every max_polling_time seconds while they do not. Default is None (fixed polling time).
 
 		:returns: 
 			None
 		'''
+		# Watched again by the scheduler when it adds the job, in case an unsubscription of the market was still queued
+		if self._market_state_store is not None:
+			self._market_state_store.watch(market_id, owner="subscribe_to_market")
+
 		job = Job(action=JobAction.ADD,
 		  function=self._update_market,
 		  params=(market_id,),
@@ -578,10 +1702,13 @@ class ManifoldSubscriber():
 			  {
 				  "function": callback,
 				  "polling_time": polling_time,
+				  "fields": fields,
 			  }
-		  ])
+		  ],
+		  max_interval=max_polling_time,
+		  activity_fields=self.ACTIVITY_FIELDS["_update_market"])
   
-		self._jobs_queue.put(job)
+		self._queue_job(job)
 
 	def unsubscribe_to_market(self, market_id):
 		'''
@@ -595,9 +1722,10 @@ class ManifoldSubscriber():
 		''' 
 		job = Job(action=JobAction.REMOVE,
 		  function=self._update_market,
-		  params=(market_id))
+		  params=(market_id,))
 
-		self._jobs_queue.put(job)
+		# The market is unwatched when the scheduler removes the job
+		self._queue_job(job)
 
 	def update_market(self, market_id):
 		'''
@@ -623,25 +1751,256 @@ class ManifoldSubscriber():
 		  params=(market_id,),
 		  job_type=JobType.ONEOFF,
 		  future=future)
-		self._jobs_queue.put(job)
+		self._queue_job(job)
 
 		return future
 	
  
-	def _update_market(self, market_id):
+	def _update_market(self, market_id, tracked_fields=None):
 		logger.debug(f"Updating market for market_id={market_id}")
   
 		market = self._manifold_api.get_market_by_id(market_id=market_id).result()
+		self._count_reads(1)
 		market["lite"] = False
 		if market["outcomeType"] == "BINARY":
-			self._manifold_db_writer.queue_write_operation(function=self._manifold_db.upsert_binary_choice_markets, data=[market]).result()
+			changes = self._upsert("binary_choice_markets", [market], tracked_fields)
 		elif market["outcomeType"] == "MULTIPLE_CHOICE":
-			self._manifold_db_writer.queue_write_operation(function=self._manifold_db.upsert_multiple_choice_markets, data=[market]).result()
+			changes = self._upsert("multiple_choice_markets", [market], tracked_fields)
 		else:
 			logger.error(f"Error, only binary and multiple choice markets are currently supported. Market is of type {market['outcomeType']}")
+			return
+
+		if self._market_state_store is not None:
+			self._market_state_store.update_markets([market], watched_only=True)
+		self._publish(MARKETS, [market])
+		return changes
      
 
-	def subscribe_to_all_markets(self, polling_time, callback):
+	def subscribe_to_markets(self, market_ids, polling_time, callback, fields=None):
+		'''
+		Continuously retrieves the (FullMarket) markets of a list of market IDs and updates the manifold database with the fetched data.
+		Meant for watching many markets: all markets subscribed to this way share one polling job, and adding or removing markets is O(1) per market.
+
+		Every polling_time seconds the shared job retrieves the next ``market_batch_size`` (a parameter of the subscriber) markets of the set,
+		so each market is retrieved every ``ceil(markets / market_batch_size)`` polls. Newly added markets are retrieved first.
+
+		.. note:: 
+			Only BC and MC markets right now.
+
+		:param list[str] market_ids:
+			Required. The IDs of the markets.
+		:param int polling_time:
+			Required. The number of seconds between batches. The shared job polls at the shortest polling time of its subscriptions.
+		:param callback:
+			Required. A function to be called when the job finishes. The function should accept no arguments.
+		:param list[str] fields:
+			Optional. Columns of the market (binary_choice_markets and multiple_choice_markets) table to track. When set, the callback is called with a ``ChangeEvent`` (table ``markets``) of the given markets whose tracked fields changed since its last call, and not called at all when nothing changed. Default is None.
+
+		:returns: 
+			None
+		'''
+		logger.debug(f"Subscribing to {len(market_ids)} markets with polling time {polling_time} seconds and callback {callback.__name__ if callback else None}")
+
+		added = []
+		with self._market_set_lock:
+			for market_id in market_ids:
+				count = self._market_set.get(market_id, 0)
+				self._market_set[market_id] = count + 1
+				if count == 0:
+					added.append(market_id)
+			# New markets are retrieved first, in the given order
+			self._market_round.extendleft(reversed(added))
+		if self._market_state_store is not None and added:
+			self._market_state_store.watch_markets(added, owner="subscribe_to_markets")
+
+		job = Job(action=JobAction.ADD,
+			function=self._update_markets,
+			params=(),
+			job_type=JobType.INTERVAL,
+			callbacks=[
+				{
+					"function": callback,
+					"polling_time": polling_time,
+					"fields": fields,
+					"keys": frozenset(market_ids),
+				}
+			])
+
+		self._queue_job(job)
+
+	def unsubscribe_to_markets(self, market_ids, callback=None):
+		'''
+		Removes markets subscribed to with ``subscribe_to_markets``. A market is only removed from the shared job once every subscription to it is removed,
+		and the shared job stops when no markets are left.
+
+		:param list[str] market_ids:
+			Required. The IDs of the markets.
+		:param callback:
+			Optional. The callback of the subscription, which is removed from the shared job. Default is None (callbacks are kept).
+
+		:returns: 
+			None
+		'''
+		removed = []
+		with self._market_set_lock:
+			for market_id in market_ids:
+				count = self._market_set.get(market_id, 0)
+				if count > 1:
+					self._market_set[market_id] = count - 1
+				elif count == 1:
+					del self._market_set[market_id]
+					removed.append(market_id)
+			empty = not self._market_set
+		if self._market_state_store is not None and removed:
+			self._market_state_store.unwatch_markets(removed, owner="subscribe_to_markets")
+
+		if empty:
+			job = Job(action=JobAction.REMOVE,
+			  function=self._update_markets,
+			  params=())
+			self._queue_job(job)
+		elif callback is not None:
+			job = Job(action=JobAction.REMOVE,
+			  function=self._update_markets,
+			  params=(),
+			  callbacks=[{"function": callback, "polling_time": 0}])
+			self._queue_job(job)
+
+	def _update_markets(self, tracked_fields=None):
+		# Take the next batch of the market set, starting a new round once every market was retrieved
+		batch = []
+		with self._market_set_lock:
+			refilled = False
+			while len(batch) < self._market_batch_size:
+				if not self._market_round:
+					if refilled or not self._market_set:
+						break
+					self._market_round.extend(self._market_set)
+					refilled = True
+				market_id = self._market_round.popleft()
+				# Removed markets are skipped, markets added during the round may already be in the batch
+				if market_id in self._market_set and market_id not in batch:
+					batch.append(market_id)
+		logger.debug(f"Updating a batch of {len(batch)} markets")
+		return self._write_rows(MARKETS, self._fetch_by_ids(MARKETS, batch), tracked_fields)
+
+	def _fetch_by_ids(self, topic, ids):
+		# Retrieves markets or users in parallel, one read each. Failed reads are logged and left out.
+		if topic == MARKETS:
+			futures = [self._manifold_api.get_market_by_id(market_id=market_id) for market_id in ids]
+		else:
+			futures = [self._manifold_api.get_user_by_id(user_id=user_id) for user_id in ids]
+		self._count_reads(len(ids))
+		rows = []
+		for row_id, future in zip(ids, futures):
+			try:
+				row = future.result()
+			except Exception as e:
+				logger.error(f"Retrieving {topic} {row_id} failed: {e}")
+				continue
+			if topic == MARKETS:
+				row["lite"] = False
+			rows.append(row)
+		return rows
+
+	def refresh_markets(self, market_ids):
+		'''
+		Retrieves (FullMarket) markets now and updates the manifold database, for reads that need fresh data (see ``ManifoldDatabaseReader.get_markets``).
+
+		Markets already being refreshed for another caller are not retrieved again, the caller waits for the same retrieval.
+
+		:param list[str] market_ids: Required. The market IDs.
+
+		:return:
+			A Future that completes once every market is written to the database.
+
+		:rtype: Future
+		'''
+		return self._refresh(MARKETS, market_ids)
+
+	def refresh_users(self, user_ids):
+		'''
+		Retrieves user profiles now and updates the manifold database, for reads that need fresh data (see ``ManifoldDatabaseReader.get_users``).
+
+		Users already being refreshed for another caller are not retrieved again, the caller waits for the same retrieval.
+
+		:param list[str] user_ids: Required. The user IDs.
+
+		:return:
+			A Future that completes once every user is written to the database.
+
+		:rtype: Future
+		'''
+		return self._refresh(USERS, user_ids)
+
+	def _refresh(self, topic, ids):
+		futures = set()
+		new_ids = []
+		with self._refresh_lock:
+			refreshing = self._refreshing[topic]
+			for row_id in dict.fromkeys(ids):
+				if row_id in refreshing:
+					futures.add(refreshing[row_id])
+				else:
+					new_ids.append(row_id)
+			if new_ids:
+				future = Future()
+				for row_id in new_ids:
+					refreshing[row_id] = future
+				futures.add(future)
+		if new_ids:
+			logger.debug(f"Refreshing {len(new_ids)} {topic}")
+			self._executor.submit(self._execute_refresh, topic, new_ids, future)
+		return self._gather(futures)
+
+	def _execute_refresh(self, topic, ids, future):
+		self._execution.reads = 0
+		try:
+			self._write_rows(topic, self._fetch_by_ids(topic, ids))
+		except Exception as e:
+			error = e
+		else:
+			error = None
+		finally:
+			self._read_planner.observe(("_refresh", topic), self._execution.reads)
+			with self._refresh_lock:
+				refreshing = self._refreshing[topic]
+				for row_id in ids:
+					if refreshing.get(row_id) is future:
+						del refreshing[row_id]
+		if error is not None:
+			future.set_exception(error)
+		else:
+			future.set_result(True)
+
+	def _gather(self, futures):
+		# A Future that completes when all futures did, with the first exception if one failed
+		if len(futures) == 1:
+			return next(iter(futures))
+		gathered = Future()
+		remaining = [len(futures)]
+		lock = threading.Lock()
+		def done(future):
+			with lock:
+				remaining[0] -= 1
+				last = remaining[0] == 0
+			if future.exception() is not None and not gathered.done():
+				try:
+					gathered.set_exception(future.exception())
+				except Exception:
+					pass
+			elif last and not gathered.done():
+				try:
+					gathered.set_result(True)
+				except Exception:
+					pass
+		if not futures:
+			gathered.set_result(True)
+		for future in futures:
+			future.add_done_callback(done)
+		return gathered
+
+	def subscribe_to_all_markets(self, polling_time, callback, fields=None):
 		'''
 		Continuously retrieves all (LiteMarket) markets and updates the manifold database.
 
@@ -652,6 +2011,8 @@ class ManifoldSubscriber():
 			Required. The number of seconds between updates. 
 		:param callback:
 			Required. A function to be called when the job finishes. The function should accept no arguments.
+		:param list[str] fields:
+			Optional. Columns of the market (binary_choice_markets and multiple_choice_markets) table to track. When set, the callback is called with a ``ChangeEvent`` of the rows whose tracked fields changed since its last call, and not called at all when nothing changed. Default is None.
 
 		:returns: 
 			None
@@ -666,11 +2027,12 @@ class ManifoldSubscriber():
 			callbacks=[
 				{
 					"function": callback,
-					"polling_time": polling_time	
+					"polling_time": polling_time,
+					"fields": fields,
 				}
 			])
 
-		self._jobs_queue.put(job) 
+		self._queue_job(job)
 
 	def unsubscribe_to_all_markets(self):
 		'''
@@ -683,7 +2045,24 @@ class ManifoldSubscriber():
 		  function=self._update_all_markets,
 		  params=()) 
 
-		self._jobs_queue.put(job)
+		self._queue_job(job)
+
+	def remove_callbacks(self, callback):
+		'''
+		Removes a callback from every subscription it was passed to. Subscriptions left without callbacks stop.
+
+		:param callback:
+			Required. The callback function.
+
+		:returns: 
+			None
+		'''
+		for job in list(self._jobs.values()):
+			if any(cb['function'] == callback for cb in job.callbacks):
+				self._queue_job(Job(action=JobAction.REMOVE,
+				  function=job.function,
+				  params=job.params,
+				  callbacks=[{'function': callback, 'polling_time': 0}]))
 
 	def update_all_markets(self):
 		'''
@@ -706,13 +2085,14 @@ class ManifoldSubscriber():
 			future=future
 			)
    
-		self._jobs_queue.put(job)
+		self._queue_job(job)
 		return future
 		
-	def _update_all_markets(self):
+	def _update_all_markets(self, tracked_fields=None):
 		logger.debug("Updating all markets")
   
 		markets = self._manifold_api.retrieve_all_data(self._manifold_api.get_markets, max_limit=1000)
+		self._count_reads(len(markets) // 1000 + 1)
 		binary_choice_markets = []
 		multiple_choice_markets = []
 		for market in markets:
@@ -721,9 +2101,14 @@ class ManifoldSubscriber():
 				binary_choice_markets.append(market)
 			elif market["outcomeType"] == "MULTIPLE_CHOICE":
 				multiple_choice_markets.append(market)
-   
-		self._manifold_db_writer.queue_write_operation(function=self._manifold_db.upsert_binary_choice_markets, data=binary_choice_markets).result()
-		self._manifold_db_writer.queue_write_operation(function=self._manifold_db.upsert_multiple_choice_markets, data=multiple_choice_markets).result()
+
+		changes = self._upsert_markets(binary_choice_markets, multiple_choice_markets, tracked_fields)
+
+		# Refresh the live state of watched markets
+		if self._market_state_store is not None:
+			self._market_state_store.update_markets(binary_choice_markets + multiple_choice_markets, watched_only=True)
+		self._publish(MARKETS, binary_choice_markets + multiple_choice_markets)
+		return changes
  
  
   
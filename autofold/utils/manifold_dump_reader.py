@@ -1,6 +1,380 @@
-# # TODO
-# def processMarketsDump():
-#     pass
+import gzip
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from loguru import logger
 
-# def processBetsDump():
-#     pass
\ No newline at end of file
+from autofold.database import WRITE_PRIORITY_BULK
+
+
+def _open_dump(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+class _ArrayReader:
+    # Reads a JSON array dump chunk by chunk, keeping only the unread tail in memory
+    def __init__(self, file, chunk_size, max_record_size):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.max_record_size = max_record_size
+        self.buffer = ""
+        self.pos = 0
+        self.offset = 0
+        self.eof = False
+
+    def skip_separators(self):
+        # Skips whitespace and commas, reading more data as needed. Returns the next character, or "" at the end of the file.
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n,":
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.read_more():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def read_more(self):
+        if self.eof:
+            return False
+        chunk = self.file.read(self.chunk_size)
+        self.eof = not chunk
+        self.offset += self.pos
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return bool(chunk)
+
+    def start(self):
+        if self.skip_separators() != "[":
+            raise ValueError("Dump is not a JSON array")
+        self.pos += 1
+
+    def decode_record(self, decoder):
+        # Returns the next record and the raw text it was decoded from, or None after the closing bracket
+        while True:
+            next_character = self.skip_separators()
+            if next_character == "":
+                raise ValueError("Dump ended before the closing bracket of its JSON array")
+            if next_character == "]":
+                return None
+            try:
+                record, end = decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as e:
+                # The record is incomplete or malformed, read more of it up to max_record_size
+                if len(self.buffer) - self.pos > self.max_record_size or not self.read_more():
+                    raise ValueError(f"Malformed record or record larger than {self.max_record_size} characters "
+                                     f"at offset {self.offset + self.pos} of the dump: {e}")
+                continue
+            raw = self.buffer[self.pos:end]
+            self.pos = end
+            return record, raw
+
+
+def _iter_json_array(file, chunk_size, max_record_size):
+    reader = _ArrayReader(file, chunk_size, max_record_size)
+    reader.start()
+    decoder = json.JSONDecoder()
+    while True:
+        decoded = reader.decode_record(decoder)
+        if decoded is None:
+            return
+        yield decoded[0]
+
+
+def _decode_lines(lines):
+    return [json.loads(line) for line in lines if line.strip()]
+
+
+def _decode_array_piece(piece):
+    # Returns None if the piece does not hold whole records, because it was cut inside a record
+    try:
+        records = json.loads("[" + piece + "]")
+    except ValueError:
+        return None
+    return records if all(isinstance(record, dict) for record in records) else None
+
+
+def _iter_json_array_pieces(file, chunk_size, batch_size, max_record_size):
+    # Cuts a JSON array into pieces of about batch_size records without decoding them. Records serialized alike start with the same text
+    # up to their first key (e.g. '{"id":'), so pieces are cut before that text where a comma precedes it. The text can also start a
+    # nested object; such cuts are detected when the piece is decoded, and the pieces around them are joined again.
+    # Yields the decoded first record as ([record], None), then (None, piece) for the rest.
+    reader = _ArrayReader(file, chunk_size, max_record_size)
+    reader.start()
+    decoded = reader.decode_record(json.JSONDecoder())
+    if decoded is None:
+        return
+    first, raw = decoded
+    yield [first], None
+    colon = raw.find(":")
+    marker = raw[:colon + 1] if raw.startswith("{") and colon > 0 else None
+    piece_size = len(raw) * batch_size
+
+    while True:
+        next_character = reader.skip_separators()
+        if next_character == "":
+            raise ValueError("Dump ended before the closing bracket of its JSON array")
+        if next_character == "]":
+            return
+        cut = -1
+        while marker is not None:
+            cut = reader.buffer.find(marker, reader.pos + piece_size)
+            while cut != -1 and reader.buffer[:cut].rstrip()[-1:] != ",":
+                cut = reader.buffer.find(marker, cut + 1)
+            if cut != -1 or reader.eof or len(reader.buffer) - reader.pos > piece_size + max_record_size:
+                break
+            reader.read_more()
+        if cut == -1:
+            # No cut ahead, the rest of the array is the last piece
+            while not reader.eof:
+                if len(reader.buffer) - reader.pos > piece_size + max_record_size:
+                    raise ValueError(f"Cannot split the dump into records of at most {max_record_size} characters "
+                                     f"at offset {reader.offset + reader.pos}")
+                reader.read_more()
+            end = reader.buffer.rstrip().rfind("]")
+            if end < reader.pos:
+                raise ValueError("Dump ended before the closing bracket of its JSON array")
+            piece, reader.pos = reader.buffer[reader.pos:end], end
+        else:
+            piece, reader.pos = reader.buffer[reader.pos:cut], cut
+        yield None, piece.rstrip().rstrip(",")
+
+
+def _iter_json_array_parallel(file, chunk_size, batch_size, workers, max_record_size):
+    # Decodes pieces of the array in worker processes, keeping at most 2 * workers pieces in flight
+    def results(executor):
+        pending = deque()
+        for records, piece in _iter_json_array_pieces(file, chunk_size, batch_size, max_record_size):
+            if records is not None:
+                yield records, None
+                continue
+            pending.append((executor.submit(_decode_array_piece, piece), piece))
+            if len(pending) >= 2 * workers:
+                future, piece = pending.popleft()
+                yield future.result(), piece
+        while pending:
+            future, piece = pending.popleft()
+            yield future.result(), piece
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Pieces that failed to decode, joined until they hold whole records
+        carry = None
+        for records, piece in results(executor):
+            if carry is not None:
+                # A piece after a bad cut starts inside a record, so it cannot decode on its own
+                if records is not None:
+                    raise ValueError("Malformed record in the dump")
+                carry += "," + piece
+                if len(carry) > 2 * max_record_size + len(piece):
+                    raise ValueError(f"Malformed record or record larger than {max_record_size} characters in the dump")
+                records = _decode_array_piece(carry)
+                if records is None:
+                    continue
+                carry = None
+            elif records is None:
+                carry = piece
+                continue
+            yield records
+        if carry is not None:
+            raise ValueError("Malformed record in the dump")
+
+
+def iter_dump_batches(path, batch_size=5000, chunk_size=1 << 20, workers=1, max_record_size=16 << 20):
+    '''
+    Incrementally reads a Manifold data dump and yields lists of records. Only the current chunks and batches are held in memory.
+
+    Supports a single JSON array (the format of the official dumps) or one JSON object per line (``.jsonl``), optionally gzip compressed (``.gz``).
+
+    :param str path: Required. Path to the dump file.
+    :param int batch_size: Optional. The number of records per batch (approximate for JSON arrays decoded by several workers). Default is 5000.
+    :param int chunk_size: Optional. The number of characters read from the file at a time. Default is 1 MiB.
+    :param int workers: Optional. The number of processes decoding batches in parallel. Default is 1.
+    :param int max_record_size: Optional. The maximum number of characters of one record. Default is 16 MiB.
+    :raises ValueError: If the dump is malformed or holds a record larger than ``max_record_size``.
+    :return: A generator of record batches.
+    :rtype: Iterator[list[dict]]
+    '''
+    with _open_dump(path) as file:
+        first = file.read(1)
+        while first and first.isspace():
+            first = file.read(1)
+
+        # JSON array
+        if first == "[" and workers > 1:
+            yield from _iter_json_array_parallel(_PrefixedFile(first, file), chunk_size, batch_size, workers, max_record_size)
+            return
+        if first == "[":
+            batch = []
+            for record in _iter_json_array(_PrefixedFile(first, file), chunk_size, max_record_size):
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+            return
+
+        # JSON lines
+        lines = _PrefixedFile(first, file).lines(max_record_size)
+        if workers <= 1:
+            batch = []
+            for line in lines:
+                if line.strip():
+                    batch.append(json.loads(line))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+            return
+
+        # Decode raw line chunks in parallel, keeping at most 2 * workers chunks in flight
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            raw = []
+            for line in lines:
+                raw.append(line)
+                if len(raw) >= batch_size:
+                    pending.append(executor.submit(_decode_lines, raw))
+                    raw = []
+                    if len(pending) >= 2 * workers:
+                        yield pending.popleft().result()
+            if raw:
+                pending.append(executor.submit(_decode_lines, raw))
+            while pending:
+                yield pending.popleft().result()
+
+
+class _PrefixedFile:
+    # Puts back the characters consumed while sniffing the dump format
+    def __init__(self, prefix, file):
+        self._prefix = prefix
+        self._file = file
+
+    def read(self, size):
+        if self._prefix:
+            data, self._prefix = self._prefix + self._file.read(max(size - len(self._prefix), 0)), ""
+            return data
+        return self._file.read(size)
+
+    def lines(self, max_size):
+        # Reads at most max_size + 1 characters per line, so an oversized line is detected without reading all of it
+        while True:
+            line = self.readline(max_size + 1)
+            if not line:
+                return
+            if len(line) > max_size:
+                raise ValueError(f"Record larger than {max_size} characters in the dump")
+            yield line
+
+    def readline(self, size):
+        if self._prefix:
+            line, self._prefix = self._prefix + self._file.readline(max(size - len(self._prefix), 0)), ""
+            return line
+        return self._file.readline(size)
+
+
+def _import_dump(path, manifold_db, manifold_db_writer, route, kind, batch_size, max_pending,
+                 workers, progress_interval, progress_callback):
+    stats = {"rows": 0, "skipped": 0, "batches": 0, "seconds": 0.0, "rows_per_second": 0.0}
+    start = time.time()
+    last_report = start
+    pending = deque()
+
+    def report():
+        stats["seconds"] = time.time() - start
+        stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["seconds"] else 0.0
+        logger.info(f"Imported {stats['rows']} {kind} ({stats['rows_per_second']:.0f} rows/s)")
+        if progress_callback:
+            progress_callback(dict(stats))
+
+    for batch in iter_dump_batches(path, batch_size=batch_size, workers=workers):
+        routed = route(batch)
+        for function, records in routed:
+            if records:
+                future = manifold_db_writer.queue_write_operation(function=manifold_db.bulk_write, data=(function.__name__, records),
+                                                                  priority=WRITE_PRIORITY_BULK)
+                pending.append((future, len(records)))
+
+        stats["skipped"] += len(batch) - sum(len(records) for _, records in routed)
+        stats["batches"] += 1
+
+        # Bound memory by waiting on the oldest writes
+        while len(pending) > max_pending:
+            future, rows = pending.popleft()
+            future.result()
+            stats["rows"] += rows
+
+        if time.time() - last_report >= progress_interval:
+            last_report = time.time()
+            report()
+
+    while pending:
+        future, rows = pending.popleft()
+        future.result()
+        stats["rows"] += rows
+
+    report()
+    return stats
+
+
+def import_markets_dump(path, manifold_db, manifold_db_writer, batch_size=5000, max_pending=4, workers=1,
+                        progress_interval=5, progress_callback=None):
+    '''
+    Streams a markets dump into the manifold database. Binary and multiple choice markets are upserted in batches
+    through the bulk lane of the ``ManifoldDatabaseWriter``, each in bulk-load mode; other market types are skipped.
+
+    .. note::
+        This function is blocking.
+
+    :param str path: Required. Path to the markets dump (see ``iter_dump_batches`` for supported formats).
+    :param ManifoldDatabase manifold_db: Required. The database to import into.
+    :param ManifoldDatabaseWriter manifold_db_writer: Required. The writer the upserts are queued on.
+    :param int batch_size: Optional. The number of records per upsert. Default is 5000.
+    :param int max_pending: Optional. The maximum number of batches queued on the writer at once. Default is 4.
+    :param int workers: Optional. Processes decoding the dump in parallel. Default is 1.
+    :param float progress_interval: Optional. Seconds between progress reports. Default is 5.
+    :param function progress_callback: Optional. Called with a copy of the statistics dict on every progress report.
+    :return: Statistics with the number of ``rows`` imported, ``skipped`` records, ``batches``, ``seconds`` and ``rows_per_second``.
+    :rtype: dict
+    '''
+    def route(markets):
+        binary_choice_markets = []
+        multiple_choice_markets = []
+        for market in markets:
+            market["lite"] = False
+            if market.get("outcomeType") == "BINARY":
+                binary_choice_markets.append(market)
+            elif market.get("outcomeType") == "MULTIPLE_CHOICE":
+                multiple_choice_markets.append(market)
+        return [(manifold_db.upsert_binary_choice_markets, binary_choice_markets),
+                (manifold_db.upsert_multiple_choice_markets, multiple_choice_markets)]
+
+    return _import_dump(path, manifold_db, manifold_db_writer, route, "markets", batch_size, max_pending,
+                        workers, progress_interval, progress_callback)
+
+
+def import_bets_dump(path, manifold_db, manifold_db_writer, batch_size=10000, max_pending=4, workers=1,
+                     progress_interval=5, progress_callback=None):
+    '''
+    Streams a bets dump into the manifold database. Bets are upserted in batches through the bulk lane of the
+    ``ManifoldDatabaseWriter``, each in bulk-load mode.
+
+    .. note::
+        This function is blocking.
+
+    :param str path: Required. Path to the bets dump (see ``iter_dump_batches`` for supported formats).
+    :param ManifoldDatabase manifold_db: Required. The database to import into.
+    :param ManifoldDatabaseWriter manifold_db_writer: Required. The writer the upserts are queued on.
+    :param int batch_size: Optional. The number of records per upsert. Default is 10000.
+    :param int max_pending: Optional. The maximum number of batches queued on the writer at once. Default is 4.
+    :param int workers: Optional. Processes decoding the dump in parallel. Default is 1.
+    :param float progress_interval: Optional. Seconds between progress reports. Default is 5.
+    :param function progress_callback: Optional. Called with a copy of the statistics dict on every progress report.
+    :return: Statistics with the number of ``rows`` imported, ``skipped`` records, ``batches``, ``seconds`` and ``rows_per_second``.
+    :rtype: dict
+    '''
+    def route(bets):
+        return [(manifold_db.upsert_bets, [bet for bet in bets if "id" in bet])]
+
+    return _import_dump(path, manifold_db, manifold_db_writer, route, "bets", batch_size, max_pending,
+                        workers, progress_interval, progress_callback)
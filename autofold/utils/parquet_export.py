@@ -0,0 +1,269 @@
+import json
+import os
+import time
+from datetime import datetime, timezone
+from loguru import logger
+
+'''
+Export specifications.
+
+- ``table``: The table the rows come from.
+- ``flatten``: One-to-one nested tables joined into the row. Their columns are prefixed with the given name (``fees_creatorFee``).
+- ``parent``: For one-to-many nested tables, the parent table and join columns. The parent's retrievedTimestamp is exported with every row.
+'''
+EXPORTS = {
+    "users": {
+        "table": "users",
+        "flatten": [("users_profit_cached", "profitCached", [("userId", "id")]),
+                    ("users_creator_traders", "creatorTraders", [("userId", "id")])],
+    },
+    "binary_choice_markets": {"table": "binary_choice_markets"},
+    "multiple_choice_markets": {"table": "multiple_choice_markets"},
+    "multiple_choice_market_answers": {
+        "table": "multiple_choice_market_answers",
+        "parent": ("multiple_choice_markets", [("contractId", "id")]),
+    },
+    "contract_metrics": {"table": "contract_metrics"},
+    "contract_metrics_from": {
+        "table": "contract_metrics_from",
+        "parent": ("contract_metrics", [("contractId", "contractId"), ("userId", "userId")]),
+    },
+    "contract_metrics_totalShares": {
+        "table": "contract_metrics_totalShares",
+        "parent": ("contract_metrics", [("contractId", "contractId"), ("userId", "userId")]),
+    },
+    "bets": {
+        "table": "bets",
+        "flatten": [("bet_fees", "fees", [("betId", "id")])],
+    },
+    "bet_fills": {
+        "table": "bet_fills",
+        "parent": ("bets", [("betId", "id")]),
+    },
+}
+
+STATE_FILE = "_export_state.json"
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Exporting to parquet requires pyarrow. Install it with: pip install autofold[export]")
+    return pyarrow
+
+
+def _arrow_type(pa, declared_type):
+    declared_type = (declared_type or "").upper()
+    if declared_type in ("INTEGER", "BOOLEAN"):
+        return pa.int64()
+    if declared_type == "REAL":
+        return pa.float64()
+    return pa.string()
+
+
+def _coerce(value, arrow_type, pa):
+    # SQLite does not enforce column types, so the odd value may not match the declared type.
+    # Values that cannot be converted are exported as null.
+    if value is None:
+        return None
+    try:
+        if arrow_type == pa.int64():
+            return int(value)
+        if arrow_type == pa.float64():
+            return float(value)
+    except (TypeError, ValueError):
+        return None
+    return str(value)
+
+
+def _build_query(conn, spec):
+    '''
+    Returns the SQL query and the list of (column name, declared type) for an export spec.
+    '''
+    def columns_of(table):
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        return [(row[1], row[2]) for row in cursor.execute(f"PRAGMA table_info({table});").fetchall()]
+
+    table = spec["table"]
+    select = []
+    columns = []
+    joins = ""
+    timestamp = "t.retrievedTimestamp"
+
+    for name, declared_type in columns_of(table):
+        # Surrogate keys of nested tables carry no information
+        if name == "id" and "parent" in spec:
+            continue
+        select.append(f't."{name}"')
+        columns.append((name, declared_type))
+
+    for index, (child, prefix, keys) in enumerate(spec.get("flatten", [])):
+        key_columns = {child_key for child_key, _ in keys}
+        on = " AND ".join(f'c{index}."{child_key}" = t."{parent_key}"' for child_key, parent_key in keys)
+        joins += f" LEFT JOIN {child} c{index} ON {on}"
+        for name, declared_type in columns_of(child):
+            if name == "id" or name in key_columns:
+                continue
+            select.append(f'c{index}."{name}"')
+            columns.append((f"{prefix}_{name}", declared_type))
+
+    if "parent" in spec:
+        parent, keys = spec["parent"]
+        on = " AND ".join(f'p."{parent_key}" = t."{child_key}"' for child_key, parent_key in keys)
+        joins += f" JOIN {parent} p ON {on}"
+        timestamp = "p.retrievedTimestamp"
+        select.append(timestamp)
+        columns.append(("retrievedTimestamp", "INTEGER"))
+
+    query = (f"SELECT {', '.join(select)} FROM {table} t{joins} "
+             f"WHERE {timestamp} > ? AND {timestamp} < ? ORDER BY {timestamp}")
+    return query, columns
+
+
+def _load_state(output_dir):
+    path = os.path.join(output_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def _save_state(output_dir, state):
+    path = os.path.join(output_dir, STATE_FILE)
+    with open(path + ".tmp", "w") as file:
+        json.dump(state, file, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def export_table(manifold_db, output_dir, name, since=0, until=None, chunk_size=50000, compression="zstd"):
+    '''
+    Streams the rows of one export (see ``EXPORTS``) retrieved in ``(since, until)`` into parquet files partitioned by retrieval date:
+    ``<output_dir>/<name>/retrieved_date=YYYY-MM-DD/part-<until>-<n>.parquet``.
+
+    :param ManifoldDatabase manifold_db: Required. The database to export from.
+    :param str output_dir: Required. The root directory of the export.
+    :param str name: Required. The name of the export, a key of ``EXPORTS``.
+    :param int since: Optional. Only export rows retrieved after this UNIX epoch time in seconds. Default is 0.
+    :param int until: Optional. Only export rows retrieved before this UNIX epoch time in seconds. Default is the current second.
+    :param int chunk_size: Optional. The number of rows fetched and written at a time. Default is 50000.
+    :param str compression: Optional. The parquet compression codec. Default is zstd.
+    :return: A dict with the number of ``rows`` and ``files`` written and the largest ``retrievedTimestamp`` exported (or None).
+    :rtype: dict
+    '''
+    pa = _import_pyarrow()
+    import pyarrow.parquet as pq
+
+    if until is None:
+        until = int(time.time())
+
+    conn = manifold_db.get_conn()
+    manifold_db.enable_partition_views(conn)
+    query, columns = _build_query(conn, EXPORTS[name])
+    arrow_types = [_arrow_type(pa, declared_type) for _, declared_type in columns]
+    schema = pa.schema([(column, arrow_type) for (column, _), arrow_type in zip(columns, arrow_types)])
+    timestamp_index = [column for column, _ in columns].index("retrievedTimestamp")
+
+    result = {"rows": 0, "files": 0, "retrievedTimestamp": None}
+    writer = None
+    partition = None
+
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(query, (since, until))
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+
+            # Rows are ordered by retrievedTimestamp, so each partition is one contiguous run
+            start = 0
+            while start < len(rows):
+                day = rows[start][timestamp_index] // 86400
+                end = start
+                while end < len(rows) and rows[end][timestamp_index] // 86400 == day:
+                    end += 1
+
+                if day != partition:
+                    if writer:
+                        writer.close()
+                    date = datetime.fromtimestamp(day * 86400, tz=timezone.utc).strftime("%Y-%m-%d")
+                    partition_dir = os.path.join(output_dir, name, f"retrieved_date={date}")
+                    os.makedirs(partition_dir, exist_ok=True)
+                    writer = pq.ParquetWriter(os.path.join(partition_dir, f"part-{until}-{result['files']}.parquet"), schema, compression=compression)
+                    partition = day
+                    result["files"] += 1
+
+                run = rows[start:end]
+                arrays = []
+                for index, arrow_type in enumerate(arrow_types):
+                    values = [row[index] for row in run]
+                    try:
+                        arrays.append(pa.array(values, type=arrow_type))
+                    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+                        arrays.append(pa.array([_coerce(value, arrow_type, pa) for value in values], type=arrow_type))
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+                result["rows"] += len(run)
+                result["retrievedTimestamp"] = run[-1][timestamp_index]
+                start = end
+    finally:
+        cursor.close()
+        if writer:
+            writer.close()
+
+    logger.debug(f"Exported {result['rows']} rows of {name} to {result['files']} files")
+    return result
+
+
+def export_to_parquet(manifold_db, output_dir, exports=None, full=False, lag=60, chunk_size=50000, compression="zstd"):
+    '''
+    Incrementally exports the manifold database to partitioned parquet files for offline analysis.
+
+    Each run only exports rows retrieved since the previous run (tracked per export in ``<output_dir>/_export_state.json``).
+    Rows retrieved in the last ``lag`` seconds are left for the next run, so that rows of upserts still in progress are not skipped.
+    One-to-one nested tables (profit cached, creator traders, bet fees) are flattened into their parent rows; one-to-many nested
+    tables (answers, contract metrics from/totalShares, bet fills) are exported separately with their parent's retrievedTimestamp.
+
+    Requires the optional ``pyarrow`` dependency.
+
+    .. note::
+        This function is blocking.
+
+    **Example**
+
+    .. code-block:: python
+
+        export_to_parquet(manifold_db, "exports/")
+        bets = pyarrow.dataset.dataset("exports/bets", partitioning="hive").to_table()
+
+    :param ManifoldDatabase manifold_db: Required. The database to export from.
+    :param str output_dir: Required. The root directory of the export.
+    :param list[str] exports: Optional. The exports to run (keys of ``EXPORTS``). Default is all of them.
+    :param bool full: Optional. Ignore the saved state and export everything. Use a fresh ``output_dir``, existing files are kept. Default is False.
+    :param int lag: Optional. Seconds of recent data left for the next run. Default is 60.
+    :param int chunk_size: Optional. The number of rows fetched and written at a time. Default is 50000.
+    :param str compression: Optional. The parquet compression codec. Default is zstd.
+    :return: A dict mapping each export name to its result (see ``export_table``).
+    :rtype: dict
+    '''
+    _import_pyarrow()
+    os.makedirs(output_dir, exist_ok=True)
+
+    state = {} if full else _load_state(output_dir)
+    until = int(time.time()) - lag
+    results = {}
+
+    for name in exports or EXPORTS:
+        since = state.get(name, 0)
+        logger.info(f"Exporting {name} retrieved after {since}")
+        results[name] = export_table(manifold_db, output_dir, name, since=since, until=until,
+                                     chunk_size=chunk_size, compression=compression)
+        if results[name]["retrievedTimestamp"] is not None:
+            state[name] = results[name]["retrievedTimestamp"]
+            _save_state(output_dir, state)
+
+    return results
@@ -2,6 +2,7 @@ import time
 from loguru import logger
 from tinydb import where
 from autofold.automation import Automation
+from autofold.event_bus import MARKETS
 from autofold.bot import AutomationBot
 
 
@@ -23,6 +24,9 @@ class TemplateAutomation(Automation):
 			logger.info("Automation has already been initialized.") 
 		  	# ... logic
    
+		# React to market updates retrieved by the subscriber as they arrive, instead of polling the database
+		market_events = self.event_bus.subscribe([MARKETS])
+
 		# You can add extra logic here to repeat the automation every hour or whatever
 		next_run_timestamp = time.time() + 60 * 60
 		while self.running:
@@ -31,8 +35,12 @@ class TemplateAutomation(Automation):
 				# ... logic
 				pass
 
-			# Check the self.running condition frequently, otherwise you will have trouble exiting the program
-			time.sleep(1)
+			# Wait at most a second, otherwise you will have trouble exiting the program
+			for event in market_events.get_batch(timeout=1):
+				# ... logic, e.g. event.market_id and event.market
+				pass
+
+		market_events.close()
 	
 	def stop(self):
 		self.running = False
@@ -0,0 +1,155 @@
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+from autofold.automation import Automation
+from autofold.automation_process import AutomationHub, _Channel, _RemoteCallback
+from autofold.database import ManifoldDatabase, ManifoldDatabaseWriter
+from autofold.event_bus import EventBus, USERS
+from autofold.subscriber import ManifoldSubscriber, CallbackExecutor
+
+
+def resolved(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+class StubAPI:
+    def get_user_by_id(self, user_id):
+        return resolved({"id": user_id, "name": user_id, "username": user_id, "createdTime": 1, "balance": 100, "totalDeposits": 100})
+
+
+class ProbeAutomation(Automation):
+    # Runs in the worker process and writes what it saw to results_path
+    def __init__(self, tiny_db_path, results_path):
+        super().__init__(tiny_db_path)
+        self.results_path = results_path
+
+    def start(self):
+        self.called = threading.Event()
+        self.hanging = threading.Event()
+        self.done = threading.Event()
+        events = self.event_bus.subscribe([USERS], keys=["u1"])
+        self.manifold_subscriber.subscribe_to_user("u1", polling_time=0.1, callback=self.on_user)
+        self.manifold_subscriber.subscribe_to_user("u2", polling_time=0.1, callback=self.hang)
+
+        results = {"callback": self.called.wait(5)}
+        event = events.get(timeout=5)
+        results["event"] = event.user_id if event is not None else None
+        # u3 is not in the database, it is retrieved through the hub's subscriber
+        results["reader"] = [user["id"] for user in self.manifold_db_reader.get_users(["u3"], max_staleness=60, timeout=5)]
+        results["proxies"] = [type(obj).__name__ for obj in (self.manifold_subscriber, self.event_bus, self.manifold_db_reader.refresher, events)]
+        results["hung"] = self.hanging.wait(5)
+        # Stay past the hub's callback timeout
+        time.sleep(1)
+        with open(self.results_path, "w") as file:
+            json.dump(results, file)
+        self.done.set()
+
+    def stop(self):
+        pass
+
+    def on_user(self):
+        self.called.set()
+
+    def hang(self):
+        self.hanging.set()
+        self.done.wait(10)
+
+
+class TestRemoteCallback(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.calls = []
+
+        def worker_handler(payload):
+            # Stands in for the worker calling the automation's callback
+            self.calls.append(payload)
+            if payload[2] == ("slow",):
+                self.release.wait(5)
+            return None
+
+        hub_conn, worker_conn = multiprocessing.Pipe()
+        self.hub = _Channel(hub_conn, lambda payload: None, name="TEST_HUB")
+        self.worker = _Channel(worker_conn, worker_handler, name="TEST_WORKER")
+
+    def tearDown(self):
+        self.release.set()
+        self.hub.close()
+        self.worker.close()
+
+    def test_callback_returns_once_the_worker_replied(self):
+        callback = _RemoteCallback(self.hub, 1, "test:callback", timeout=5)
+        callback("fast")
+        self.assertEqual(self.calls, [("callback", 1, ("fast",))])
+
+    def test_callback_that_does_not_return_in_time_fails(self):
+        callback = _RemoteCallback(self.hub, 1, "test:callback", timeout=0.1)
+        start = time.time()
+        with self.assertRaises(TimeoutError):
+            callback("slow")
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(self.hub._pending, {})
+
+        # The callback executor counts the timeout as a failed call
+        executor = CallbackExecutor()
+        executor.submit({"function": callback, "polling_time": 60}, "slow")
+        executor.shutdown(wait=True)
+        self.assertEqual(executor.stats()[0]["errors"], 1)
+
+
+class TestAutomationHub(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.dir, "manifold.db")
+        self.db = ManifoldDatabase(self.db_path)
+        self.db.create_tables()
+        self.writer = ManifoldDatabaseWriter(self.db)
+        self.event_bus = EventBus()
+        self.subscriber = ManifoldSubscriber(StubAPI(), self.db, self.writer, event_bus=self.event_bus)
+        self.bot = SimpleNamespace(manifold_api=StubAPI(), manifold_subscriber=self.subscriber, market_state_store=None,
+                                   event_bus=self.event_bus, manifold_db_path=self.db_path, bet_partition_period=None, metrics_from_partitions=0)
+
+    def tearDown(self):
+        self.subscriber.shutdown()
+        self.writer.shutdown()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_automation_runs_in_a_worker_process(self):
+        results_path = os.path.join(self.dir, "results.json")
+        hub = AutomationHub(self.bot, "probe", callback_timeout=0.5)
+        exitcode = hub.run(ProbeAutomation(os.path.join(self.dir, "probe.json"), results_path))
+        self.assertEqual(exitcode, 0)
+
+        with open(results_path) as file:
+            results = json.load(file)
+        self.assertTrue(results["callback"])
+        self.assertEqual(results["event"], "u1")
+        self.assertEqual(results["reader"], ["u3"])
+        self.assertEqual(results["proxies"], ["RemoteObject"] * 4)
+        self.assertTrue(results["hung"])
+
+        # The hanging callback timed out in the hub
+        stats = {stats["callback"]: stats for stats in self.subscriber.callback_stats()}
+        self.assertGreaterEqual(stats["probe:ProbeAutomation.hang"]["errors"], 1)
+        self.assertGreaterEqual(stats["probe:ProbeAutomation.on_user"]["calls"], 1)
+
+        # The worker's callbacks were removed when it exited, which stops their subscriptions
+        deadline = time.time() + 5
+        while self.subscriber._jobs and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.subscriber._jobs, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
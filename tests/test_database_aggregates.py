@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from autofold.database import ManifoldDatabase, ManifoldDatabaseReader
+
+HOUR = 3_600_000
+START = 1_700_000_000 // 3600 * HOUR
+
+
+def make_bet(bet_id, user_id, amount, created_time, contract_id="c1"):
+    return {"id": bet_id, "userId": user_id, "contractId": contract_id, "amount": amount, "outcome": "YES",
+            "createdTime": created_time, "fills": [], "fees": {"creatorFee": 0, "liquidityFee": 0, "platformFee": 0}}
+
+
+class TestAggregateTriggers(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def open(self, **kwargs):
+        db = ManifoldDatabase(os.path.join(self.dir, "manifold.db"), **kwargs)
+        db.create_tables()
+        return db, ManifoldDatabaseReader(db)
+
+    def snapshot(self, db):
+        cursor = db.get_conn().cursor()
+        cursor.row_factory = None
+        return {table: sorted(cursor.execute(f"SELECT * FROM main.{table};").fetchall())
+                for table in ("market_traders", "market_trader_counts", "market_volume_hourly", "user_contract_shares")}
+
+    def test_bets_maintain_traders_and_volume(self):
+        db, reader = self.open()
+        db.upsert_bets([make_bet("b1", "u1", 10, START), make_bet("b2", "u1", -5, START + 1),
+                        make_bet("b3", "u2", 20, START + HOUR), make_bet("b4", "u3", 1, START, contract_id="c2")])
+        self.assertEqual(reader.get_market_trader_count("c1"), 2)
+        self.assertEqual(sorted((row["userId"], row["bets"]) for row in reader.get_market_traders("c1")), [("u1", 2), ("u2", 1)])
+        self.assertEqual([(row["hour"], row["volume"], row["bets"]) for row in reader.get_market_volume_by_hour("c1")],
+                         [(START, 15, 2), (START + HOUR, 20, 1)])
+        self.assertEqual(len(reader.get_market_volume_by_hour("c1", since=START + 1)), 1)
+
+        # Upserting the same bets again (INSERT OR REPLACE) must not count them twice
+        db.upsert_bets([make_bet("b1", "u1", 10, START), make_bet("b3", "u2", 20, START + HOUR)])
+        self.assertEqual(reader.get_market_trader_count("c1"), 2)
+        self.assertEqual(sum(row["bets"] for row in reader.get_market_volume_by_hour("c1")), 3)
+
+    def test_pruning_bets_decrements_aggregates(self):
+        db, reader = self.open()
+        db.upsert_bets([make_bet("b1", "u1", 10, START), make_bet("b2", "u2", 20, START + 2 * HOUR)])
+        db.prune_bets(older_than=(START + HOUR) // 1000)
+        self.assertEqual(reader.get_market_trader_count("c1"), 1)
+        self.assertEqual([row["userId"] for row in reader.get_market_traders("c1")], ["u2"])
+        self.assertEqual([row["hour"] for row in reader.get_market_volume_by_hour("c1")], [START + 2 * HOUR])
+
+    def test_contract_metrics_maintain_user_shares(self):
+        db, reader = self.open()
+        db.upsert_contract_metrics([{"contractId": "c1", "userId": "u1", "totalShares": {"YES": 10, "NO": 4}}])
+        self.assertEqual(reader.get_user_shares("c1", "u1"), [{"userId": "u1", "yesShares": 10, "noShares": 4, "netShares": 6}])
+        db.upsert_contract_metrics([{"contractId": "c1", "userId": "u1", "totalShares": {"YES": 3}}])
+        self.assertEqual(reader.get_user_shares("c1", "u1"), [{"userId": "u1", "yesShares": 3, "noShares": 0, "netShares": 3}])
+
+    def test_triggers_match_rebuild(self):
+        db, _ = self.open(bet_partition_period="month")
+        bets = [make_bet(f"b{i}", f"u{i % 4}", i, START + i * 10 * HOUR, contract_id=f"c{i % 3}") for i in range(200)]
+        db.upsert_bets(bets)
+        db.upsert_bets(bets[::3])
+        db.upsert_contract_metrics([{"contractId": f"c{i % 3}", "userId": f"u{i}", "totalShares": {"YES": i, "NO": 1}} for i in range(10)])
+        self.assertGreater(len(db.list_partitions("bets")), 1)
+
+        maintained = self.snapshot(db)
+        db.rebuild_aggregates()
+        self.assertEqual(self.snapshot(db), maintained)
+
+
+if __name__ == "__main__":
+    unittest.main()
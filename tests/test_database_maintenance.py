@@ -0,0 +1,87 @@
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from autofold.database import ManifoldDatabase, ManifoldDatabaseWriter, ManifoldDatabaseMaintainer
+
+
+def make_bets(count, contract_id="c1", created_time=1_700_000_000_000):
+    return [{"id": f"b{i}", "userId": f"u{i % 7}", "contractId": contract_id, "amount": 10, "outcome": "YES",
+             "createdTime": created_time + i, "fills": [], "fees": {"creatorFee": 0, "liquidityFee": 0, "platformFee": 0}}
+            for i in range(count)]
+
+
+class TestDatabaseMaintenance(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.dir, "manifold.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def auto_vacuum(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute("PRAGMA auto_vacuum;").fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_new_database_uses_incremental_auto_vacuum(self):
+        db = ManifoldDatabase(self.db_path)
+        db.create_tables()
+        self.assertEqual(self.auto_vacuum(), 2)
+        self.assertEqual(db.get_conn().execute("PRAGMA journal_mode;").fetchone()[0], "wal")
+
+    def test_existing_database_is_converted(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("CREATE TABLE legacy (a INTEGER);")
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.auto_vacuum(), 0)
+
+        db = ManifoldDatabase(self.db_path)
+        db.create_tables()
+        self.assertEqual(self.auto_vacuum(), 2)
+
+    def test_incremental_vacuum_frees_pages(self):
+        db = ManifoldDatabase(self.db_path)
+        db.create_tables()
+        db.upsert_bets(make_bets(5000))
+        conn = db.get_conn()
+        conn.execute("DELETE FROM bets;")
+        conn.commit()
+        free_pages = db.incremental_vacuum(pages=100000)
+        self.assertGreater(free_pages, 0)
+        self.assertEqual(conn.execute("PRAGMA freelist_count;").fetchone()[0], 0)
+
+    def test_maintainer_checkpoints_and_vacuums(self):
+        db = ManifoldDatabase(self.db_path)
+        db.create_tables()
+        writer = ManifoldDatabaseWriter(db)
+        maintainer = ManifoldDatabaseMaintainer(db, writer, checkpoint_interval=0.05, idle_time=0,
+                                                vacuum_interval=0.05, analyze_interval=0.05)
+        try:
+            writer.queue_write_operation(function=db.upsert_bets, data=make_bets(100)).result()
+            deadline = time.time() + 5
+            while time.time() < deadline:
+                stats = maintainer.stats()
+                if stats["truncate_checkpoints"] and stats["vacuums"] and stats["analyzes"]:
+                    break
+                time.sleep(0.05)
+            stats = maintainer.stats()
+            self.assertGreater(stats["checkpoints"], 0)
+            self.assertGreater(stats["truncate_checkpoints"], 0)
+            self.assertGreater(stats["vacuums"], 0)
+            self.assertGreater(stats["analyzes"], 0)
+        finally:
+            maintainer.shutdown()
+            writer.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from autofold.database import ManifoldDatabase, ManifoldDatabaseReader
+
+# 2023-01-15 and 2023-02-15 (UTC) in milliseconds
+JANUARY = 1_673_740_800_000
+FEBRUARY = 1_676_419_200_000
+
+
+def make_bets(count, created_time, prefix="b", contract_id="c1"):
+    return [{"id": f"{prefix}{i}", "userId": f"u{i % 3}", "contractId": contract_id, "amount": 10, "outcome": "YES",
+             "createdTime": created_time + i, "fills": [{"amount": 10, "shares": 20, "timestamp": created_time + i}],
+             "fees": {"creatorFee": 0, "liquidityFee": 0, "platformFee": 0}}
+            for i in range(count)]
+
+
+class TestDatabasePartitions(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.dir, "manifold.db")
+        self.db = ManifoldDatabase(self.db_path, bet_partition_period="month", metrics_from_partitions=2)
+        self.db.create_tables()
+        self.reader = ManifoldDatabaseReader(self.db)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def count(self, table, schema="main"):
+        cursor = self.db.get_conn().cursor()
+        cursor.row_factory = None
+        return cursor.execute(f"SELECT COUNT(*) FROM {schema}.{table};").fetchone()[0]
+
+    def count_bets(self):
+        return self.reader.execute_query("SELECT COUNT(*) AS n FROM bets")[0]["n"]
+
+    def test_bets_are_routed_by_month(self):
+        self.db.upsert_bets(make_bets(5, JANUARY, "jan") + make_bets(3, FEBRUARY, "feb"))
+        self.assertEqual([partition["schema"] for partition in self.db.list_partitions("bets")], ["bets_2023_01", "bets_2023_02"])
+        self.assertEqual(self.count("bets", "bets_2023_01"), 5)
+        self.assertEqual(self.count("bet_fills", "bets_2023_02"), 3)
+        self.assertEqual(self.count("bets"), 0)
+        self.assertEqual(self.count_bets(), 8)
+        # The aggregates in the main database follow writes to the partitions
+        self.assertEqual(self.count("market_traders"), 3)
+
+    def test_unpartitioned_bets_move_into_their_partition(self):
+        unpartitioned = ManifoldDatabase(self.db_path)
+        unpartitioned.upsert_bets(make_bets(4, JANUARY))
+        self.assertEqual(self.count("bets"), 4)
+        self.db.upsert_bets(make_bets(4, JANUARY))
+        self.assertEqual(self.count("bets"), 0)
+        self.assertEqual(self.count("bets", "bets_2023_01"), 4)
+
+    def test_metrics_from_partitions(self):
+        metrics = [{"contractId": f"c{i}", "userId": "u1", "profit": 1,
+                    "from": {"day": {"value": 1, "profit": 1, "invested": 1, "prevValue": 1, "profitPercent": 1}}} for i in range(10)]
+        self.db.upsert_contract_metrics(metrics)
+        schemas = [partition["schema"] for partition in self.db.list_partitions("contract_metrics_from")]
+        self.assertEqual(schemas, ["contract_metrics_from_0", "contract_metrics_from_1"])
+        self.assertEqual(sum(self.count("contract_metrics_from", schema) for schema in schemas), 10)
+        self.assertEqual(self.reader.execute_query("SELECT COUNT(*) AS n FROM contract_metrics_from")[0]["n"], 10)
+
+    def test_rows_for_read_only_partitions_are_rejected(self):
+        self.db.upsert_bets(make_bets(5, JANUARY, "jan"))
+        self.db.set_partition_read_only("bets_2023_01")
+        self.assertTrue(self.db.list_partitions("bets")[0]["read_only"])
+
+        # The rows of writable partitions are still written
+        self.db.upsert_bets(make_bets(2, JANUARY, "late") + make_bets(3, FEBRUARY, "feb"))
+        self.assertEqual(self.count("bets", "bets_2023_02"), 3)
+        self.assertEqual(self.count_bets(), 8)
+
+        self.db.set_partition_read_only("bets_2023_01", read_only=False)
+        self.db.upsert_bets(make_bets(2, JANUARY, "late"))
+        self.assertEqual(self.count("bets", "bets_2023_01"), 7)
+
+    def test_maintenance_with_read_only_partition_attached(self):
+        self.db.upsert_bets(make_bets(5, JANUARY, "jan") + make_bets(3, FEBRUARY, "feb"))
+        self.db.set_partition_read_only("bets_2023_01")
+        # Attaches the read-only partition to this thread's connection
+        self.assertEqual(self.count_bets(), 8)
+        self.db.upsert_bets(make_bets(3, FEBRUARY, "feb2"))
+
+        result = self.db.checkpoint("TRUNCATE")
+        self.assertEqual(result["busy"], 0)
+        self.db.analyze()
+        cursor = self.db.get_conn().cursor()
+        cursor.row_factory = None
+        self.assertTrue(cursor.execute("SELECT COUNT(*) FROM bets_2023_02.sqlite_stat1;").fetchone()[0])
+
+    def test_archive_partition(self):
+        self.db.upsert_bets(make_bets(5, JANUARY, "jan") + make_bets(3, FEBRUARY, "feb"))
+        self.assertEqual(self.count_bets(), 8)
+        archive_dir = os.path.join(self.dir, "archive")
+        path = self.db.archive_partition("bets_2023_01", archive_dir)
+        self.assertEqual(path, os.path.join(archive_dir, "bets_2023_01.db"))
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual([partition["schema"] for partition in self.db.list_partitions("bets")], ["bets_2023_02"])
+        self.assertEqual(self.count_bets(), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import stat
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from autofold.database import ManifoldDatabase, WriteQueueFull
+from autofold.database_service import ManifoldDatabaseWriterService, ManifoldDatabaseWriterClient
+
+
+def make_bets(count, contract_id="c1", created_time=1_700_000_000_000):
+    return [{"id": f"b{i}", "userId": f"u{i % 7}", "contractId": contract_id, "amount": 10, "outcome": "YES",
+             "createdTime": created_time + i, "fills": [{"amount": 10, "shares": 20, "timestamp": created_time + i}],
+             "fees": {"creatorFee": 0, "liquidityFee": 0, "platformFee": 0}}
+            for i in range(count)]
+
+
+class TestDatabaseService(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.dir, "manifold.db")
+        self.socket_path = os.path.join(self.dir, "writer.sock")
+        self.service = ManifoldDatabaseWriterService(self.db_path, self.socket_path, maintenance=False, max_queue_items=1)
+        self.service.start()
+        deadline = time.time() + 5
+        while not os.path.exists(self.socket_path) and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.db = ManifoldDatabase(self.db_path)
+        self.client = ManifoldDatabaseWriterClient(self.db, self.socket_path)
+        self.changes = []
+        self.db.add_change_listener(self.changes.append)
+
+    def tearDown(self):
+        self.client.shutdown()
+        self.service.shutdown()
+        self.service.thread.join(5)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def count(self, table):
+        return self.db.get_conn().execute(f"SELECT COUNT(*) FROM {table};").fetchone()[0]
+
+    def test_socket_is_private(self):
+        mode = stat.S_IMODE(os.stat(self.socket_path).st_mode)
+        self.assertEqual(mode & 0o077, 0)
+
+    def test_recorded_statements_are_replayed(self):
+        self.client.queue_write_operation(function=self.db.upsert_bets, data=make_bets(50)).result(timeout=5)
+        self.assertEqual(self.count("bets"), 50)
+        self.assertEqual(self.count("bet_fills"), 50)
+        self.assertEqual(self.count("bet_fees"), 50)
+
+        # Rewriting the same bets replaces their nested rows
+        self.client.queue_write_operation(function=self.db.upsert_bets, data=make_bets(50)).result(timeout=5)
+        self.assertEqual(self.count("bet_fills"), 50)
+
+        # Change notifications of the service reach this process
+        deadline = time.time() + 5
+        while not any(tables and "bets" in tables for tables in self.changes) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(any(tables and "bets" in tables for tables in self.changes))
+
+    def test_write_functions_that_read_run_on_the_service(self):
+        self.client.queue_write_operation(function=self.db.upsert_bets, data=make_bets(10, created_time=1000)).result(timeout=5)
+        self.client.queue_write_operation(function=self.db.prune_bets, data=2000).result(timeout=5)
+        self.assertEqual(self.count("bets"), 0)
+
+    def test_changes_are_returned_from_the_service(self):
+        bets = make_bets(3)
+        changes = self.client.queue_write_operation(function=self.db.upsert_with_changes, data=("bets", bets, ["amount"], None)).result(timeout=5)
+        self.assertEqual(sorted(changes.inserted), ["b0", "b1", "b2"])
+        bets[0]["amount"] = 20
+        changes = self.client.queue_write_operation(function=self.db.upsert_with_changes, data=("bets", bets, ["amount"], None)).result(timeout=5)
+        self.assertEqual(changes.updated, ["b0"])
+        self.assertEqual(self.count("bets"), 3)
+
+    def test_non_blocking_write_is_rejected_when_lane_is_full(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def hold(_):
+            started.set()
+            release.wait(5)
+
+        writer = self.service.manifold_db_writer
+        try:
+            writer.queue_write_operation(function=hold, data=None)
+            started.wait(5)
+            writer.queue_write_operation(function=hold, data=None)
+            with self.assertRaises(WriteQueueFull):
+                self.client.queue_write_operation(function=self.db.upsert_bets, data=make_bets(1), block=False)
+            with self.assertRaises(WriteQueueFull):
+                self.client.queue_write_operation(function=self.db.upsert_bets, data=make_bets(1), timeout=0.1)
+        finally:
+            release.set()
+        future = self.client.queue_write_operation(function=self.db.upsert_bets, data=make_bets(1), block=True, timeout=5)
+        future.result(timeout=5)
+        self.assertEqual(self.count("bets"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
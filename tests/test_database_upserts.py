@@ -0,0 +1,36 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from autofold.database import ManifoldDatabase
+
+
+class TestContractMetricsUpsert(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = ManifoldDatabase(os.path.join(self.dir, "manifold.db"))
+        self.db.create_tables()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_from_entries_keep_their_own_capped_profit_percent(self):
+        self.db.upsert_contract_metrics([{
+            "contractId": "c1", "userId": "u1", "profitPercent": 5.5, "profit": 1,
+            "from": {
+                "day": {"value": 10, "profit": 1, "invested": 9, "prevValue": 9, "profitPercent": 11.1},
+                "week": {"value": 10, "profit": 1, "invested": 0, "prevValue": 9, "profitPercent": 3e12},
+                "month": {"value": 10, "profit": 1, "invested": 9, "prevValue": 9, "profitPercent": None},
+                "allTime": {"value": 10, "profit": 1, "invested": 9, "prevValue": 9},
+            },
+            "totalShares": {"YES": 12.5},
+        }])
+        rows = self.db.get_conn().execute("SELECT period, profitPercent FROM contract_metrics_from;").fetchall()
+        self.assertEqual(dict((row[0], row[1]) for row in rows),
+                         {"day": 11.1, "week": 1_000_000, "month": 0, "allTime": 0})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+import os
+import json
+import gzip
+import shutil
+import tempfile
+import time
+import unittest
+
+from autofold.database import ManifoldDatabase, ManifoldDatabaseWriter
+from autofold.database_service import ManifoldDatabaseWriterService, ManifoldDatabaseWriterClient
+from autofold.utils.manifold_dump_reader import iter_dump_batches, import_bets_dump, import_markets_dump
+
+
+def make_records(count):
+    # Nested objects with the same first key as the records, and descriptions holding array syntax
+    return [{"id": f"r{i}", "question": f"Question {i}, \"quoted\" }},{{ [ ]",
+             "description": {"id": f"d{i}", "content": [{"id": "p", "text": "},{\"id\":"}, {"id": "q"}]},
+             "amount": i} for i in range(count)]
+
+
+class TestManifoldDumpReader(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(path, "wt", encoding="utf-8") as file:
+            file.write(text)
+        return path
+
+    def read_all(self, path, **kwargs):
+        return [record for batch in iter_dump_batches(path, **kwargs) for record in batch]
+
+    def test_json_array(self):
+        records = make_records(1000)
+        path = self.write("dump.json", json.dumps(records, indent=1))
+        batches = list(iter_dump_batches(path, batch_size=300, chunk_size=256))
+        self.assertEqual([len(batch) for batch in batches], [300, 300, 300, 100])
+        self.assertEqual([record for batch in batches for record in batch], records)
+
+    def test_json_array_parallel(self):
+        records = make_records(2000)
+        for text in (json.dumps(records), json.dumps(records, indent=2), json.dumps(records, separators=(",", ":"))):
+            path = self.write("dump.json.gz", text)
+            self.assertEqual(self.read_all(path, batch_size=50, chunk_size=512, workers=2), records)
+
+    def test_json_array_parallel_small(self):
+        for count in (0, 1, 3):
+            records = make_records(count)
+            path = self.write("dump.json", json.dumps(records))
+            self.assertEqual(self.read_all(path, batch_size=2, workers=2), records)
+
+    def test_json_lines(self):
+        records = make_records(500)
+        path = self.write("dump.jsonl", "\n".join(json.dumps(record) for record in records) + "\n\n")
+        self.assertEqual(self.read_all(path, batch_size=64), records)
+        self.assertEqual(self.read_all(path, batch_size=64, workers=2), records)
+
+    def test_malformed_record_raises(self):
+        text = json.dumps(make_records(100))
+        path = self.write("dump.json", text[:len(text) // 2] + "{\"id\": oops}, " + text[len(text) // 2:])
+        with self.assertRaises(ValueError):
+            self.read_all(path, chunk_size=256)
+        with self.assertRaises(ValueError):
+            self.read_all(path, batch_size=10, chunk_size=256, workers=2)
+
+    def test_truncated_dump_raises(self):
+        text = json.dumps(make_records(100))
+        path = self.write("dump.json", text[:-20])
+        with self.assertRaises(ValueError):
+            self.read_all(path, chunk_size=256)
+        with self.assertRaises(ValueError):
+            self.read_all(path, batch_size=10, chunk_size=256, workers=2)
+
+    def test_oversized_record_raises(self):
+        records = make_records(10)
+        records[5]["description"] = "x" * 10000
+        path = self.write("dump.json", json.dumps(records))
+        self.assertEqual(self.read_all(path, chunk_size=256, max_record_size=20000), records)
+        with self.assertRaises(ValueError):
+            self.read_all(path, chunk_size=256, max_record_size=1000)
+        path = self.write("dump.jsonl", "\n".join(json.dumps(record) for record in records))
+        with self.assertRaises(ValueError):
+            self.read_all(path, max_record_size=1000)
+
+    def test_import_bets_dump(self):
+        bets = [{"id": f"b{i}", "userId": "u1", "contractId": "c1", "amount": 10, "outcome": "YES",
+                 "createdTime": 1_700_000_000_000 + i, "fills": [], "fees": {"creatorFee": 0, "liquidityFee": 0, "platformFee": 0}}
+                for i in range(500)]
+        path = self.write("bets.json", json.dumps(bets))
+        db = ManifoldDatabase(os.path.join(self.dir, "manifold.db"))
+        db.create_tables()
+        writer = ManifoldDatabaseWriter(db)
+
+        def read_synchronous(result):
+            result.append(db.get_conn().execute("PRAGMA synchronous;").fetchone()[0])
+
+        synchronous = []
+        try:
+            writer.queue_write_operation(function=read_synchronous, data=synchronous).result()
+            stats = import_bets_dump(path, db, writer, batch_size=100, workers=2)
+            self.assertEqual(stats["rows"], 500)
+            self.assertEqual(db.get_conn().execute("SELECT COUNT(*) FROM bets;").fetchone()[0], 500)
+            # The bulk-load settings only applied to the import's own writes
+            writer.queue_write_operation(function=read_synchronous, data=synchronous).result()
+            self.assertEqual(synchronous[0], synchronous[1])
+            self.assertNotEqual(synchronous[1], 0)
+        finally:
+            writer.shutdown()
+
+    def test_import_through_writer_service(self):
+        db_path = os.path.join(self.dir, "manifold.db")
+        socket_path = os.path.join(self.dir, "writer.sock")
+        service = ManifoldDatabaseWriterService(db_path, socket_path, maintenance=False)
+        service.start()
+        deadline = time.time() + 5
+        while not os.path.exists(socket_path) and time.time() < deadline:
+            time.sleep(0.01)
+        db = ManifoldDatabase(db_path)
+        client = ManifoldDatabaseWriterClient(db, socket_path)
+        invalidated = []
+        db.add_change_listener(invalidated.append)
+
+        markets = [{"id": f"m{i}", "outcomeType": "BINARY", "question": f"Question {i}", "probability": 0.5,
+                    "pool": {"YES": 10, "NO": 10}, "createdTime": 1, "lastUpdatedTime": 1} for i in range(20)]
+        bets = [{"id": f"b{i}", "userId": "u1", "contractId": "m1", "amount": 10, "outcome": "YES",
+                 "createdTime": 1_700_000_000_000 + i, "fills": [], "fees": {"creatorFee": 0, "liquidityFee": 0, "platformFee": 0}}
+                for i in range(50)]
+        try:
+            self.assertEqual(import_markets_dump(self.write("markets.json", json.dumps(markets)), db, client, batch_size=8)["rows"], 20)
+            self.assertEqual(import_bets_dump(self.write("bets.json", json.dumps(bets)), db, client, batch_size=16)["rows"], 50)
+            self.assertEqual(db.get_conn().execute("SELECT COUNT(*) FROM binary_choice_markets;").fetchone()[0], 20)
+            self.assertEqual(db.get_conn().execute("SELECT COUNT(*) FROM bets;").fetchone()[0], 50)
+            # Bulk writes invalidate the tables they write, not the whole query cache
+            deadline = time.time() + 5
+            while not invalidated and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(invalidated)
+            self.assertTrue(all(tables is not None and "bets" in tables for tables in invalidated))
+        finally:
+            client.shutdown()
+            service.shutdown()
+            service.thread.join(5)
+
+
+if __name__ == "__main__":
+    unittest.main()
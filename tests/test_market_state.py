@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from concurrent.futures import Future
+
+from autofold.database import ManifoldDatabase, ManifoldDatabaseWriter, ManifoldDatabaseReader
+from autofold.market_state import MarketStateStore
+from autofold.subscriber import ManifoldSubscriber
+
+
+def make_market(market_id, probability=0.5, last_updated_time=1):
+    return {"id": market_id, "outcomeType": "BINARY", "question": market_id, "probability": probability,
+            "pool": {"YES": 10, "NO": 10}, "createdTime": 1, "lastUpdatedTime": last_updated_time}
+
+
+def resolved(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+class StubAPI:
+    def get_market_by_id(self, market_id):
+        return resolved(make_market(market_id, last_updated_time=time.time() * 1000))
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestMarketStateStore(unittest.TestCase):
+
+    def test_update_and_snapshot(self):
+        store = MarketStateStore()
+        store.watch("m1")
+        store.update_markets([make_market("m1", 0.4, 2), make_market("m2")], watched_only=True)
+        self.assertEqual(store.get("m1").probability, 0.4)
+        self.assertIsNone(store.get("m2"))
+        # Older updates are ignored
+        store.update_markets([make_market("m1", 0.9, 1)])
+        self.assertEqual(store.snapshot()["m1"].probability, 0.4)
+
+    def test_market_stays_watched_until_every_owner_unwatched_it(self):
+        store = MarketStateStore()
+        store.watch("m1", owner="a")
+        store.watch_markets(["m1", "m2"], owner="b")
+        store.watch("m1", owner="b")
+        store.update_markets([make_market("m1"), make_market("m2")])
+
+        store.unwatch("m1", owner="a")
+        self.assertTrue(store.is_watched("m1"))
+        self.assertIn("m1", store)
+
+        store.unwatch_markets(["m1", "m2"], owner="b")
+        self.assertFalse(store.is_watched("m1"))
+        self.assertNotIn("m1", store)
+        self.assertNotIn("m2", store)
+
+    def test_watch_loads_from_database(self):
+        directory = tempfile.mkdtemp()
+        try:
+            db = ManifoldDatabase(os.path.join(directory, "manifold.db"))
+            db.create_tables()
+            db.upsert_binary_choice_markets([make_market("m1", 0.7)])
+            store = MarketStateStore(ManifoldDatabaseReader(db))
+            store.watch("m1")
+            self.assertEqual(store.get("m1").probability, 0.7)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+class TestSubscriberWatches(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = ManifoldDatabase(os.path.join(self.dir, "manifold.db"))
+        self.db.create_tables()
+        # Watched markets are loaded from the database, before the first (phase-delayed) poll
+        self.db.upsert_binary_choice_markets([make_market("m1"), make_market("m2")])
+        self.writer = ManifoldDatabaseWriter(self.db)
+        self.store = MarketStateStore(ManifoldDatabaseReader(self.db))
+        self.subscriber = ManifoldSubscriber(StubAPI(), self.db, self.writer, market_state_store=self.store)
+
+    def tearDown(self):
+        self.subscriber.shutdown()
+        self.writer.shutdown()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def has_job(self, function):
+        return any(job.function == function for job in list(self.subscriber._jobs.values()))
+
+    def test_unsubscribing_one_subscription_keeps_markets_of_others(self):
+        callback = lambda: None
+        self.subscriber.subscribe_to_market("m1", polling_time=60, callback=callback)
+        self.subscriber.subscribe_to_markets(["m1", "m2"], polling_time=60, callback=callback)
+        self.assertTrue(wait_for(lambda: self.has_job(self.subscriber._update_market) and self.has_job(self.subscriber._update_markets)))
+        self.assertIn("m2", self.store)
+
+        self.subscriber.unsubscribe_to_market("m1")
+        self.assertTrue(wait_for(lambda: not self.has_job(self.subscriber._update_market)))
+        self.assertTrue(self.store.is_watched("m1"))
+        self.assertIn("m1", self.store)
+
+        self.subscriber.unsubscribe_to_markets(["m1", "m2"])
+        self.assertFalse(self.store.is_watched("m1"))
+        self.assertFalse(self.store.is_watched("m2"))
+
+    def test_removing_the_last_callback_unwatches_the_market(self):
+        callback = lambda: None
+        self.subscriber.subscribe_to_market("m1", polling_time=60, callback=callback)
+        self.assertTrue(wait_for(lambda: self.has_job(self.subscriber._update_market)))
+        self.assertIn("m1", self.store)
+        self.subscriber.remove_callbacks(callback)
+        self.assertTrue(wait_for(lambda: not self.store.is_watched("m1")))
+
+
+if __name__ == "__main__":
+    unittest.main()
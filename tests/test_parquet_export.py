@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from autofold.database import ManifoldDatabase
+from autofold.utils.parquet_export import export_to_parquet, export_table, STATE_FILE
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+
+DAY = 86400
+
+
+def make_bet(bet_id, fills=()):
+    return {"id": bet_id, "userId": "u1", "contractId": "c1", "amount": 10, "outcome": "YES", "createdTime": 1_700_000_000_000,
+            "fills": list(fills), "fees": {"creatorFee": 1, "liquidityFee": 2, "platformFee": 3}}
+
+
+@unittest.skipUnless(pq, "pyarrow is not installed")
+class TestParquetExport(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.dir, "exports")
+        self.db = ManifoldDatabase(os.path.join(self.dir, "manifold.db"))
+        self.db.create_tables()
+        self.now = int(time.time())
+        # Two bets retrieved three days ago, one yesterday and one within the lag window
+        self.retrieved = {"b1": self.now - 3 * DAY, "b2": self.now - 3 * DAY + 1, "b3": self.now - DAY, "b4": self.now - 5}
+        self.db.upsert_bets([make_bet("b1", fills=[{"timestamp": 1, "matchedBetId": None, "amount": 10, "shares": 20}]),
+                             make_bet("b2"), make_bet("b3"), make_bet("b4")])
+        for bet_id, retrieved in self.retrieved.items():
+            self.set_retrieved(bet_id, retrieved)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def set_retrieved(self, bet_id, retrieved):
+        conn = self.db.get_conn()
+        conn.execute("UPDATE bets SET retrievedTimestamp = ? WHERE id = ?;", (retrieved, bet_id))
+        conn.commit()
+
+    def read(self, name, output_dir=None):
+        rows = []
+        for root, _, files in os.walk(os.path.join(output_dir or self.output_dir, name)):
+            for file in sorted(files):
+                rows.extend(pq.read_table(os.path.join(root, file)).to_pylist())
+        return sorted(rows, key=lambda row: row.get("id") or row["betId"])
+
+    def test_incremental_export(self):
+        results = export_to_parquet(self.db, self.output_dir, exports=["bets", "bet_fills"])
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, STATE_FILE)))
+        # The bet within the lag window is left for the next run
+        self.assertEqual([row["id"] for row in self.read("bets")], ["b1", "b2", "b3"])
+        self.assertEqual(results["bets"]["retrievedTimestamp"], self.retrieved["b3"])
+
+        # One partition per retrieval day
+        self.assertEqual(results["bets"]["files"], 2)
+        partitions = sorted(os.listdir(os.path.join(self.output_dir, "bets")))
+        self.assertEqual(len(partitions), 2)
+        self.assertTrue(all(partition.startswith("retrieved_date=") for partition in partitions))
+
+        # Fees are flattened into the bets, fills carry the retrievedTimestamp of their bet
+        bet = self.read("bets")[0]
+        self.assertEqual((bet["fees_creatorFee"], bet["fees_liquidityFee"], bet["fees_platformFee"]), (1, 2, 3))
+        self.assertNotIn("fees_betId", bet)
+        fills = self.read("bet_fills")
+        self.assertEqual(len(fills), 1)
+        self.assertEqual((fills[0]["betId"], fills[0]["retrievedTimestamp"]), ("b1", self.retrieved["b1"]))
+        self.assertNotIn("id", fills[0])
+
+        # The next run exports nothing new
+        results = export_to_parquet(self.db, self.output_dir, exports=["bets", "bet_fills"])
+        self.assertEqual((results["bets"]["rows"], results["bet_fills"]["rows"]), (0, 0))
+
+        # Once it is out of the lag window, the held back bet is exported
+        self.set_retrieved("b4", self.now - 120)
+        results = export_to_parquet(self.db, self.output_dir, exports=["bets"])
+        self.assertEqual(results["bets"]["rows"], 1)
+        self.assertEqual([row["id"] for row in self.read("bets")], ["b1", "b2", "b3", "b4"])
+
+    def test_since_and_until_are_exclusive(self):
+        result = export_table(self.db, self.output_dir, "bets", since=self.retrieved["b1"], until=self.retrieved["b4"])
+        self.assertEqual(result["rows"], 2)
+        self.assertEqual([row["id"] for row in self.read("bets")], ["b2", "b3"])
+
+    def test_values_not_matching_the_column_type_are_exported_as_null(self):
+        # SQLite keeps text that does not look like a number in a REAL column
+        conn = self.db.get_conn()
+        conn.execute("UPDATE bets SET amount = 'lots' WHERE id = 'b2';")
+        conn.commit()
+        export_to_parquet(self.db, self.output_dir, exports=["bets"])
+        amounts = {row["id"]: row["amount"] for row in self.read("bets")}
+        self.assertEqual(amounts, {"b1": 10.0, "b2": None, "b3": 10.0})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import Future
+
+from autofold.database import ManifoldDatabase, ManifoldDatabaseWriter
+from autofold.subscriber import ManifoldSubscriber
+
+
+def resolved(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+class StubAPI:
+    # Serves the positions of one market like the API: windows of at most POSITION_WINDOW positions, or one user's position
+    def __init__(self, count):
+        self.positions = [{"contractId": "c1", "userId": f"u{i}", "profit": i, "totalShares": {"YES": 1}} for i in range(count)]
+        self.user_queries = []
+
+    def get_market_positions(self, market_id, order='profit', top=None, bottom=None, user_id=None):
+        if user_id is not None:
+            self.user_queries.append(user_id)
+            return resolved([position for position in self.positions if position["userId"] == user_id][:top])
+        key = (lambda position: position["profit"]) if order == "profit" else (lambda position: position["totalShares"]["YES"])
+        ordered = sorted(self.positions, key=key, reverse=True)
+        return resolved(ordered[:top] if top else ordered[-bottom:])
+
+
+def make_bets(user_ids):
+    return [{"id": f"b{user_id}", "userId": user_id, "contractId": "c1", "amount": 10, "outcome": "YES", "createdTime": 1,
+             "fills": [], "fees": {"creatorFee": 0, "liquidityFee": 0, "platformFee": 0}} for user_id in user_ids]
+
+
+class TestPositionSync(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = ManifoldDatabase(os.path.join(self.dir, "manifold.db"))
+        self.db.create_tables()
+        self.writer = ManifoldDatabaseWriter(self.db)
+        self.subscribers = []
+
+    def tearDown(self):
+        for subscriber in self.subscribers:
+            subscriber.shutdown()
+        self.writer.shutdown()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def sync(self, api):
+        subscriber = ManifoldSubscriber(api, self.db, self.writer)
+        self.subscribers.append(subscriber)
+        return subscriber, subscriber.sync_market_positions("c1")
+
+    def test_windows_that_overlap_are_complete(self):
+        api = StubAPI(3999)
+        self.db.upsert_bets(make_bets(["u5", "nobody"]))
+        _, positions = self.sync(api)
+        self.assertEqual(len(positions), 3999)
+        self.assertEqual(api.user_queries, [])
+
+    def test_exactly_two_windows_of_positions_do_not_requery_positionless_traders(self):
+        window = ManifoldSubscriber.POSITION_WINDOW
+        api = StubAPI(2 * window)
+        # A trader of the market without a position, e.g. one whose bets were all cancelled
+        self.db.upsert_bets(make_bets(["u5", "nobody"]))
+        subscriber, positions = self.sync(api)
+        self.assertEqual(len(positions), 2 * window)
+        self.assertEqual(api.user_queries, ["nobody"])
+        subscriber.sync_market_positions("c1")
+        self.assertEqual(api.user_queries, ["nobody"])
+
+    def test_missing_middle_is_filled_from_known_traders(self):
+        window = ManifoldSubscriber.POSITION_WINDOW
+        api = StubAPI(2 * window + 10)
+        middle = [f"u{i}" for i in range(window, window + 10)]
+        self.db.upsert_bets(make_bets(middle))
+        _, positions = self.sync(api)
+        self.assertEqual(len(positions), 2 * window + 10)
+        self.assertEqual(sorted(api.user_queries), sorted(middle))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from autofold.database import ManifoldDatabase, ManifoldDatabaseWriter, ManifoldDatabaseReader, QueryCache, writes_tables
+
+
+def make_bets(count, contract_id="c1", created_time=1_700_000_000_000):
+    return [{"id": f"b{i}", "userId": f"u{i % 7}", "contractId": contract_id, "amount": 10, "outcome": "YES",
+             "createdTime": created_time + i, "fills": [], "fees": {"creatorFee": 0, "liquidityFee": 0, "platformFee": 0}}
+            for i in range(count)]
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = QueryCache(2)
+        for key in ("a", "b"):
+            cache.put(key, [key], frozenset({"bets"}), cache.versions({"bets"}))
+        cache.get("a")
+        cache.put("c", ["c"], frozenset({"bets"}), cache.versions({"bets"}))
+        self.assertEqual(cache.get("a"), ["a"])
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_invalidate_tables(self):
+        cache = QueryCache(10)
+        cache.put("bets", [1], frozenset({"bets"}), cache.versions({"bets"}))
+        cache.put("users", [2], frozenset({"users"}), cache.versions({"users"}))
+        cache.invalidate({"bets"})
+        self.assertIsNone(cache.get("bets"))
+        self.assertEqual(cache.get("users"), [2])
+        cache.invalidate()
+        self.assertIsNone(cache.get("users"))
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def test_result_computed_during_write_is_not_stored(self):
+        cache = QueryCache(10)
+        versions = cache.versions({"bets"})
+        cache.invalidate({"bets"})
+        cache.put("bets", [1], frozenset({"bets"}), versions)
+        self.assertIsNone(cache.get("bets"))
+
+        versions = cache.versions({"bets"})
+        cache.invalidate()
+        cache.put("bets", [1], frozenset({"bets"}), versions)
+        self.assertIsNone(cache.get("bets"))
+
+
+class TestReaderCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = ManifoldDatabase(os.path.join(self.dir, "manifold.db"))
+        self.db.create_tables()
+        self.writer = ManifoldDatabaseWriter(self.db)
+        self.reader = ManifoldDatabaseReader(self.db, cache_size=16)
+
+    def tearDown(self):
+        self.writer.shutdown()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def count_bets(self):
+        return self.reader.execute_query("SELECT COUNT(*) AS n FROM bets WHERE contractId = ?", ("c1",))[0]["n"]
+
+    def test_write_invalidates_read_tables(self):
+        self.writer.queue_write_operation(function=self.db.upsert_bets, data=make_bets(10)).result()
+        self.assertEqual(self.count_bets(), 10)
+        self.assertEqual(self.count_bets(), 10)
+        self.assertEqual(self.reader.cache.stats()["hits"], 1)
+
+        self.writer.queue_write_operation(function=self.db.upsert_bets, data=make_bets(20)).result()
+        self.assertEqual(self.count_bets(), 20)
+
+    def test_write_to_other_tables_keeps_entries(self):
+        @writes_tables("users")
+        def write_users(_):
+            pass
+
+        def write_anything(_):
+            pass
+
+        self.count_bets()
+        self.writer.queue_write_operation(function=write_users, data=None).result()
+        self.count_bets()
+        self.assertEqual(self.reader.cache.stats()["hits"], 1)
+
+        # Writes without a declaration invalidate everything
+        self.writer.queue_write_operation(function=write_anything, data=None).result()
+        self.count_bets()
+        self.assertEqual(self.reader.cache.stats()["hits"], 1)
+
+    def test_uncacheable_queries(self):
+        for _ in range(2):
+            self.reader.execute_query("SELECT random() AS r FROM bets")
+            self.reader.execute_query("SELECT COUNT(*) AS n FROM bets", use_cache=False)
+        self.assertEqual(self.reader.cache.stats()["entries"], 0)
+        self.assertEqual(self.reader.cache.stats()["hits"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from autofold.database import ManifoldDatabase, ManifoldDatabaseWriter
+from autofold.streaming import StreamSource, LocalFeedServer, JsonLinesStreamSource
+from autofold.subscriber import ManifoldSubscriber
+
+
+def make_user(user_id):
+    return {"id": user_id, "name": user_id, "username": user_id, "createdTime": 1, "balance": 100, "totalDeposits": 100}
+
+
+class StubAPI:
+    # Polls find no bets
+    get_bets = None
+
+    def retrieve_all_data(self, api_call_func, **kwargs):
+        return []
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestStreaming(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = ManifoldDatabase(os.path.join(self.dir, "manifold.db"))
+        self.db.create_tables()
+        self.writer = ManifoldDatabaseWriter(self.db)
+        self.feed = LocalFeedServer()
+        self.feed.start()
+        self.source = JsonLinesStreamSource(*self.feed.address)
+        self.subscriber = ManifoldSubscriber(StubAPI(), self.db, self.writer, stream_source=self.source)
+        self.assertTrue(wait_for(lambda: self.feed.clients == 1 and self.source.connected))
+
+    def tearDown(self):
+        self.subscriber.shutdown()
+        self.feed.shutdown()
+        self.writer.shutdown()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def count_users(self):
+        return self.db.get_conn().execute("SELECT COUNT(*) FROM users;").fetchone()[0]
+
+    def test_bad_message_is_skipped_without_reconnecting(self):
+        # A market without an ID fails in the subscriber
+        self.feed.publish("markets", [{"question": "no id"}])
+        self.feed.publish("users", [make_user("u1")])
+        self.assertTrue(wait_for(lambda: self.count_users() == 1))
+        self.assertEqual(self.source.errors, 1)
+        self.assertEqual(self.source.messages, 2)
+        self.assertEqual(self.feed.clients, 1)
+
+    def test_bet_to_callback_latency_is_recorded(self):
+        calls = []
+        self.subscriber.subscribe_to_bets(None, None, "c1", None, polling_time=60, callback=lambda: calls.append(time.time()))
+        self.assertTrue(wait_for(lambda: (self.subscriber._update_bets, (None, None, "c1", None)) in self.subscriber._jobs))
+        # A bet placed two seconds before it is streamed
+        created_time = time.time() - 2
+        self.feed.publish("bets", [{"id": "b1", "userId": "u1", "contractId": "c1", "amount": 10, "outcome": "YES",
+                                    "createdTime": int(created_time * 1000), "fills": [], "fees": None}])
+        self.assertTrue(wait_for(lambda: calls and self.subscriber.stats()["stream"]
+                                 and self.subscriber.stats()["stream"][0]["deliveries"] == 1))
+        stats = self.subscriber.stats()["stream"][0]
+        self.assertEqual((stats["topic"], stats["messages"], stats["rows"]), ("bets", 1, 1))
+        self.assertGreaterEqual(stats["max_latency"], 2)
+        self.assertLessEqual(stats["max_latency"], calls[-1] - created_time + 0.01)
+
+    def test_sources_implement_the_connection_methods(self):
+        class Incomplete(StreamSource):
+            def _open(self):
+                return None
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+if __name__ == "__main__":
+    unittest.main()
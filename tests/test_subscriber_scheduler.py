@@ -0,0 +1,241 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+
+from autofold.database import ManifoldDatabase, ManifoldDatabaseWriter
+from autofold.subscriber import ManifoldSubscriber, CallbackExecutor, ReadBudgetPlanner, Job, JobAction, JobType
+
+
+def make_user(user_id, balance=100):
+    return {"id": user_id, "name": user_id, "username": user_id, "createdTime": 1, "balance": balance, "totalDeposits": 100}
+
+
+def resolved(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+class StubAPI:
+    def __init__(self):
+        self.reads = {}
+        self.lock = threading.Lock()
+
+    def get_user_by_id(self, user_id):
+        with self.lock:
+            self.reads[user_id] = self.reads.get(user_id, 0) + 1
+            # The balance changes with every read
+            return resolved(make_user(user_id, balance=self.reads[user_id]))
+
+    def count(self, user_id):
+        with self.lock:
+            return self.reads.get(user_id, 0)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestCallbackExecutor(unittest.TestCase):
+
+    def test_function_shared_by_subscriptions_never_runs_concurrently(self):
+        executor = CallbackExecutor(max_workers=4)
+        started = threading.Event()
+        release = threading.Event()
+
+        def callback():
+            started.set()
+            release.wait(5)
+
+        try:
+            # Two subscriptions with the same callback function, each with its own callback dict
+            self.assertTrue(executor.submit({"function": callback, "polling_time": 60}))
+            started.wait(5)
+            self.assertFalse(executor.submit({"function": callback, "polling_time": 60}))
+        finally:
+            release.set()
+            executor.shutdown()
+        stats = executor.stats()[0]
+        self.assertEqual((stats["calls"], stats["overruns"]), (1, 1))
+
+
+class TestReadBudgetPlanner(unittest.TestCase):
+
+    def test_adaptive_intervals_are_planned_at_their_current_interval(self):
+        planner = ReadBudgetPlanner(reads_per_second=10, utilization=1)
+        planner.admit("a", "_update_market", 1)
+        planner.admit("b", "_update_market", 1)
+        self.assertEqual(planner.stretch(), 1.0)
+        planner.update_interval("a", 0.1)
+        self.assertAlmostEqual(planner.stretch(), 1.1)
+        planner.release("a")
+        self.assertEqual(planner.stretch(), 1.0)
+
+
+class TestHeapScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = ManifoldDatabase(os.path.join(self.dir, "manifold.db"))
+        self.db.create_tables()
+        self.writer = ManifoldDatabaseWriter(self.db)
+        self.api = StubAPI()
+        self.subscribers = []
+
+    def tearDown(self):
+        for subscriber in self.subscribers:
+            subscriber.shutdown()
+        self.writer.shutdown()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def start(self, **kwargs):
+        subscriber = ManifoldSubscriber(self.api, self.db, self.writer, **kwargs)
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def job(self, subscriber, user_id):
+        return subscriber._jobs.get((subscriber._update_user, (user_id,)))
+
+    def test_interval_job_executes_every_interval(self):
+        subscriber = self.start()
+        calls = []
+        subscriber.subscribe_to_user("u1", polling_time=0.1, callback=lambda: calls.append(time.time()))
+        self.assertTrue(wait_for(lambda: self.api.count("u1") >= 4 and len(calls) >= 3))
+        self.assertEqual(self.db.get_conn().execute("SELECT COUNT(*) FROM users;").fetchone()[0], 1)
+        # Stale timers of rescheduled executions are skipped rather than executing the job again
+        self.assertLessEqual(len(subscriber._timers), 2)
+
+    def test_change_data_callback_receives_the_changes_of_each_poll(self):
+        subscriber = self.start()
+        events = []
+        subscriber.subscribe_to_user("u1", polling_time=0.05, callback=events.append, fields=["balance"])
+        self.assertTrue(wait_for(lambda: len(events) >= 2))
+        self.assertEqual(events[0].inserted, ["u1"])
+        later = [event for event in events[1:] if event.updated]
+        self.assertTrue(later)
+        self.assertLess(later[0].old["u1"]["balance"], later[0].new["u1"]["balance"])
+
+    def test_adaptive_interval_is_stretched_once(self):
+        subscriber = self.start()
+        subscriber.shutdown()
+        self.subscribers.remove(subscriber)
+        job = Job(action=JobAction.ADD, function=subscriber._update_user, params=("u1",), job_type=JobType.INTERVAL,
+                  callbacks=[{"function": None, "polling_time": 10, "fields": None, "next_call_time": 0}], max_interval=100)
+        job.adaptive["interval"] = 40
+        key = (job.function, job.params)
+        subscriber._jobs[key] = job
+        subscriber._read_planner.admit(key, "_update_user", job.update_interval)
+        # One read every 40 seconds against a budget of one read every 80 seconds
+        subscriber._read_planner.budget = 1 / 80
+        job.last_execution_time = 1000
+        subscriber._reschedule_job(job)
+        self.assertAlmostEqual(subscriber._read_planner.stretch(), 2)
+        # The next execution is on the job's phase grid of the stretched interval
+        offset = job.phase[2] * 80
+        self.assertAlmostEqual((job.next_execution_time - offset) / 80, round((job.next_execution_time - offset) / 80))
+        self.assertTrue(0 < job.next_execution_time - job.last_execution_time <= 80)
+
+    def test_unsubscribed_job_stops_executing(self):
+        subscriber = self.start()
+        subscriber.subscribe_to_user("u1", polling_time=0.05, callback=lambda: None)
+        self.assertTrue(wait_for(lambda: self.api.count("u1") >= 2))
+        subscriber.unsubscribe_to_user("u1")
+        self.assertTrue(wait_for(lambda: self.job(subscriber, "u1") is None))
+        time.sleep(0.1)
+        reads = self.api.count("u1")
+        time.sleep(0.2)
+        self.assertEqual(self.api.count("u1"), reads)
+
+    def test_jobs_of_the_same_interval_get_spread_phases(self):
+        subscriber = self.start()
+        for i in range(5):
+            subscriber.subscribe_to_user(f"u{i}", polling_time=60, callback=lambda: None)
+        self.assertTrue(wait_for(lambda: all(self.job(subscriber, f"u{i}") is not None for i in range(5))))
+        offsets = sorted(self.job(subscriber, f"u{i}").phase[2] for i in range(5))
+        self.assertEqual(len({self.job(subscriber, f"u{i}").phase[1] for i in range(5)}), 5)
+        # The golden ratio sequence leaves no gap between 5 slots wider than about twice the even spacing
+        gaps = [b - a for a, b in zip(offsets, offsets[1:])] + [offsets[0] + 1 - offsets[-1]]
+        self.assertLess(max(gaps), 0.5)
+
+        # A released slot is reused by the next job
+        slot = self.job(subscriber, "u2").phase[1]
+        subscriber.unsubscribe_to_user("u2")
+        subscriber.subscribe_to_user("u5", polling_time=60, callback=lambda: None)
+        self.assertTrue(wait_for(lambda: self.job(subscriber, "u5") is not None))
+        self.assertEqual(self.job(subscriber, "u5").phase[1], slot)
+
+    def test_one_off_update_runs_now_and_coalesces_into_interval_job(self):
+        subscriber = self.start()
+        subscriber.subscribe_to_user("u1", polling_time=60, callback=lambda: None)
+        self.assertTrue(wait_for(lambda: self.job(subscriber, "u1") is not None))
+        subscriber.update_user("u1").result(timeout=5)
+        self.assertEqual(self.api.count("u1"), 1)
+        self.assertEqual(self.job(subscriber, "u1").job_type, JobType.INTERVAL)
+        self.assertEqual(len(subscriber._jobs), 1)
+
+    def test_subscriptions_are_restored_after_restart(self):
+        subscriber = self.start(resume_subscriptions=True)
+        subscriber.subscribe_to_user("u1", polling_time=60, callback=lambda: None)
+        self.assertTrue(wait_for(lambda: self.job(subscriber, "u1") is not None))
+        subscriber.update_user("u1").result(timeout=5)
+        subscriber.shutdown()
+        self.subscribers.remove(subscriber)
+        saved = self.db.get_subscriptions("default")
+        self.assertEqual([(row["function"], row["polling_time"]) for row in saved], [("_update_user", 60)])
+        self.assertGreater(saved[0]["last_execution_time"], 0)
+
+        restarted = self.start(resume_subscriptions=True)
+        self.assertTrue(wait_for(lambda: self.job(restarted, "u1") is not None))
+        job = self.job(restarted, "u1")
+        self.assertTrue(job.callbacks[0].get("restored"))
+        self.assertEqual(job.last_execution_time, saved[0]["last_execution_time"])
+
+        # The first new subscription claims the restored job
+        callback = lambda: None
+        restarted.subscribe_to_user("u1", polling_time=30, callback=callback)
+        self.assertTrue(wait_for(lambda: [cb["function"] for cb in self.job(restarted, "u1").callbacks] == [callback]))
+        self.assertEqual(self.job(restarted, "u1").update_interval, 30)
+
+    def test_only_the_owners_subscriptions_are_restored(self):
+        first = self.start(resume_subscriptions=True, subscription_owner="bot-1")
+        second = self.start(resume_subscriptions=True, subscription_owner="bot-2")
+        unsaved = self.start()
+        first.subscribe_to_user("u1", polling_time=60, callback=lambda: None)
+        second.subscribe_to_user("u2", polling_time=60, callback=lambda: None)
+        unsaved.subscribe_to_user("u3", polling_time=60, callback=lambda: None)
+        self.assertTrue(wait_for(lambda: self.job(first, "u1") and self.job(second, "u2") and self.job(unsaved, "u3")))
+        for subscriber in (first, second, unsaved):
+            subscriber.shutdown()
+            self.subscribers.remove(subscriber)
+        self.assertEqual([row["params"] for row in self.db.get_subscriptions("bot-1")], ['["u1"]'])
+        self.assertEqual([row["params"] for row in self.db.get_subscriptions("bot-2")], ['["u2"]'])
+        self.assertEqual(self.db.get_subscriptions("default"), [])
+
+        restarted = self.start(resume_subscriptions=True, subscription_owner="bot-2")
+        self.assertTrue(wait_for(lambda: self.job(restarted, "u2") is not None))
+        self.assertEqual(list(restarted._jobs), [(restarted._update_user, ("u2",))])
+
+    def test_restored_subscriptions_expire_unless_subscribed_again(self):
+        subscriber = self.start(resume_subscriptions=True)
+        subscriber.subscribe_to_user("u1", polling_time=60, callback=lambda: None)
+        self.assertTrue(wait_for(lambda: self.job(subscriber, "u1") is not None))
+        subscriber.shutdown()
+        self.subscribers.remove(subscriber)
+
+        restarted = self.start(resume_subscriptions=True, resume_timeout=0.2)
+        self.assertTrue(wait_for(lambda: self.job(restarted, "u1") is not None))
+        self.assertTrue(wait_for(lambda: self.job(restarted, "u1") is None))
+        restarted.shutdown()
+        self.subscribers.remove(restarted)
+        self.assertEqual(self.db.get_subscriptions("default"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from autofold.database import (ManifoldDatabase, ManifoldDatabaseWriter, WriteQueue, WriteQueueFull,
+                               WRITE_PRIORITY_INTERACTIVE, WRITE_PRIORITY_NORMAL, WRITE_PRIORITY_BULK)
+
+
+class TestWriteQueue(unittest.TestCase):
+
+    def test_highest_priority_lane_first(self):
+        write_queue = WriteQueue()
+        write_queue.put("bulk 1", WRITE_PRIORITY_BULK)
+        write_queue.put("normal", WRITE_PRIORITY_NORMAL)
+        write_queue.put("bulk 2", WRITE_PRIORITY_BULK)
+        write_queue.put("interactive", WRITE_PRIORITY_INTERACTIVE)
+        items = [write_queue.get(timeout=0)[0] for _ in range(4)]
+        self.assertEqual(items, ["interactive", "normal", "bulk 1", "bulk 2"])
+        with self.assertRaises(queue.Empty):
+            write_queue.get(timeout=0)
+
+    def test_lanes_are_bounded_separately(self):
+        write_queue = WriteQueue(max_items=2)
+        write_queue.put(1, WRITE_PRIORITY_BULK)
+        write_queue.put(2, WRITE_PRIORITY_BULK)
+        with self.assertRaises(WriteQueueFull):
+            write_queue.put(3, WRITE_PRIORITY_BULK, block=False)
+        with self.assertRaises(WriteQueueFull):
+            write_queue.put(3, WRITE_PRIORITY_BULK, timeout=0.05)
+        # A full bulk lane does not hold up interactive writes
+        write_queue.put(4, WRITE_PRIORITY_INTERACTIVE, block=False)
+        self.assertEqual(write_queue.depths()["bulk"]["items"], 2)
+        self.assertEqual(write_queue.depths()["interactive"]["items"], 1)
+
+    def test_byte_bound_accepts_one_oversized_item(self):
+        write_queue = WriteQueue(max_bytes=100)
+        write_queue.put("big", WRITE_PRIORITY_NORMAL, size=1000, block=False)
+        with self.assertRaises(WriteQueueFull):
+            write_queue.put("small", WRITE_PRIORITY_NORMAL, size=1, block=False)
+        self.assertEqual(write_queue.depths()["normal"]["bytes"], 1000)
+
+    def test_blocked_put_resumes_when_room_frees_up(self):
+        write_queue = WriteQueue(max_items=1)
+        write_queue.put(1, WRITE_PRIORITY_BULK)
+        threading.Timer(0.1, write_queue.get).start()
+        blocked_time = write_queue.put(2, WRITE_PRIORITY_BULK, timeout=5)
+        self.assertGreater(blocked_time, 0.05)
+        self.assertEqual(write_queue.get(timeout=0), (2, WRITE_PRIORITY_BULK))
+
+
+class TestWriterLanes(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = ManifoldDatabase(os.path.join(self.dir, "manifold.db"))
+        self.db.create_tables()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_interactive_writes_run_ahead_of_queued_bulk_writes(self):
+        writer = ManifoldDatabaseWriter(self.db)
+        order = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def hold(_):
+            started.set()
+            release.wait(5)
+
+        try:
+            writer.queue_write_operation(function=hold, data=None, priority=WRITE_PRIORITY_BULK)
+            started.wait(5)
+            futures = [writer.queue_write_operation(function=order.append, data=f"bulk {i}", priority=WRITE_PRIORITY_BULK)
+                       for i in range(3)]
+            futures.append(writer.queue_write_operation(function=order.append, data="interactive", priority=WRITE_PRIORITY_INTERACTIVE))
+            release.set()
+            for future in futures:
+                future.result(timeout=5)
+            self.assertEqual(order, ["interactive", "bulk 0", "bulk 1", "bulk 2"])
+            stats = writer.stats()
+            self.assertEqual(stats["bulk"]["completed"], 4)
+            self.assertEqual(stats["interactive"]["completed"], 1)
+        finally:
+            release.set()
+            writer.shutdown()
+
+    def test_upsert_with_changes_resolves_with_the_changes(self):
+        writer = ManifoldDatabaseWriter(self.db)
+        user = {"id": "u1", "name": "a", "username": "a", "createdTime": 1, "balance": 1}
+        try:
+            changes = writer.queue_write_operation(function=self.db.upsert_with_changes, data=("users", [user], ["balance"], None)).result(timeout=5)
+            self.assertEqual(changes.inserted, ["u1"])
+            user["balance"] = 2
+            changes = writer.queue_write_operation(function=self.db.upsert_with_changes, data=("users", [user], ["balance"], None)).result(timeout=5)
+            self.assertEqual((changes.updated, changes.old["u1"], changes.new["u1"]), (["u1"], {"balance": 1}, {"balance": 2}))
+            # Write functions without a result still resolve with True
+            self.assertIs(writer.queue_write_operation(function=self.db.upsert_users, data=[user]).result(timeout=5), True)
+        finally:
+            writer.shutdown()
+
+    def test_fail_policy_rejects_when_lane_is_full(self):
+        writer = ManifoldDatabaseWriter(self.db, max_queue_items=1, full_policy="fail")
+        started = threading.Event()
+        release = threading.Event()
+
+        def hold(_):
+            started.set()
+            release.wait(5)
+
+        try:
+            writer.queue_write_operation(function=hold, data=None)
+            started.wait(5)
+            writer.queue_write_operation(function=hold, data=None)
+            with self.assertRaises(WriteQueueFull):
+                writer.queue_write_operation(function=hold, data=None)
+            self.assertEqual(writer.stats()["normal"]["rejected"], 1)
+            # Per-operation override of the policy
+            start = time.time()
+            with self.assertRaises(WriteQueueFull):
+                writer.queue_write_operation(function=hold, data=None, block=True, timeout=0.1)
+            self.assertGreaterEqual(time.time() - start, 0.1)
+        finally:
+            release.set()
+            writer.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()